@@ -9,11 +9,25 @@ from common.log import logger
 from lib.gewechat import GewechatClient
 from plugins import Plugin, EventContext, EventAction, Event
 from plugins.PKTracker.admin_manager import AdminManager
+from plugins.PKTracker.analytics import AnalyticsMirror
+from plugins.PKTracker.checkin_calendar import CheckinCalendar
 from plugins.PKTracker.checkin_manager import CheckinManager
+from plugins.PKTracker.checkin_search import CheckinSearch, checkin_index
+from plugins.PKTracker.consistency import ConsistencyChecker, load_report
+from plugins.PKTracker.content_store import checkin_content
 from plugins.PKTracker.database import DatabaseManager
+from plugins.PKTracker.dedup import checkin_dedup
+from plugins.PKTracker.metrics import metrics
 from plugins.PKTracker.ranking_manager import RankingManager
+from plugins.PKTracker.rescore import Rescorer
+from plugins.PKTracker.reward_rules import parse_rule_args
 from plugins.PKTracker.scheduler import TaskScheduler
+from plugins.PKTracker.shard_migrate import count_groups
+from plugins.PKTracker.shards import shards
+from plugins.PKTracker.slow_query import slow_queries
 from plugins.PKTracker.task_manager import TaskManager
+from plugins.PKTracker.throttle import checkin_throttle
+from plugins.PKTracker.upgrade import upgrade_database
 from plugins.PKTracker.user_manager import UserManager
 
 
@@ -43,10 +57,42 @@ class PKTracker(Plugin):
                 if not self.config:
                     self.config = self._load_config_template()
 
+                # 性能统计开关和慢查询记录
+                metrics.enabled = self.config.get("enable_metrics", True)
+                slow_queries.configure(
+                    self.config.get("slow_query_threshold_ms", 200),
+                    os.path.join(os.path.dirname(__file__), self.config.get("slow_query_log", "slow_query.log"))
+                )
+
+                # 打卡限流
+                throttle_config = self.config.get("checkin_throttle", {})
+                checkin_throttle.configure(
+                    user_per_minute=throttle_config.get("user_per_minute", 6),
+                    user_burst=throttle_config.get("user_burst", 3),
+                    group_per_minute=throttle_config.get("group_per_minute", 120),
+                    group_burst=throttle_config.get("group_burst", 30),
+                    max_buckets=throttle_config.get("max_buckets", 10000)
+                )
+                checkin_dedup.configure(self.config.get("checkin_dedup_size", 4096))
+                checkin_content.configure(self.config.get("content_compress_threshold", 200))
+
                 # 初始化数据库
                 db_name = self.config.get("db_path", "pkTracker.db")
                 self.db_path = os.path.join(os.path.dirname(__file__), db_name)
-                self.db_manager = DatabaseManager(self.db_path)
+                self.db_manager = DatabaseManager(self.db_path, wal=self.config.get("enable_wal", True))
+                checkin_index.configure(self.db_manager.fts_enabled)
+                upgrade_database(self.db_manager)
+                # 按群组分库: 每个群的数据在单独的文件中, 分库第一次用到时同样执行升级回填
+                shard_config = self.config.get("shards", {})
+                shards.configure(
+                    shard_config.get("enable", False),
+                    directory=shard_config.get("directory", "shards"),
+                    wal=self.config.get("enable_wal", True),
+                    upgrade=upgrade_database
+                )
+                if shards.enabled and count_groups(self.db_path):
+                    logger.warning("[PKTracker] 已开启按群组分库, 但主库中还有群组数据(开启后不再读取), "
+                                   "请先停止插件执行 python -m plugins.PKTracker.shard_migrate 拆分")
 
                 # 初始化客户端
                 self._init_client()
@@ -57,10 +103,28 @@ class PKTracker(Plugin):
                 self.user_manager = UserManager(self.client, self.app_id)
                 self.admin_manager = AdminManager(self.db_path, self.config, self.user_manager)
                 self.ranking_manager = RankingManager(self.db_path, self.user_manager)
+                self.checkin_calendar = CheckinCalendar(self.db_path, self.user_manager)
+                self.checkin_search = CheckinSearch(self.db_path, self.user_manager)
+                self.rescorer = Rescorer(self.db_path, self.user_manager)
+                # 统计报告使用的分析库, 由调度器定时增量同步
+                self.analytics = None
+                analytics_config = self.config.get("analytics_mirror", {})
+                if analytics_config.get("enable", False) and shards.enabled:
+                    logger.warning("[PKTracker] 分析库只支持单个数据库, 开启按群组分库时统计报告不可用")
+                elif analytics_config.get("enable", False):
+                    self.analytics = AnalyticsMirror(
+                        self.db_path,
+                        os.path.join(os.path.dirname(__file__), analytics_config.get("path", "analytics_mirror")),
+                        backend=analytics_config.get("backend", "auto"),
+                        batch_size=analytics_config.get("batch_size", 5000)
+                    )
 
                 # 只在第一次初始化时创建和启动调度器
                 self.scheduler = TaskScheduler(self.db_path, self)
                 self.scheduler.start_scheduler()
+                if self.analytics is not None:
+                    # 启动后尽快同步一次, 不等待第一个同步周期
+                    self.scheduler.run_soon("sync_analytics")
 
                 # 注册事件处理器
                 self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
@@ -155,6 +219,8 @@ class PKTracker(Plugin):
             group_id = receiver_value
             session_id = context.kwargs.get("session_id", "")
             user_id = session_id.split('@@')[0]
+            # 通道断线重连后可能重复投递同一条消息, 打卡按消息 ID 去重
+            msg_id = getattr(context.kwargs.get("msg"), "msg_id", None)
 
             # 解析命令
             parts = content.split()
@@ -165,7 +231,14 @@ class PKTracker(Plugin):
                 return
 
             command = parts[1]
-            reply_text = self.handle_command(command, parts, user_id, group_id)
+            metric_name = "打卡" if command.startswith("[") and command.endswith("]") else command
+            with metrics.timer("command", metric_name):
+                reply_text = self.handle_command(command, parts, user_id, group_id, msg_id)
+
+            if reply_text is None:
+                # 被限流且已经提示过, 直接丢弃不回复
+                e_context.action = EventAction.BREAK_PASS
+                return
 
             reply = Reply(ReplyType.TEXT, reply_text)
             e_context["reply"] = reply
@@ -177,15 +250,26 @@ class PKTracker(Plugin):
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS
 
-    def handle_command(self, command, parts, user_id, group_id):
+    def handle_command(self, command, parts, user_id, group_id, msg_id=None):
         """处理各种命令"""
         # 处理打卡命令
         if command.startswith("[") and command.endswith("]"):
             task_name = command[1:-1]
             if len(parts) < 3:
                 return "请输入打卡内容"
+            msg_id = str(msg_id) if msg_id else None
+            # 重复投递的消息直接返回第一次的结果, 也不消耗限流令牌
+            replay = checkin_dedup.get(msg_id)
+            if replay is not None:
+                return replay
+            # 在访问数据库之前拦截刷屏, 每轮限流只提示一次
+            allowed, notify, level = checkin_throttle.check(group_id, user_id)
+            if not allowed:
+                if not notify:
+                    return None
+                return "⏳ 打卡太频繁了,请稍后再试" if level == "user" else "⏳ 本群打卡人数过多,请稍后再试"
             content = " ".join(parts[2:])
-            return self.checkin_manager.handle_checkin(user_id, group_id, task_name, content)
+            return self.checkin_manager.handle_checkin(user_id, group_id, task_name, content, msg_id)
 
         # 处理管理员命令
         elif command == "设置频率":
@@ -202,7 +286,84 @@ class PKTracker(Plugin):
 
         # 处理查询命令
         elif command == "积分榜":
-            return self.ranking_manager.get_ranking(group_id, parts[2] if len(parts) > 2 else None)
+            try:
+                task_name, window, page = self._parse_ranking_args(parts)
+            except ValueError:
+                return "❌ 页码必须是正整数"
+            return self.ranking_manager.get_ranking(group_id, task_name, window, page)
+
+        # 处理我的排名命令
+        elif command == "我的排名":
+            task_name = parts[2][1:-1] if len(parts) > 2 and parts[2].startswith("[") and parts[2].endswith("]") else None
+            return self.ranking_manager.get_my_rank(group_id, user_id, task_name)
+
+        # 处理全局排行榜命令
+        elif command == "全局榜":
+            if not self.admin_manager.is_super_admin(user_id):
+                return "只有超级管理员可以查看全局排行榜"
+            try:
+                task_name, window, page = self._parse_ranking_args(parts)
+            except ValueError:
+                return "❌ 页码必须是正整数"
+            return self.ranking_manager.get_global_ranking(task_name, window, page)
+
+        # 处理打卡日历命令
+        elif command == "打卡日历":
+            names = []
+            year = None
+            for part in parts[2:]:
+                if part.startswith('y[') and part.endswith(']'):
+                    try:
+                        year = int(part[2:-1])
+                    except ValueError:
+                        return "❌ 年份必须是整数"
+                elif part.startswith('[') and part.endswith(']'):
+                    names.append(part[1:-1])
+            if not names or len(names) > 2:
+                return "格式错误,请使用: PKTracker 打卡日历 [任务名称] [用户名] y[年份]"
+            user_name = names[1] if len(names) == 2 else None
+            return self.checkin_calendar.get_calendar(group_id, names[0], user_name=user_name,
+                                                      sender_id=user_id, year=year)
+
+        # 处理搜索打卡命令
+        elif command == "搜索打卡":
+            terms = []
+            task_name = None
+            user_name = None
+            page = 1
+            for part in parts[2:]:
+                if part.startswith('p[') and part.endswith(']'):
+                    try:
+                        page = int(part[2:-1])
+                        if page < 1:
+                            return "❌ 页码必须大于0"
+                    except ValueError:
+                        return "❌ 页码必须是正整数"
+                elif part.startswith('u[') and part.endswith(']'):
+                    user_name = part[2:-1]
+                elif part.startswith('[') and part.endswith(']'):
+                    task_name = part[1:-1]
+                else:
+                    terms.append(part)
+            return self.checkin_search.search(group_id, terms, task_name=task_name, user_name=user_name,
+                                              sender_id=user_id, page=page)
+
+        # 处理统计报告命令
+        elif command == "统计报告":
+            if self.analytics is None:
+                return "❌ 未启用分析库, 请在配置中开启 analytics_mirror"
+            report = "趋势"
+            task_name = None
+            for part in parts[2:]:
+                if part.startswith('[') and part.endswith(']'):
+                    task_name = part[1:-1]
+                else:
+                    report = part
+            if report == "趋势":
+                return self.analytics.trend(group_id, task_name)
+            elif report == "留存":
+                return self.analytics.retention(group_id, task_name)
+            return "格式错误,请使用: PKTracker 统计报告 [趋势/留存] [任务名称]"
 
         # 处理任务列表命令
         elif command == "任务列表":
@@ -266,6 +427,11 @@ class PKTracker(Plugin):
             task_name = parts[2][1:-1]
             return self.task_manager.get_task_detail(group_id, task_name)
 
+        elif command == "奖励规则":
+            if len(parts) != 3 or not (parts[2].startswith('[') and parts[2].endswith(']')):
+                return "格式错误,请使用: PKTracker 奖励规则 [任务名称]"
+            return self.task_manager.get_reward_rules(group_id, parts[2][1:-1])
+
         # 处理积分详情命令
         elif command == "积分详情":
             page = 1
@@ -483,7 +649,43 @@ class PKTracker(Plugin):
                 return "格式错误,请使用: PKTracker 删除任务 [任务名称]"
 
             task_name = parts[2][1:-1]
-            return self.task_manager.delete_task(group_id, task_name)
+            result = self.task_manager.delete_task(group_id, task_name)
+            if result.startswith("✅"):
+                # 立即开始后台清理, 不必等到下一分钟
+                self.scheduler.run_soon('purge_deleted_tasks')
+            return result
+        # 处理设置奖励规则命令
+        elif command == "设置奖励规则":
+            if not self.admin_manager.is_admin(group_id, user_id):
+                return "只有管理员可以设置奖励规则"
+
+            if len(parts) < 4 or not (parts[2].startswith('[') and parts[2].endswith(']')):
+                return "格式错误,请使用: PKTracker 设置奖励规则 [任务名称] n[名额] t[天数:分数] w[时段:分数] x[倍数]"
+
+            task_name = parts[2][1:-1]
+            if parts[3:] == ["清除"]:
+                return self.task_manager.set_reward_rules(group_id, task_name, None)
+            try:
+                extra = parse_rule_args(parts[3:])
+            except ValueError as e:
+                return f"❌ {e}"
+            return self.task_manager.set_reward_rules(group_id, task_name, extra)
+        # 处理重新计分命令
+        elif command == "重新计分":
+            if not self.admin_manager.is_admin(group_id, user_id):
+                return "只有管理员可以重新计分"
+
+            if len(parts) not in (3, 4) or not (parts[2].startswith('[') and parts[2].endswith(']')) \
+                    or (len(parts) == 4 and parts[3] != "确认"):
+                return "格式错误,请使用: PKTracker 重新计分 [任务名称] [确认]"
+
+            return self.rescorer.rescore(group_id, parts[2][1:-1], apply=len(parts) == 4)
+        # 处理查看清理进度命令
+        elif command == "清理进度":
+            if not self.admin_manager.is_admin(group_id, user_id):
+                return "只有管理员可以查看清理进度"
+
+            return self.task_manager.get_purge_progress(group_id)
             # 处理设置提醒时间命令
         elif command == "设置提醒时间":
             if not self.admin_manager.is_admin(group_id, user_id):
@@ -507,9 +709,93 @@ class PKTracker(Plugin):
                 return "❌ 请设置提醒时间：time[HH:MM]"
 
             return self.task_manager.set_reminder(group_id, task_name, reminder_time, remind_text)
+
+        # 处理性能统计命令
+        elif command == "性能统计":
+            if not self.admin_manager.is_super_admin(user_id):
+                return "只有超级管理员可以查看性能统计"
+
+            action = parts[2] if len(parts) > 2 else None
+            if action == "导出":
+                file_name = self.config.get("metrics_file", "metrics.json")
+                path = metrics.dump(os.path.join(os.path.dirname(__file__), file_name))
+                return f"✅ 性能统计已导出到: {path}"
+            elif action == "重置":
+                metrics.reset()
+                checkin_throttle.reset()
+                checkin_dedup.reset()
+                return "✅ 性能统计已重置"
+            elif action is not None:
+                return "格式错误,请使用: PKTracker 性能统计 [导出/重置]"
+            return "\n\n".join([metrics.format_report(), checkin_throttle.format_report(),
+                                checkin_dedup.format_report()])
+
+        # 处理慢查询命令
+        elif command == "慢查询":
+            if not self.admin_manager.is_super_admin(user_id):
+                return "只有超级管理员可以查看慢查询"
+
+            action = parts[2] if len(parts) > 2 else None
+            if action == "重置":
+                slow_queries.reset()
+                return "✅ 慢查询统计已重置"
+            elif action is not None:
+                return "格式错误,请使用: PKTracker 慢查询 [重置]"
+            return slow_queries.format_report()
+
+        # 处理一致性检查命令
+        elif command == "一致性检查":
+            if not self.admin_manager.is_super_admin(user_id):
+                return "只有超级管理员可以执行一致性检查"
+
+            action = parts[2] if len(parts) > 2 else None
+            if action in ("执行", "修复"):
+                # 全表扫描耗时较长, 在后台执行, 不占用消息处理线程
+                if not self.scheduler.check_consistency(repair=action == "修复"):
+                    return "❌ 一致性检查正在进行中,请稍后查看报告"
+                return "✅ 一致性检查已开始, 稍后用 PKTracker 一致性检查 查看报告"
+            elif action is not None:
+                return "格式错误,请使用: PKTracker 一致性检查 [执行/修复]"
+            return ConsistencyChecker.format_report(load_report(self.scheduler.consistency_report_path))
+
+        # 处理数据库备份命令
+        elif command == "备份":
+            if not self.admin_manager.is_super_admin(user_id):
+                return "只有超级管理员可以执行数据库备份"
+
+            action = parts[2] if len(parts) > 2 else None
+            if action == "执行":
+                # 分步复制之间会休眠, 大库需要较长时间, 在后台执行
+                if not self.scheduler.backup_database():
+                    return "❌ 数据库备份正在进行中,请稍后查看结果"
+                return "✅ 数据库备份已开始, 稍后用 PKTracker 备份 查看结果"
+            elif action is not None:
+                return "格式错误,请使用: PKTracker 备份 [执行]"
+            return self.scheduler.backup.format_report(self.scheduler.backup.load_report())
         else:
             return "未知命令,请检查输入"
 
+    @staticmethod
+    def _parse_ranking_args(parts):
+        """解析排行榜命令的参数: [任务名称] w[时间范围] p[页码], 均可省略
+
+        Raises:
+            ValueError: 页码不是正整数
+        """
+        task_name, window, page = None, None, 1
+        for part in parts[2:]:
+            if part.startswith("w[") and part.endswith("]"):
+                window = part[2:-1]
+            elif part.startswith("p[") and part.endswith("]"):
+                page = int(part[2:-1])
+                if page < 1:
+                    raise ValueError(part)
+            elif part.startswith("[") and part.endswith("]"):
+                task_name = part[1:-1]
+            else:
+                task_name = part
+        return task_name, window, page
+
     def get_help_text(self, **kwargs):
         base_help = """📝 微信群打卡PK插件使用指南
 
@@ -522,10 +808,21 @@ class PKTracker(Plugin):
         PKTracker 任务列表
       - 查看任务详情:
         PKTracker 任务详情 [任务名称]
+      - 查看任务的奖励规则:
+        PKTracker 奖励规则 [任务名称]
       - 查看指定任务排名:
         PKTracker 积分榜 [任务名称]
       - 查看所有任务排名:
         PKTracker 积分榜
+      - 查看指定时间范围的排名:
+        PKTracker 积分榜 [任务名称] w[时间范围]
+        时间范围: 今天/昨天/本周/上周/本月/上月/今年/N天/2024-01-01~2024-01-31
+        例如: PKTracker 积分榜 w[本周]
+      - 翻页查看排名(每页10人):
+        PKTracker 积分榜 [任务名称] p[页码]
+        例如: PKTracker 积分榜 [早起] p[2]
+      - 查看自己的排名(名次、与上一名的分差、前后各5人):
+        PKTracker 我的排名 [任务名称]
       - 查看积分详情:
         PKTracker 积分详情 [用户名] p[页码]
         例如: 
@@ -533,6 +830,19 @@ class PKTracker(Plugin):
         PKTracker 积分详情 p[2]     (查看自己的第2页)
         PKTracker 积分详情 [张三]    (查看张三的第1页)
         PKTracker 积分详情 [张三] p[2] (查看张三的第2页)
+      - 查看打卡日历(全年每天是否打卡、连续天数):
+        PKTracker 打卡日历 [任务名称] [用户名] y[年份]
+        例如: 
+        PKTracker 打卡日历 [早起]            (查看自己今年的日历)
+        PKTracker 打卡日历 [早起] [张三] y[2024] (查看张三2024年的日历)
+      - 搜索打卡内容(多个关键词需同时出现, 每页5条):
+        PKTracker 搜索打卡 关键词 [任务名称] u[用户名] p[页码]
+        例如:
+        PKTracker 搜索打卡 10km              (搜索全群的打卡)
+        PKTracker 搜索打卡 10km [跑步] u[我]   (搜索自己跑步任务的打卡)
+      - 查看统计报告(需开启分析库, 数据定时同步):
+        PKTracker 统计报告 趋势 [任务名称]   (最近14天每天的打卡人数、次数和积分)
+        PKTracker 统计报告 留存 [任务名称]   (最近6周新用户之后每周的留存比例)
 
     🔹 管理员指令:
       1. 任务管理:
@@ -540,6 +850,8 @@ class PKTracker(Plugin):
            PKTracker 创建任务 [任务名称]
          - 删除任务:
            PKTracker 删除任务 [任务名称]
+         - 查看已删除任务的后台清理进度:
+           PKTracker 清理进度
          - 设置任务状态和基础分:
            PKTracker 设置任务 [任务名称] s[开/关] b[分数]
            例如: PKTracker 设置任务 [早起] s[开] b[2]
@@ -561,6 +873,13 @@ class PKTracker(Plugin):
            PKTracker 设置周冠军 [任务名称] s[开/关] b[分数]
          - 设置月冠军奖励:
            PKTracker 设置月冠军 [任务名称] s[开/关] b[分数]
+         - 设置附加奖励规则(可组合, "清除" 恢复为只用上面的设置):
+           PKTracker 设置奖励规则 [任务名称] n[前N个打卡有首次奖励] t[天数:分数,...] w[HH:MM-HH:MM:分数] x[倍数]
+           例如: PKTracker 设置奖励规则 [早起] n[3] t[7:3,30:5] w[05:00-06:30:2] x[06:00-07:00:1.5]
+           PKTracker 设置奖励规则 [早起] 清除
+         - 按当前规则重新计算历史打卡的基础/首次/连续积分(不带"确认"时只预览差异):
+           PKTracker 重新计分 [任务名称] [确认]
+           (确认后分析库在下次同步时重新复制该任务的积分, 统计报告在同步完成后更新)
 
       4. 管理员管理:
          - 查看管理员:
@@ -570,11 +889,34 @@ class PKTracker(Plugin):
          - 取消管理员(仅超管):
            PKTracker 取消管理员 [用户名]
 
+      5. 性能统计(仅超管):
+         - 查看统计:
+           PKTracker 性能统计
+         - 导出为 JSON / 清空统计:
+           PKTracker 性能统计 导出
+           PKTracker 性能统计 重置
+         - 查看慢查询排行:
+           PKTracker 慢查询
+         - 数据一致性检查(查看最近报告 / 立即检查 / 检查并修复):
+           PKTracker 一致性检查
+           PKTracker 一致性检查 执行
+           PKTracker 一致性检查 修复
+         - 数据库在线备份(查看最近一次备份 / 立即备份):
+           PKTracker 备份
+           PKTracker 备份 执行
+
+      6. 全局排行榜(仅超管):
+         - 跨群统计同名任务的排名:
+           PKTracker 全局榜 [任务名称] w[时间范围] p[页码]
+           例如: PKTracker 全局榜 [早起] w[本月]
+
     🔸 系统功能:
       - 每日排行榜: 每天早上9:10自动发送
-      - 周冠军公告: 每周日晚23:00自动结算
-      - 月冠军公告: 每月最后一天23:00自动结算
+      - 周冠军公告: 每周一00:05自动结算上周(周一至周日)
+      - 月冠军公告: 每月1日00:05自动结算上个月
       - 定时提醒: 根据设置的提醒时间自动发送
+      - 一致性检查: 每天凌晨4:30在后台检查打卡和积分数据
+      - 数据库备份: 每天凌晨3:30在线备份, 保留最近7份
 
     💡 Tips: 
       - 每个任务可以设置每日打卡次数限制
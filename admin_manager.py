@@ -1,6 +1,6 @@
-import sqlite3
-
 from common.log import logger
+from plugins.PKTracker.database import get_connection
+from plugins.PKTracker.shards import shards
 
 
 class AdminManager:
@@ -15,7 +15,7 @@ class AdminManager:
             return True
 
         """检查用户是否为管理员"""
-        conn = sqlite3.connect(self.db_path)
+        conn = get_connection(shards.path(self.db_path, group_id), readonly=True)
         c = conn.cursor()
         c.execute("SELECT 1 FROM t_admin WHERE group_id=? AND user_id=?",
                   (group_id, user_id))
@@ -40,7 +40,7 @@ class AdminManager:
             return "❌ 只有超级管理员才能添加管理员"
 
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id))
             c = conn.cursor()
 
             # 检查是否已经是管理员
@@ -77,7 +77,7 @@ class AdminManager:
             return "❌ 只有超级管理员才能取消管理员"
 
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id))
             c = conn.cursor()
 
             # 检查是否是超级管理员
@@ -112,7 +112,7 @@ class AdminManager:
             str: 管理员列表信息
         """
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id), readonly=True)
             c = conn.cursor()
 
             # 获取所有管理员ID
@@ -0,0 +1,355 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from common.log import logger
+from plugins.PKTracker.database import get_connection
+
+try:
+    import duckdb
+except ImportError:  # 可选依赖, 未安装时使用 SQLite 文件作为分析库
+    duckdb = None
+
+# 每批从主库读取的行数
+MIRROR_BATCH_SIZE = 5000
+
+# DuckDB 文件被其他进程的同步连接锁定时, 报告连接的重试次数和间隔(秒)
+LOCK_RETRIES = 5
+LOCK_RETRY_DELAY = 0.2
+
+# 趋势报告的天数和留存报告的周数
+TREND_DAYS = 14
+RETENTION_WEEKS = 6
+
+MIRROR_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS mirror_task
+       (task_id BIGINT PRIMARY KEY, group_id VARCHAR, task_name VARCHAR, enable BIGINT)""",
+    """CREATE TABLE IF NOT EXISTS mirror_checkin
+       (checkin_id BIGINT PRIMARY KEY, task_id BIGINT, user_id VARCHAR, day VARCHAR, week BIGINT)""",
+    """CREATE TABLE IF NOT EXISTS mirror_bonus
+       (bonus_id BIGINT PRIMARY KEY, task_id BIGINT, user_id VARCHAR, bonus_type VARCHAR,
+        bonus_value BIGINT, day VARCHAR)""",
+    """CREATE TABLE IF NOT EXISTS mirror_state (name VARCHAR PRIMARY KEY, value BIGINT)""",
+]
+
+# 主库上的增量抽取, 按主键范围读取, 每批一个读事务
+EXTRACT_CHECKINS = """
+    SELECT checkin_id, task_id, user_id, checkin_time FROM t_checkin_log
+    WHERE checkin_id > ? AND checkin_id <= ? ORDER BY checkin_id LIMIT ?
+"""
+
+EXTRACT_BONUSES = """
+    SELECT bonus_id, task_id, user_id, bonus_type, bonus_value, create_time FROM t_bonus
+    WHERE bonus_id > ? AND bonus_id <= ? ORDER BY bonus_id LIMIT ?
+"""
+
+# 重新计分的任务按 bonus_id 范围重新复制水位线以下的积分记录
+EXTRACT_TASK_BONUSES = """
+    SELECT bonus_id, task_id, user_id, bonus_type, bonus_value, create_time FROM t_bonus
+    WHERE task_id = ? AND bonus_id > ? AND bonus_id <= ? ORDER BY bonus_id LIMIT ?
+"""
+
+INSERT_CHECKINS = "INSERT INTO mirror_checkin VALUES (?, ?, ?, ?, ?)"
+INSERT_BONUSES = "INSERT INTO mirror_bonus VALUES (?, ?, ?, ?, ?, ?)"
+
+
+class MirrorBusy(Exception):
+    """DuckDB 分析库正被其他进程同步, 暂时无法打开"""
+
+
+def week_number(day):
+    """从 0001-01-01(星期一)起的周序号, 同一自然周(周一到周日)的日期序号相同"""
+    return (day.toordinal() - 1) // 7
+
+
+def week_start(week):
+    return date.fromordinal(week * 7 + 1)
+
+
+def _checkin_row(row):
+    checkin_id, task_id, user_id, checkin_time = row
+    day = checkin_time[:10]
+    return checkin_id, task_id, user_id, day, week_number(date.fromisoformat(day))
+
+
+def _bonus_row(row):
+    bonus_id, task_id, user_id, bonus_type, bonus_value, create_time = row
+    # 与日汇总一致, 积分按 create_time 的日期归属
+    return bonus_id, task_id, user_id, bonus_type, bonus_value, (create_time or "")[:10]
+
+
+class AnalyticsMirror:
+    """统计报告使用的分析库
+
+    定时把 t_task 全量、t_checkin_log / t_bonus 按自增主键的水位线增量复制到单独的分析库,
+    趋势、留存等需要扫描大量历史记录的报告只在分析库上计算, 主库只承担按主键范围读取的增量抽取。
+    SQLite 同一时刻只有一个写事务, 主键小于水位线的记录不会在之后才提交, 所以按水位线复制不会漏行。
+
+    分析库优先使用 DuckDB(列式存储, 需要安装 duckdb), 未安装时使用单独的 SQLite 文件。
+    DuckDB 同一时刻只允许一个进程以读写方式打开文件: 同步只在主调度进程执行, 报告以只读方式打开,
+    文件正被其他进程同步时短暂重试后提示同步中; 本进程正在同步时在同步连接上新建游标读取。
+    主库中删除的任务在下次同步时从分析库删除; 重新计分会原地修改和删除积分记录, 按 t_rescore_log 中新增的记录
+    把这些任务在分析库中的积分记录删除后重新复制。一致性修复删除的个别积分记录不会同步, 需要时删除分析库文件后全量重建。
+    """
+
+    def __init__(self, db_path, mirror_path, backend="auto", batch_size=MIRROR_BATCH_SIZE):
+        self.db_path = db_path
+        if backend == "auto":
+            backend = "duckdb" if duckdb is not None else "sqlite"
+        elif backend == "duckdb" and duckdb is None:
+            logger.warning("[PKTracker] 未安装 duckdb, 分析库改用 SQLite")
+            backend = "sqlite"
+        self.backend = backend
+        self.mirror_path = f"{mirror_path}.{'duckdb' if backend == 'duckdb' else 'db'}"
+        self.batch_size = batch_size
+        self._sync_lock = threading.Lock()
+        # 本进程正在同步时的分析库连接, 报告在其上新建游标; 同步连接在持有 _writer_lock 时打开和关闭
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def _connect(self, read_only=False):
+        if self.backend == "duckdb":
+            for attempt in range(LOCK_RETRIES):
+                try:
+                    return duckdb.connect(self.mirror_path, read_only=read_only)
+                except duckdb.IOException as e:
+                    # 文件锁被其他进程持有(同步中, 或同步时有其他进程正在读取报告)
+                    if attempt == LOCK_RETRIES - 1:
+                        raise MirrorBusy(str(e))
+                    time.sleep(LOCK_RETRY_DELAY)
+        conn = sqlite3.connect(self.mirror_path)
+        # 报告读取不阻塞同步写入
+        conn.execute("PRAGMA journal_mode = WAL")
+        return conn
+
+    def sync(self):
+        """增量同步一次, 已有同步在进行中时直接返回
+
+        Returns:
+            dict: 本次复制的行数, 跳过时返回 None
+        """
+        if not self._sync_lock.acquire(blocking=False):
+            return None
+        start = time.perf_counter()
+        src = dst = None
+        try:
+            src = get_connection(self.db_path, readonly=True)
+            with self._writer_lock:
+                dst = self._writer = self._connect()
+            for statement in MIRROR_SCHEMA:
+                dst.execute(statement)
+            state = dict(dst.execute("SELECT name, value FROM mirror_state").fetchall())
+
+            c = src.cursor()
+            c.execute("SELECT COALESCE(MAX(checkin_id), 0) FROM t_checkin_log")
+            max_checkin = c.fetchone()[0]
+            c.execute("SELECT COALESCE(MAX(bonus_id), 0) FROM t_bonus")
+            max_bonus = c.fetchone()[0]
+            c.execute("SELECT COALESCE(MAX(rescore_id), 0) FROM t_rescore_log")
+            max_rescore = c.fetchone()[0]
+            if (max_checkin < state.get("checkin_id", 0) or max_bonus < state.get("bonus_id", 0)
+                    or max_rescore < state.get("rescore_id", 0)):
+                # 主库的最大主键比水位线还小, 说明主库被恢复或替换过, 全量重建
+                logger.warning("[PKTracker] 主库记录少于分析库水位线, 重建分析库")
+                dst.execute("BEGIN TRANSACTION")
+                dst.execute("DELETE FROM mirror_checkin")
+                dst.execute("DELETE FROM mirror_bonus")
+                dst.execute("DELETE FROM mirror_state")
+                dst.commit()
+                state = {}
+
+            copied = {
+                # 先按复制前的水位线重新复制重新计分的任务, 水位线之上的记录由之后的增量复制处理
+                "rescored": self._recopy_rescored(c, dst, state.get("rescore_id", 0), max_rescore,
+                                                  state.get("bonus_id", 0)),
+                "checkins": self._copy(c, dst, EXTRACT_CHECKINS, _checkin_row, INSERT_CHECKINS, "checkin_id",
+                                       state.get("checkin_id", 0), max_checkin),
+                "bonuses": self._copy(c, dst, EXTRACT_BONUSES, _bonus_row, INSERT_BONUSES, "bonus_id",
+                                      state.get("bonus_id", 0), max_bonus),
+            }
+
+            # 任务表很小, 每次全量替换; 已删除任务的记录随之删除
+            c.execute("SELECT task_id, group_id, task_name, enable FROM t_task")
+            tasks = c.fetchall()
+            dst.execute("BEGIN TRANSACTION")
+            dst.execute("DELETE FROM mirror_task")
+            if tasks:
+                dst.executemany("INSERT INTO mirror_task VALUES (?, ?, ?, ?)", tasks)
+            dst.execute("DELETE FROM mirror_checkin WHERE task_id NOT IN (SELECT task_id FROM mirror_task)")
+            dst.execute("DELETE FROM mirror_bonus WHERE task_id NOT IN (SELECT task_id FROM mirror_task)")
+            self._set_state(dst, "synced_at", int(time.time()))
+            dst.commit()
+        except Exception as e:
+            logger.error(f"[PKTracker] 同步分析库异常: {str(e)}")
+            return None
+        finally:
+            if src is not None:
+                src.close()
+            if dst is not None:
+                with self._writer_lock:
+                    self._writer = None
+                    dst.close()
+            self._sync_lock.release()
+        logger.debug(f"[PKTracker] 分析库同步完成: {copied}, 耗时 {time.perf_counter() - start:.2f}s")
+        return copied
+
+    def _copy(self, cursor, dst, sql, convert, insert, key, last, upper):
+        """按主键从 last 复制到 upper, 每批的写入和水位线在分析库的同一个事务中提交"""
+        copied = 0
+        while last < upper:
+            cursor.execute(sql, (last, upper, self.batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last = rows[-1][0]
+            dst.execute("BEGIN TRANSACTION")
+            dst.executemany(insert, [convert(row) for row in rows])
+            self._set_state(dst, key, last)
+            dst.commit()
+            copied += len(rows)
+        return copied
+
+    def _recopy_rescored(self, cursor, dst, last, upper, watermark):
+        """删除重新计分的任务在分析库中的积分记录, 按主键重新复制到 watermark, 返回复制的行数
+
+        每个任务的删除和重新复制在分析库的同一个事务中提交; 中途失败时 rescore_id 的水位线不变, 下次同步重新执行。
+        """
+        if last >= upper:
+            return 0
+        cursor.execute("SELECT task_id FROM t_rescore_log WHERE rescore_id > ? AND rescore_id <= ?", (last, upper))
+        copied = 0
+        # 同一任务多次重新计分只需重新复制一次
+        for task_id in dict.fromkeys(row[0] for row in cursor.fetchall()):
+            dst.execute("BEGIN TRANSACTION")
+            dst.execute("DELETE FROM mirror_bonus WHERE task_id = ?", (task_id,))
+            bonus_id = 0
+            while bonus_id < watermark:
+                cursor.execute(EXTRACT_TASK_BONUSES, (task_id, bonus_id, watermark, self.batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                bonus_id = rows[-1][0]
+                dst.executemany(INSERT_BONUSES, [_bonus_row(row) for row in rows])
+                copied += len(rows)
+            dst.commit()
+        dst.execute("BEGIN TRANSACTION")
+        self._set_state(dst, "rescore_id", upper)
+        dst.commit()
+        return copied
+
+    @staticmethod
+    def _set_state(dst, name, value):
+        dst.execute("DELETE FROM mirror_state WHERE name = ?", (name,))
+        dst.execute("INSERT INTO mirror_state VALUES (?, ?)", (name, value))
+
+    def _query(self, sql, params):
+        """在分析库上执行报告查询, 返回 (结果, 同步时间)"""
+        if not os.path.exists(self.mirror_path):
+            return None, None
+        # 持有锁期间本进程的同步连接不会打开或关闭
+        with self._writer_lock:
+            if self.backend == "duckdb" and self._writer is not None:
+                # 本进程的同步连接以读写方式持有文件, 不能再以只读方式打开
+                conn = self._writer.cursor()
+            else:
+                conn = self._connect(read_only=True)
+            rows, synced = self._read(conn, sql, params)
+        synced_at = datetime.fromtimestamp(synced[0]).strftime('%Y-%m-%d %H:%M') if synced else None
+        return rows, synced_at
+
+    @staticmethod
+    def _read(conn, sql, params):
+        try:
+            rows = conn.execute(sql, params).fetchall()
+            synced = conn.execute("SELECT value FROM mirror_state WHERE name = 'synced_at'").fetchone()
+        finally:
+            conn.close()
+        return rows, synced
+
+    def trend(self, group_id: str, task_name: str = None, days: int = TREND_DAYS) -> str:
+        """最近 days 天每天的打卡人数、打卡次数和获得的积分"""
+        today = date.today()
+        first = (today - timedelta(days=days - 1)).isoformat()
+        task_filter = " AND t.task_name = ?" if task_name else ""
+        params = [group_id, first] + ([task_name] if task_name else [])
+        try:
+            checkins, synced_at = self._query(f"""
+                SELECT c.day, COUNT(DISTINCT c.user_id), COUNT(*)
+                FROM mirror_checkin c JOIN mirror_task t ON t.task_id = c.task_id
+                WHERE t.group_id = ? AND t.enable = 1 AND c.day >= ?{task_filter}
+                GROUP BY c.day""", params)
+            points, _ = self._query(f"""
+                SELECT b.day, SUM(b.bonus_value)
+                FROM mirror_bonus b JOIN mirror_task t ON t.task_id = b.task_id
+                WHERE t.group_id = ? AND t.enable = 1 AND b.day >= ?{task_filter}
+                GROUP BY b.day""", params)
+        except MirrorBusy:
+            return "⏳ 分析库正在同步,请稍后再试"
+        except Exception as e:
+            logger.exception(f"[PKTracker] 生成趋势报告异常: {str(e)}")
+            return "❌ 统计报告生成失败,请稍后重试"
+        if synced_at is None:
+            return "⏳ 分析库尚未完成首次同步,请稍后再试"
+
+        by_day = {day: (users, count) for day, users, count in checkins}
+        points = dict(points)
+        scope = f"[{task_name}]" if task_name else "全部任务"
+        peak = max([count for _, count in by_day.values()] + [1])
+        message = f"📈 {scope} 最近{days}天打卡趋势\n"
+        message += "===================\n"
+        for i in range(days):
+            day = (today - timedelta(days=days - 1 - i)).isoformat()
+            users, count = by_day.get(day, (0, 0))
+            bar = "█" * round(count * 10 / peak)
+            message += f"{day[5:]} {users:3d}人 {count:3d}次 +{points.get(day, 0)}分 {bar}\n"
+        message += "===================\n"
+        message += f"🔸 数据同步于 {synced_at}"
+        return message
+
+    def retention(self, group_id: str, task_name: str = None, weeks: int = RETENTION_WEEKS) -> str:
+        """按首次打卡所在的周分组, 统计每组用户在之后各周仍然打卡的比例"""
+        first_week = week_number(date.today()) - weeks + 1
+        task_filter = " AND t.task_name = ?" if task_name else ""
+        params = [group_id] + ([task_name] if task_name else []) + [first_week]
+        try:
+            rows, synced_at = self._query(f"""
+                WITH activity AS (
+                    SELECT DISTINCT c.user_id, c.week
+                    FROM mirror_checkin c JOIN mirror_task t ON t.task_id = c.task_id
+                    WHERE t.group_id = ? AND t.enable = 1{task_filter}
+                ),
+                cohort AS (
+                    SELECT user_id, MIN(week) AS first_week FROM activity GROUP BY user_id
+                )
+                SELECT co.first_week, a.week - co.first_week AS week_offset, COUNT(*)
+                FROM cohort co JOIN activity a ON a.user_id = co.user_id
+                WHERE co.first_week >= ?
+                GROUP BY co.first_week, a.week - co.first_week""", params)
+        except MirrorBusy:
+            return "⏳ 分析库正在同步,请稍后再试"
+        except Exception as e:
+            logger.exception(f"[PKTracker] 生成留存报告异常: {str(e)}")
+            return "❌ 统计报告生成失败,请稍后重试"
+        if synced_at is None:
+            return "⏳ 分析库尚未完成首次同步,请稍后再试"
+
+        cohorts = {}
+        for week, offset, users in rows:
+            cohorts.setdefault(week, {})[offset] = users
+        scope = f"[{task_name}]" if task_name else "全部任务"
+        message = f"📊 {scope} 最近{weeks}周新用户留存\n"
+        message += "===================\n"
+        if not cohorts:
+            message += "暂无新用户\n"
+        for week in sorted(cohorts):
+            counts = cohorts[week]
+            size = counts.get(0, 0)
+            rates = " ".join(f"{counts.get(offset, 0) * 100 // size:3d}%"
+                             for offset in range(1, week_number(date.today()) - week + 1))
+            message += f"{week_start(week).strftime('%m-%d')}周 {size:3d}人 {rates}\n"
+        message += "===================\n"
+        message += "🔸 每行依次为之后第1、2…周仍在打卡的比例\n"
+        message += f"🔸 数据同步于 {synced_at}"
+        return message
@@ -0,0 +1,189 @@
+import json
+import os
+import re
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+
+from common.log import logger
+from plugins.PKTracker.database import get_connection
+from plugins.PKTracker.shards import shards
+
+# 备份目录中快照子目录的名称, 按时间排序即按名称排序; 同一秒内的多次备份追加序号
+SNAPSHOT_NAME = re.compile(r"^\d{8}-\d{6}(-\d+)?$")
+PARTIAL_SUFFIX = ".partial"
+REPORT_FILE = "backup_report.json"
+
+
+class BackupRestarted(Exception):
+    """备份期间源库被其他连接修改的次数过多"""
+
+
+class BackupManager:
+    """使用 SQLite 在线备份接口为数据库做快照
+
+    每次只复制 step_pages 页, 两步之间休眠 pause 秒: 每一步只短暂持有源库的读锁, 打卡和定时任务的写入不会被长时间阻塞。
+    备份期间其他连接写入源库时 SQLite 会从头重新复制; 重新开始超过 max_restarts 次(打卡持续密集)时改为一步复制完,
+    WAL 模式下一步复制只占用一个读快照, 同样不阻塞写入。
+
+    每个快照是备份目录下以时间命名的子目录(包括主库和开启分库时的全部分库), 先写入临时目录,
+    逐个文件通过 PRAGMA quick_check 后才改为正式名称, 然后只保留最近 keep 个快照。
+    """
+
+    def __init__(self, db_path, directory, keep=7, step_pages=256, pause=0.02, max_restarts=20):
+        self.db_path = db_path
+        self.directory = directory
+        self.keep = keep
+        self.step_pages = step_pages
+        self.pause = pause
+        self.max_restarts = max_restarts
+
+    @property
+    def report_path(self):
+        return os.path.join(self.directory, REPORT_FILE)
+
+    def run(self):
+        """做一次快照, 返回报告并保存为最近一次备份报告"""
+        start = time.perf_counter()
+        now = datetime.now()
+        name = now.strftime('%Y%m%d-%H%M%S')
+        for seq in range(1, 100):
+            if not os.path.exists(os.path.join(self.directory, name)):
+                break
+            name = f"{now.strftime('%Y%m%d-%H%M%S')}-{seq}"
+        report = {
+            "time": now.strftime('%Y-%m-%d %H:%M:%S'),
+            "snapshot": name,
+            "ok": False,
+            "files": 0,
+            "size": 0,
+            "pages": 0,
+            "restarts": 0,
+            "duration_s": 0,
+            "error": None,
+            "removed": [],
+        }
+        partial = os.path.join(self.directory, name + PARTIAL_SUFFIX)
+        try:
+            self._remove_partials()
+            sources = [(self.db_path, os.path.basename(self.db_path))]
+            if shards.enabled:
+                sources += [(path, os.path.join("shards", os.path.basename(path)))
+                            for path in shards.paths(self.db_path)]
+            for source, relative in sources:
+                target = os.path.join(partial, relative)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                pages, restarts = self._backup_file(source, target)
+                self._verify(target)
+                report["files"] += 1
+                report["pages"] += pages
+                report["restarts"] += restarts
+                report["size"] += os.path.getsize(target)
+            os.rename(partial, os.path.join(self.directory, name))
+            report["ok"] = True
+            report["removed"] = self._rotate()
+        except Exception as e:
+            report["error"] = str(e)
+            shutil.rmtree(partial, ignore_errors=True)
+            logger.error(f"[PKTracker] 数据库备份失败: {str(e)}")
+        report["duration_s"] = round(time.perf_counter() - start, 3)
+        self._save_report(report)
+        return report
+
+    def _backup_file(self, source, target):
+        """把 source 复制到 target, 返回 (总页数, 重新开始的次数)"""
+        src = get_connection(source, readonly=True)
+        dst = sqlite3.connect(target)
+        state = {"remaining": None, "total": 0, "restarts": 0}
+
+        def progress(status, remaining, total):
+            # 剩余页数没有减少说明源库被修改后从头开始
+            if state["remaining"] is not None and remaining >= state["remaining"]:
+                state["restarts"] += 1
+                if state["restarts"] > self.max_restarts:
+                    raise BackupRestarted()
+            state["remaining"], state["total"] = remaining, total
+            if remaining:
+                time.sleep(self.pause)
+
+        try:
+            try:
+                src.backup(dst, pages=self.step_pages, progress=progress)
+            except BackupRestarted:
+                logger.info(f"[PKTracker] 备份 {source} 时源库持续被修改, 改为一步复制")
+                src.backup(dst)
+            # 快照使用回滚日志模式, 单个文件即可完整恢复
+            dst.execute("PRAGMA journal_mode=DELETE")
+            return state["total"], state["restarts"]
+        finally:
+            dst.close()
+            src.close()
+
+    @staticmethod
+    def _verify(path):
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            result = [row[0] for row in conn.execute("PRAGMA quick_check")]
+        finally:
+            conn.close()
+        if result != ["ok"]:
+            raise ValueError(f"快照 {path} 校验失败: {'; '.join(result[:5])}")
+
+    def _snapshots(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory)
+                      if SNAPSHOT_NAME.match(name) and os.path.isdir(os.path.join(self.directory, name)))
+
+    def _rotate(self):
+        """只保留最近 keep 个快照, 返回删除的快照名称"""
+        snapshots = self._snapshots()
+        removed = snapshots[:-self.keep] if self.keep > 0 else []
+        for name in removed:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        return removed
+
+    def _remove_partials(self):
+        """删除上次中断留下的临时目录"""
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(PARTIAL_SUFFIX):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def _save_report(self, report):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.report_path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            logger.warning(f"[PKTracker] 保存备份报告失败: {str(e)}")
+
+    def load_report(self):
+        """读取最近一次备份报告, 不存在时返回 None"""
+        try:
+            with open(self.report_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"[PKTracker] 读取备份报告失败: {str(e)}")
+            return None
+
+    def format_report(self, report):
+        if report is None:
+            return "暂无备份记录, 可以使用 PKTracker 备份 执行 立即备份"
+        status = "✅ 成功" if report["ok"] else f"❌ 失败: {report['error']}"
+        message = f"💾 数据库备份 ({report['time']})\n"
+        message += "===================\n"
+        message += f"🔸 结果: {status}\n"
+        message += f"🔸 耗时: {report['duration_s']}s\n"
+        message += f"🔸 大小: {report['size'] / 1024 / 1024:.2f} MB ({report['files']}个文件, {report['pages']}页)\n"
+        if report["restarts"]:
+            message += f"🔸 源库修改后重新开始: {report['restarts']}次\n"
+        message += f"🔸 快照: {os.path.join(self.directory, report['snapshot'])}\n"
+        message += f"🔸 保留: 最近{len(self._snapshots())}个快照"
+        if report["removed"]:
+            message += f", 本次删除 {len(report['removed'])}个旧快照"
+        return message
@@ -0,0 +1,7 @@
+"""PKTracker 性能基准测试工具
+
+- stubs: dify-on-wechat 运行环境(lib.gewechat / channel_factory / common.log 等)的进程内替身
+- datagen: 按 pkTracker.db 结构生成确定性的合成数据
+- micro: 各管理器核心方法的微基准测试, 结果输出为 JSON
+- compare: 对比两次基准测试的 JSON 结果
+"""
@@ -0,0 +1,53 @@
+"""对比两次基准测试结果
+
+用法:
+    python -m benchmark.compare before.json after.json [--metric median_ms]
+
+按 (数据规模, 基准项) 输出两次结果和比值, 比值 < 1 表示变快。
+"""
+import argparse
+import json
+
+
+def load(path):
+    with open(path, encoding="utf-8") as f:
+        report = json.load(f)
+    rows = {}
+    for result in report["results"]:
+        for name, stats in result["benchmarks"].items():
+            rows[(result["size"], name)] = stats
+    return report.get("meta", {}), rows
+
+
+def compare(before, after, metric="median_ms"):
+    """返回 [(size, name, before, after, ratio)], 只包含两边都有的项"""
+    rows = []
+    for key in before:
+        if key not in after:
+            continue
+        old, new = before[key].get(metric), after[key].get(metric)
+        if old is None or new is None:
+            continue
+        ratio = new / old if old else float("inf")
+        rows.append((key[0], key[1], old, new, ratio))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="对比两次 PKTracker 基准测试结果")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--metric", default="median_ms")
+    args = parser.parse_args(argv)
+
+    before_meta, before = load(args.before)
+    after_meta, after = load(args.after)
+    print(f"before: {before_meta.get('git_revision')} {before_meta.get('timestamp')}")
+    print(f"after:  {after_meta.get('git_revision')} {after_meta.get('timestamp')}")
+    print(f"{'size':<8} {'benchmark':<26} {'before':>12} {'after':>12} {'ratio':>8}")
+    for size, name, old, new, ratio in compare(before, after, args.metric):
+        print(f"{size:<8} {name:<26} {old:>12.3f} {new:>12.3f} {ratio:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""读写争用基准测试
+
+多个线程持续打卡的同时, 另一组线程不停地查询积分榜、任务详情并生成每日排行榜,
+统计打卡的 p50/p95/p99 延迟和失败次数, 以及读线程的吞吐量。
+
+默认分别在 DELETE(回滚日志)和 WAL 两种日志模式下各跑一次: DELETE 模式下读操作持有的共享锁
+会推迟打卡的提交, WAL 模式配合只读连接后读写互不阻塞。
+
+用法:
+    python -m benchmark.contention --size small --writers 4 --readers 8 --duration 10
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from benchmark import datagen, stubs
+from benchmark.micro import Fixture, summarize
+
+from plugins.PKTracker.database import DatabaseManager  # noqa: E402
+
+READS = {
+    "get_ranking": lambda f, g, t, task_id: f.ranking_manager.get_ranking(g),
+    "get_ranking_task": lambda f, g, t, task_id: f.ranking_manager.get_ranking(g, t),
+    "get_task_detail": lambda f, g, t, task_id: f.task_manager.get_task_detail(g, t),
+    "send_ranking_list": lambda f, g, t, task_id: f.scheduler.send_ranking_list(task_id),
+}
+
+
+def run_mode(db_path, journal, writers, readers, duration, seed):
+    DatabaseManager(db_path, wal=journal == "wal")
+    fixture = Fixture(db_path)
+    conn = sqlite3.connect(db_path)
+    tasks = conn.execute("SELECT task_id, group_id, task_name FROM t_task").fetchall()
+    conn.close()
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    checkin_ms = []
+    failures = [0]
+    read_ms = {name: [] for name in READS}
+
+    def writer(idx):
+        rng = random.Random(seed + idx)
+        seq = 0
+        while not stop.is_set():
+            seq += 1
+            _, group_id, task_name = rng.choice(tasks)
+            user_id = f"wxid_contention_{journal}_{idx}_{seq}"
+            start = time.perf_counter()
+            reply = fixture.checkin_manager.handle_checkin(user_id, group_id, task_name, "争用测试")
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                checkin_ms.append(elapsed)
+                if not reply.startswith("✅"):
+                    failures[0] += 1
+
+    def reader(idx):
+        rng = random.Random(seed + 1000 + idx)
+        names = list(READS)
+        while not stop.is_set():
+            task_id, group_id, task_name = rng.choice(tasks)
+            name = rng.choice(names)
+            start = time.perf_counter()
+            READS[name](fixture, group_id, task_name, task_id)
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                read_ms[name].append(elapsed)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    threads += [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    stubs.channel().reset()
+
+    return {
+        "journal": journal,
+        "checkin": dict(summarize(checkin_ms), failures=failures[0],
+                        per_second=round(len(checkin_ms) / duration, 1)) if checkin_ms else None,
+        "reads": {name: dict(summarize(values), per_second=round(len(values) / duration, 1))
+                  for name, values in read_ms.items() if values},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PKTracker 读写争用基准测试")
+    parser.add_argument("--size", choices=sorted(datagen.SIZES), default="small")
+    parser.add_argument("--journal", choices=["delete", "wal", "both"], default="both")
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0, help="每种模式的持续时间(秒)")
+    parser.add_argument("--seed", type=int, default=20240101)
+    parser.add_argument("--output", help="JSON 结果文件")
+    args = parser.parse_args(argv)
+
+    modes = ["delete", "wal"] if args.journal == "both" else [args.journal]
+    results = []
+    with tempfile.TemporaryDirectory(prefix="pktracker_contention_") as tmp:
+        for journal in modes:
+            db_path = os.path.join(tmp, f"contention_{journal}.db")
+            datagen.generate(db_path, seed=args.seed, **datagen.SIZES[args.size])
+            result = run_mode(db_path, journal, args.writers, args.readers, args.duration, args.seed)
+            results.append(result)
+
+            checkin = result["checkin"] or {}
+            print(f"[{journal}] 打卡 {checkin.get('per_second', 0)}/s  p50 {checkin.get('median_ms', 0):.2f}ms"
+                  f"  p95 {checkin.get('p95_ms', 0):.2f}ms  p99 {checkin.get('p99_ms', 0):.2f}ms"
+                  f"  max {checkin.get('max_ms', 0):.2f}ms  失败 {checkin.get('failures', 0)}", file=sys.stderr)
+            for name, stats in result["reads"].items():
+                print(f"[{journal}]   {name:<18} {stats['per_second']}/s  p95 {stats['p95_ms']:.2f}ms",
+                      file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"size": args.size, "writers": args.writers, "readers": args.readers,
+                       "duration": args.duration, "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
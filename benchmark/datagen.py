@@ -0,0 +1,208 @@
+"""合成数据生成器
+
+按 pkTracker.db 的表结构生成 N 个群、每群 M 个任务、每群 K 个用户、若干天的打卡记录和积分明细。
+相同的参数(含 seed 和 end_date)总是生成完全相同的数据库。
+
+奖励规则与插件一致:
+- base: 每次打卡获得任务的基础分
+- first: 当日该任务的第一条打卡
+- consecutive: 用户连续三天打卡
+- week / month: 每个完整自然周/月打卡次数最多的用户, 挂在该用户当期的一条打卡上
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+from datetime import date, datetime, timedelta
+
+from benchmark import stubs
+
+stubs.install()
+
+from plugins.PKTracker.checkin_calendar import CheckinCalendar  # noqa: E402
+from plugins.PKTracker.checkin_search import CheckinSearch  # noqa: E402
+from plugins.PKTracker.content_store import checkin_content  # noqa: E402
+from plugins.PKTracker.daily_stats import DailyStats  # noqa: E402
+from plugins.PKTracker.database import DatabaseManager  # noqa: E402
+from plugins.PKTracker.rank_index import UserTotals  # noqa: E402
+from plugins.PKTracker.task_stats import TaskStats  # noqa: E402
+
+# 预置的数据规模
+SIZES = {
+    "tiny": {"groups": 2, "tasks": 2, "users": 10, "days": 30},
+    "small": {"groups": 5, "tasks": 2, "users": 20, "days": 120},
+    "medium": {"groups": 20, "tasks": 3, "users": 40, "days": 365},
+    "large": {"groups": 40, "tasks": 3, "users": 60, "days": 730},
+    # 群多而每个群数据少, 用于衡量定时任务按群组分发的效果
+    "wide": {"groups": 1000, "tasks": 1, "users": 5, "days": 14},
+}
+
+FIRST_REWARD = 3
+CONSECUTIVE_REWARD = 3
+WEEK_REWARD = 3
+MONTH_REWARD = 5
+
+_WORDS = ["跑步", "早起", "读书", "背单词", "健身", "冥想", "练字", "喝水", "10km", "5km",
+          "30分钟", "一小时", "第一章", "坚持", "打卡", "今天", "完成", "状态不错", "有点累", "继续加油"]
+
+
+def group_id(g):
+    return f"bench_group_{g:04d}@chatroom"
+
+
+def user_id(g, u):
+    return f"wxid_g{g:04d}_u{u:04d}"
+
+
+def task_name(t):
+    return f"任务{t}"
+
+
+def _content(rng, max_words=12):
+    return " ".join(rng.choice(_WORDS) for _ in range(rng.randint(1, max_words)))
+
+
+def _week_key(d):
+    return d.isocalendar()[:2]
+
+
+def _month_key(d):
+    return d.year, d.month
+
+
+def generate(db_path, groups, tasks, users, days, seed=20240101, end_date=None, checkin_rate=(0.2, 0.95),
+             content_words=12):
+    """生成合成数据库
+
+    Args:
+        db_path: 数据库文件路径, 已存在则覆盖
+        groups: 群数量
+        tasks: 每个群的任务数量
+        users: 每个群的用户数量
+        days: 打卡记录覆盖的天数, 截止到 end_date (含)
+        seed: 随机种子
+        end_date: 最后一天, 默认为今天; 周/月奖励只结算 end_date 之前已结束的周期
+        checkin_rate: 每个用户每日打卡概率的取值范围
+        content_words: 每条打卡内容最多的词数
+
+    Returns:
+        dict: 生成参数和各表行数
+    """
+    rng = random.Random(seed)
+    end_date = end_date or date.today()
+    start_date = end_date - timedelta(days=days - 1)
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    DatabaseManager(db_path)
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA synchronous=OFF")
+    c = conn.cursor()
+
+    checkin_id = 0
+    counts = {"tasks": 0, "checkins": 0, "bonuses": 0}
+    for g in range(groups):
+        gid = group_id(g)
+        rates = [rng.uniform(*checkin_rate) for _ in range(users)]
+        for t in range(tasks):
+            reminder = f"{rng.randint(6, 22):02d}:{rng.randint(0, 59):02d}"
+            c.execute("""INSERT INTO t_task (group_id, task_name, frequency, max_checkins, base_score,
+                                             reminder_time, remind_text, enable, create_time)
+                         VALUES (?, ?, 'day', 1, 1, ?, ?, 1, ?)""",
+                      (gid, task_name(t), reminder, "该打卡啦", f"{start_date} 00:00:00"))
+            tid = c.lastrowid
+            counts["tasks"] += 1
+
+            checkin_rows = []
+            content_rows = []
+            bonus_rows = []
+            streak = [0] * users
+            week_counts = {}
+            month_counts = {}
+            for d in range(days):
+                day = start_date + timedelta(days=d)
+                todays = []
+                for u in range(users):
+                    if rng.random() < rates[u]:
+                        todays.append((rng.randint(6 * 3600, 23 * 3600), u))
+                        streak[u] += 1
+                    else:
+                        streak[u] = 0
+                todays.sort()
+                for idx, (seconds, u) in enumerate(todays):
+                    checkin_id += 1
+                    ts = (datetime.combine(day, datetime.min.time()) + timedelta(seconds=seconds)
+                          ).strftime('%Y-%m-%d %H:%M:%S')
+                    uid = user_id(g, u)
+                    checkin_rows.append((checkin_id, tid, uid, ts, ts, ts))
+                    content_rows.append((checkin_id,) + checkin_content.encode(_content(rng, content_words)))
+                    bonus_rows.append((tid, uid, checkin_id, "base", 1, ts))
+                    if idx == 0:
+                        bonus_rows.append((tid, uid, checkin_id, "first", FIRST_REWARD, ts))
+                    if streak[u] >= 3:
+                        bonus_rows.append((tid, uid, checkin_id, "consecutive", CONSECUTIVE_REWARD, ts))
+                    for key, bucket in ((_week_key(day), week_counts), (_month_key(day), month_counts)):
+                        per_user = bucket.setdefault(key, {})
+                        cnt = per_user.get(uid, (0,))[0]
+                        per_user[uid] = (cnt + 1, checkin_id, ts)
+
+            # 周/月冠军: 只结算在 end_date 之前完整结束的周期
+            current_week = _week_key(end_date)
+            current_month = _month_key(end_date)
+            for kind, bucket, current, value in (("week", week_counts, current_week, WEEK_REWARD),
+                                                 ("month", month_counts, current_month, MONTH_REWARD)):
+                for key in sorted(bucket):
+                    if key >= current:
+                        continue
+                    winner, (_, last_id, ts) = max(sorted(bucket[key].items()), key=lambda kv: kv[1][0])
+                    bonus_rows.append((tid, winner, last_id, kind, value, ts))
+
+            c.executemany("""INSERT INTO t_checkin_log
+                             (checkin_id, task_id, user_id, checkin_time, create_time, update_time)
+                             VALUES (?, ?, ?, ?, ?, ?)""", checkin_rows)
+            c.executemany("INSERT INTO t_checkin_content (checkin_id, body, compressed) VALUES (?, ?, ?)",
+                          content_rows)
+            c.executemany("""INSERT INTO t_bonus
+                             (task_id, user_id, checkin_id, bonus_type, bonus_value, create_time)
+                             VALUES (?, ?, ?, ?, ?, ?)""", bonus_rows)
+            counts["checkins"] += len(checkin_rows)
+            counts["bonuses"] += len(bonus_rows)
+
+    conn.commit()
+    conn.close()
+    counts["daily_stats"] = DailyStats(db_path).backfill(pause=0)
+    counts["checkin_calendar"] = CheckinCalendar(db_path, None).backfill(pause=0)
+    counts["user_totals"] = UserTotals(db_path).backfill(pause=0)
+    counts["task_stats"] = TaskStats(db_path).backfill(pause=0)
+    counts["checkin_fts"] = CheckinSearch(db_path, None).backfill(pause=0)
+
+    return {
+        "params": {"groups": groups, "tasks": tasks, "users": users, "days": days, "seed": seed,
+                   "end_date": end_date.isoformat()},
+        "rows": counts,
+        "file_bytes": os.path.getsize(db_path),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成 PKTracker 合成数据库")
+    parser.add_argument("db_path", help="输出的数据库文件")
+    parser.add_argument("--size", choices=sorted(SIZES), default="small", help="预置规模")
+    parser.add_argument("--groups", type=int)
+    parser.add_argument("--tasks", type=int)
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--days", type=int)
+    parser.add_argument("--seed", type=int, default=20240101)
+    args = parser.parse_args()
+
+    params = dict(SIZES[args.size])
+    for key in ("groups", "tasks", "users", "days"):
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    print(json.dumps(generate(args.db_path, seed=args.seed, **params), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""打卡记录表存储布局对比
+
+用同一份合成数据分别构建两个数据库:
+- inline: 旧布局, 打卡内容存放在 t_checkin_log.content 中
+- split: 新布局, 打卡内容存放在 t_checkin_content 中, 超过阈值的内容压缩存储
+
+两个数据库都执行 VACUUM 后, 通过 dbstat 统计各表的页数, 并对比扫描打卡记录表和查询积分详情一页的耗时。
+
+用法:
+    python -m benchmark.layout --size small --content-words 60 --output layout.json
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmark import datagen
+
+from plugins.PKTracker.content_store import checkin_content  # noqa: E402
+
+TABLES = ["t_checkin_log", "t_checkin_content", "idx_checkin_task_user_time", "idx_checkin_task_time"]
+
+# 只读取打卡记录表的定长字段, 两种布局使用同一条语句
+SCANS = {
+    "scan_count": "SELECT task_id, COUNT(*) FROM t_checkin_log NOT INDEXED GROUP BY task_id",
+    "scan_create_time": "SELECT MAX(create_time) FROM t_checkin_log NOT INDEXED",
+}
+
+DETAIL_PAGE = {
+    "inline": """
+        SELECT t.task_name, cl.checkin_time, cl.content, SUM(b.bonus_value)
+        FROM t_checkin_log cl
+        JOIN t_task t ON cl.task_id = t.task_id
+        LEFT JOIN t_bonus b ON cl.checkin_id = b.checkin_id
+        WHERE t.group_id = ? AND cl.user_id = ? AND t.enable = 1
+        GROUP BY cl.checkin_id
+        ORDER BY cl.checkin_time DESC
+        LIMIT 5 OFFSET ?
+    """,
+    "split": """
+        SELECT cl.checkin_id, t.task_name, cl.checkin_time, SUM(b.bonus_value)
+        FROM t_checkin_log cl
+        JOIN t_task t ON cl.task_id = t.task_id
+        LEFT JOIN t_bonus b ON cl.checkin_id = b.checkin_id
+        WHERE t.group_id = ? AND cl.user_id = ? AND t.enable = 1
+        GROUP BY cl.checkin_id
+        ORDER BY cl.checkin_time DESC
+        LIMIT 5 OFFSET ?
+    """,
+}
+
+
+def build_inline(split_path, inline_path):
+    """由新布局的数据库复制出旧布局: 内容解压后写回 t_checkin_log.content"""
+    shutil.copyfile(split_path, inline_path)
+    conn = sqlite3.connect(inline_path)
+    conn.execute("ALTER TABLE t_checkin_log ADD COLUMN content TEXT")
+    rows = conn.execute("SELECT checkin_id, compressed, body FROM t_checkin_content").fetchall()
+    conn.executemany("UPDATE t_checkin_log SET content = ? WHERE checkin_id = ?",
+                     [(checkin_content.decode(body, compressed), checkin_id) for checkin_id, compressed, body in rows])
+    conn.execute("DROP TABLE t_checkin_content")
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+
+
+def page_stats(db_path):
+    conn = sqlite3.connect(db_path)
+    placeholders = ",".join("?" * len(TABLES))
+    rows = conn.execute(f"""SELECT name, COUNT(*), SUM(pgsize) FROM dbstat
+                            WHERE name IN ({placeholders}) GROUP BY name""", TABLES).fetchall()
+    conn.close()
+    stats = {name: {"pages": pages, "bytes": size} for name, pages, size in rows}
+    stats["file_bytes"] = os.path.getsize(db_path)
+    return stats
+
+
+def time_query(db_path, sql, params, repeat):
+    """每次使用新连接执行, 返回耗时中位数(毫秒)"""
+    durations = []
+    for _ in range(repeat):
+        conn = sqlite3.connect(db_path)
+        start = time.perf_counter()
+        rows = conn.execute(sql, params).fetchall()
+        if "content" not in sql and "checkin_id" in sql.split("FROM")[0]:
+            checkin_content.load(conn.cursor(), [row[0] for row in rows])
+        durations.append((time.perf_counter() - start) * 1000)
+        conn.close()
+    return round(statistics.median(durations), 3)
+
+
+def run(db_dir, size, content_words, repeat):
+    split_path = os.path.join(db_dir, "split.db")
+    inline_path = os.path.join(db_dir, "inline.db")
+    params = datagen.SIZES[size]
+    datagen.generate(split_path, content_words=content_words, **params)
+    conn = sqlite3.connect(split_path)
+    conn.execute("VACUUM")
+    compressed, total = conn.execute("SELECT SUM(compressed), COUNT(*) FROM t_checkin_content").fetchone()
+    conn.close()
+    build_inline(split_path, inline_path)
+
+    group, user = datagen.group_id(0), datagen.user_id(0, 0)
+    result = {"params": dict(params, content_words=content_words, threshold=checkin_content.threshold),
+              "compressed_rows": f"{compressed}/{total}"}
+    for layout, path in (("inline", inline_path), ("split", split_path)):
+        timings = {name: time_query(path, sql, (), repeat) for name, sql in SCANS.items()}
+        timings["detail_page_1"] = time_query(path, DETAIL_PAGE[layout], (group, user, 0), repeat)
+        timings["detail_page_20"] = time_query(path, DETAIL_PAGE[layout], (group, user, 95), repeat)
+        result[layout] = {"pages": page_stats(path), "median_ms": timings}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对比打卡内容内联存储与单独存储的页数和扫描耗时")
+    parser.add_argument("--size", choices=sorted(datagen.SIZES), default="small")
+    parser.add_argument("--content-words", type=int, default=60, help="每条打卡内容最多的词数")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--output", help="结果 JSON 文件")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="pktracker_layout_") as tmp:
+        result = run(tmp, args.size, args.content_words, args.repeat)
+
+    for layout in ("inline", "split"):
+        pages = result[layout]["pages"]
+        print(f"{layout:7s} t_checkin_log {pages['t_checkin_log']['pages']:6d}页"
+              f"  t_checkin_content {pages.get('t_checkin_content', {}).get('pages', 0):6d}页"
+              f"  文件 {pages['file_bytes'] / 1024 / 1024:.1f}MB")
+        for name, value in result[layout]["median_ms"].items():
+            print(f"        {name:18s} {value:9.3f} ms")
+    print(f"压缩的内容: {result['compressed_rows']}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
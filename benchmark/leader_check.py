@@ -0,0 +1,157 @@
+"""调度器选主的多进程检查
+
+启动多个本地进程共用同一个数据库, 每个进程运行一个 SchedulerLease, 并按固定间隔执行一个"模拟任务"
+(与 TaskScheduler._leader_only 相同: 执行前先续约, 不是主节点则跳过)。主进程依次:
+
+1. 等待选出主节点, 统计稳定期内执行模拟任务的进程数(应当只有 1 个)
+2. 用 SIGKILL 杀掉主节点(不释放租约), 测量其他进程接管所需的时间(应当不超过 ttl + 心跳间隔)
+3. 让新的主节点正常退出(主动释放租约), 测量接管时间(应当约为一个心跳间隔)
+
+同时检查所有执行记录按时间排序后 term 单调不减, 即不存在两个进程交替执行任务的情况。
+
+用法:
+    python -m benchmark.leader_check --processes 4 --ttl 2 --heartbeat 0.5
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import time
+
+from benchmark import stubs
+
+stubs.install()
+
+from plugins.PKTracker.database import DatabaseManager  # noqa: E402
+from plugins.PKTracker.leader import SchedulerLease  # noqa: E402
+
+# 模拟任务的执行间隔(秒)
+TICK_INTERVAL = 0.1
+
+
+def _worker(db_path, ttl, heartbeat, events, stop):
+    """子进程: 运行租约心跳, 作为主节点时上报每次任务执行"""
+    stubs.install()
+    # SIGTERM 时走正常退出流程, 释放租约
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    lease = SchedulerLease(db_path, ttl=ttl, heartbeat_interval=heartbeat)
+    lease.start()
+    try:
+        while not stop.is_set():
+            if lease.try_acquire():
+                events.put((time.time(), os.getpid(), lease.term))
+            time.sleep(TICK_INTERVAL)
+    finally:
+        lease.stop()
+
+
+def _drain(events, timeout=0.0):
+    items = []
+    deadline = time.time() + timeout
+    while True:
+        try:
+            items.append(events.get(timeout=max(0.0, deadline - time.time())))
+        except Exception:
+            return items
+
+
+def _wait_for_new_leader(events, old_pid, since, timeout):
+    """等待 old_pid 以外的进程上报任务执行, 返回 (接管耗时, 新主节点 pid, 期间的记录)"""
+    seen = []
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        for item in _drain(events, 0.1):
+            seen.append(item)
+            if item[1] != old_pid:
+                return item[0] - since, item[1], seen
+    return None, None, seen
+
+
+def run_check(processes=4, ttl=2.0, heartbeat=0.5, settle=None):
+    settle = settle or ttl * 2
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(prefix="pktracker_leader_") as tmp:
+        db_path = os.path.join(tmp, "leader.db")
+        DatabaseManager(db_path)
+
+        events = ctx.Queue()
+        stop = ctx.Event()
+        workers = {}
+        for _ in range(processes):
+            p = ctx.Process(target=_worker, args=(db_path, ttl, heartbeat, events, stop), daemon=True)
+            p.start()
+            workers[p.pid] = p
+
+        timeline = []
+        result = {"processes": processes, "ttl": ttl, "heartbeat": heartbeat}
+        try:
+            # 1. 稳定期: 只有一个进程执行任务
+            first = _drain(events, settle + ttl)
+            timeline.extend(first)
+            stable = [item for item in first if item[0] >= first[0][0] + ttl] if first else []
+            leaders = sorted({pid for _, pid, _ in stable})
+            result["stable_leaders"] = len(leaders)
+            leader = first[-1][1] if first else None
+
+            # 2. 杀掉主节点, 租约只能等待过期
+            killed_at = time.time()
+            os.kill(leader, signal.SIGKILL)
+            workers.pop(leader).join()
+            failover, new_leader, seen = _wait_for_new_leader(events, leader, killed_at, ttl * 3)
+            timeline.extend(seen)
+            result["failover_after_kill"] = failover
+
+            # 3. 新主节点正常退出, 主动释放租约
+            if new_leader:
+                timeline.extend(_drain(events, heartbeat))
+                released_at = time.time()
+                os.kill(new_leader, signal.SIGTERM)
+                workers.pop(new_leader).join()
+                failover, _, seen = _wait_for_new_leader(events, new_leader, released_at, ttl * 3)
+                timeline.extend(seen)
+                result["failover_after_release"] = failover
+        finally:
+            stop.set()
+            for p in workers.values():
+                p.join(timeout=ttl)
+                if p.is_alive():
+                    p.kill()
+            timeline.extend(_drain(events, 0.2))
+
+    timeline.sort()
+    terms = [term for _, _, term in timeline]
+    result["executions"] = len(timeline)
+    result["terms"] = sorted(set(terms))
+    result["terms_monotonic"] = all(a <= b for a, b in zip(terms, terms[1:]))
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PKTracker 调度器选主多进程检查")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--ttl", type=float, default=2.0, help="租约有效期(秒)")
+    parser.add_argument("--heartbeat", type=float, default=0.5, help="心跳间隔(秒)")
+    args = parser.parse_args(argv)
+
+    result = run_check(args.processes, args.ttl, args.heartbeat)
+    limit = args.ttl + args.heartbeat + TICK_INTERVAL * 2
+    checks = [
+        ("稳定期只有一个进程执行任务", result["stable_leaders"] == 1),
+        (f"主节点被杀后 {limit:g}s 内接管", result.get("failover_after_kill") is not None
+         and result["failover_after_kill"] <= limit),
+        (f"主节点释放租约后 {args.heartbeat + TICK_INTERVAL * 2:g}s 内接管",
+         result.get("failover_after_release") is not None
+         and result["failover_after_release"] <= args.heartbeat + TICK_INTERVAL * 2),
+        ("任务执行记录的 term 单调不减", result["terms_monotonic"]),
+    ]
+    for name, ok in checks:
+        print(f"{'✅' if ok else '❌'} {name}")
+    print(f"被杀后接管: {result.get('failover_after_kill')}, 释放后接管: {result.get('failover_after_release')}, "
+          f"执行次数: {result['executions']}, term: {result['terms']}", file=sys.stderr)
+    return 0 if all(ok for _, ok in checks) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
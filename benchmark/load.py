@@ -0,0 +1,288 @@
+"""端到端压测: 多线程驱动 PKTracker.on_handle_context
+
+微基准测试看不到消息处理线程和 BackgroundScheduler 线程之间的锁竞争。这里在替身环境中
+构造完整的 PKTracker 插件, 由多个线程并发发送打卡、排行榜、管理命令等混合消息, 同时由一个
+独立线程按顺序反复执行调度任务(与调度器 max_workers=1 的线程池一致), 最后统计:
+
+- 吞吐量(每秒处理的消息数)
+- 各类消息和调度任务的 p50/p95/p99 延迟
+- 日志中出现的 `database is locked` 次数, 以及返回失败提示的消息数
+
+用法:
+    python -m benchmark.load --size small --threads 16 --duration 30 --output load_results.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from benchmark import datagen, stubs
+from benchmark.micro import summarize, _git_revision
+
+from bridge.context import Context, ContextType  # noqa: E402
+from channel.chat_message import ChatMessage  # noqa: E402
+from plugins import Event, EventContext  # noqa: E402
+from plugins.PKTracker.PKTracker import PKTracker  # noqa: E402
+from plugins.PKTracker.scheduler import TaskScheduler  # noqa: E402
+
+SUPER_ADMIN = "wxid_load_super"
+
+# (消息类型, 权重)
+DEFAULT_MIX = {
+    "checkin": 60,
+    "ranking": 10,
+    "ranking_task": 5,
+    "bonus_detail": 10,
+    "task_detail": 5,
+    "task_list": 5,
+    "admin": 5,
+}
+
+SCHEDULER_JOBS = ("check_reminders", "send_daily_ranking", "process_weekly_rewards")
+
+
+class LockCounter(logging.Handler):
+    """统计插件日志中的 database is locked 错误"""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self._lock_ = threading.Lock()
+        self.locked = 0
+        self.errors = 0
+
+    def emit(self, record):
+        text = record.getMessage()
+        if record.exc_info and record.exc_info[1] is not None:
+            text += str(record.exc_info[1])
+        with self._lock_:
+            self.errors += 1
+            if "database is locked" in text:
+                self.locked += 1
+
+
+class Workload:
+    """按权重随机生成消息内容"""
+
+    def __init__(self, params, mix, seed):
+        self.params = params
+        self.kinds = list(mix)
+        self.weights = [mix[k] for k in self.kinds]
+        self.seed = seed
+
+    def rng(self, worker):
+        return random.Random(self.seed * 1000 + worker)
+
+    def next(self, rng):
+        kind = rng.choices(self.kinds, self.weights)[0]
+        g = rng.randrange(self.params["groups"])
+        task = datagen.task_name(rng.randrange(self.params["tasks"]))
+        user = datagen.user_id(g, rng.randrange(self.params["users"]))
+        if kind == "checkin":
+            content = f"PKTracker [{task}] 压测打卡 {rng.randint(1, 42)}km"
+        elif kind == "ranking":
+            content = "PKTracker 积分榜"
+        elif kind == "ranking_task":
+            content = f"PKTracker 积分榜 {task}"
+        elif kind == "bonus_detail":
+            content = f"PKTracker 积分详情 p[{rng.randint(1, 3)}]"
+        elif kind == "task_detail":
+            content = f"PKTracker 任务详情 [{task}]"
+        elif kind == "task_list":
+            content = "PKTracker 任务列表"
+        else:
+            user = SUPER_ADMIN
+            content = rng.choice([
+                f"PKTracker 设置提醒时间 [{task}] time[{rng.randint(6, 22):02d}:{rng.randint(0, 59):02d}] t[压测提醒]",
+                f"PKTracker 设置次数 [{task}] [{rng.randint(100, 1000)}]",
+                "PKTracker 查看管理员",
+            ])
+        return kind, datagen.group_id(g), user, content
+
+
+def build_plugin(db_path, throttle=False):
+    """在替身环境中构造 PKTracker 插件(含已启动的调度器)
+
+    压测中少量用户反复打卡, 默认关闭打卡限流以测量真实的写库路径
+    """
+    config = {"db_path": db_path, "super_admins": [SUPER_ADMIN], "daily_ranking_time": "09:10"}
+    if not throttle:
+        config["checkin_throttle"] = {"user_per_minute": 0, "group_per_minute": 0}
+    stubs.install(plugin_config=config)
+    PKTracker._load_root_config = lambda self: stubs.root_config()
+    PKTracker._instance = None
+    TaskScheduler._instance = None
+    return PKTracker()
+
+
+def make_event(group_id, user_id, content, msg_id=None):
+    msg = ChatMessage(None)
+    msg.msg_id = msg_id
+    context = Context(ContextType.TEXT, content,
+                      kwargs={"receiver": group_id, "session_id": f"{user_id}@@{group_id}", "isgroup": True,
+                              "msg": msg})
+    return EventContext(Event.ON_HANDLE_CONTEXT, {"context": context})
+
+
+def arm_reminders(db_path):
+    """让所有任务的提醒时间都落在当前分钟, 保证提醒任务真正执行; 库被锁住时跳过本轮"""
+    conn = sqlite3.connect(db_path, timeout=1)
+    try:
+        conn.execute("UPDATE t_task SET reminder_time=?", (datetime.now().strftime('%H:%M'),))
+        conn.commit()
+    except sqlite3.OperationalError:
+        pass
+    finally:
+        conn.close()
+
+
+def run_load(plugin, workload, threads, duration, scheduler_interval):
+    latencies = defaultdict(list)
+    failures = defaultdict(int)
+    job_latencies = defaultdict(list)
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def worker(idx):
+        rng = workload.rng(idx)
+        local = defaultdict(list)
+        local_failures = defaultdict(int)
+        seq = 0
+        while not stop.is_set():
+            seq += 1
+            kind, group_id, user_id, content = workload.next(rng)
+            event = make_event(group_id, user_id, content, f"load_{idx}_{seq}")
+            start = time.perf_counter()
+            plugin.on_handle_context(event)
+            local[kind].append((time.perf_counter() - start) * 1000)
+            reply = event.econtext.get("reply")
+            text = reply.content if reply else ""
+            if not reply or "失败" in text or "出错" in text:
+                local_failures[kind] += 1
+        with lock:
+            for kind, values in local.items():
+                latencies[kind].extend(values)
+            for kind, count in local_failures.items():
+                failures[kind] += count
+
+    def scheduler_worker():
+        scheduler = plugin.scheduler
+        while not stop.is_set():
+            for job in SCHEDULER_JOBS:
+                if job == "check_reminders":
+                    arm_reminders(plugin.db_path)
+                start = time.perf_counter()
+                getattr(scheduler, job)()
+                job_latencies[job].append((time.perf_counter() - start) * 1000)
+                if stop.wait(scheduler_interval):
+                    return
+
+    pool = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(threads)]
+    if scheduler_interval is not None:
+        pool.append(threading.Thread(target=scheduler_worker, daemon=True))
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    stop.wait(duration)
+    stop.set()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return latencies, failures, job_latencies, elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PKTracker 端到端压测")
+    parser.add_argument("--size", choices=sorted(datagen.SIZES), default="tiny")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20.0, help="压测时长(秒)")
+    parser.add_argument("--scheduler-interval", type=float, default=0.5,
+                        help="两次调度任务之间的间隔(秒), 负数表示不运行调度任务")
+    parser.add_argument("--max-checkins", type=int, default=1000,
+                        help="压测前把所有任务的最大打卡次数设为该值, 让大部分打卡真正写库")
+    parser.add_argument("--mix", help="消息权重, 例如 checkin=60,ranking=20,admin=5")
+    parser.add_argument("--seed", type=int, default=20240101)
+    parser.add_argument("--throttle", action="store_true", help="使用默认的打卡限流参数")
+    parser.add_argument("--data-dir", help="合成数据库存放目录, 默认使用临时目录")
+    parser.add_argument("--output", default="load_results.json")
+    args = parser.parse_args(argv)
+
+    mix = dict(DEFAULT_MIX)
+    if args.mix:
+        mix = {k: int(v) for k, v in (item.split("=") for item in args.mix.split(","))}
+        unknown = set(mix) - set(DEFAULT_MIX)
+        if unknown:
+            parser.error(f"未知的消息类型: {','.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory(prefix="pktracker_load_") as tmp:
+        data_dir = args.data_dir or tmp
+        os.makedirs(data_dir, exist_ok=True)
+        db_path = os.path.join(data_dir, f"load_{args.size}_{args.seed}.db")
+        params = datagen.SIZES[args.size]
+        dataset = datagen.generate(db_path, seed=args.seed, **params)
+        conn = sqlite3.connect(db_path)
+        conn.execute("UPDATE t_task SET max_checkins=?", (args.max_checkins,))
+        conn.commit()
+        conn.close()
+
+        plugin = build_plugin(db_path, throttle=args.throttle)
+        counter = LockCounter()
+        logging.getLogger("PKTracker").addHandler(counter)
+        stubs.channel().reset()
+        try:
+            interval = args.scheduler_interval if args.scheduler_interval >= 0 else None
+            latencies, failures, job_latencies, elapsed = run_load(
+                plugin, Workload(params, mix, args.seed), args.threads, args.duration, interval)
+        finally:
+            logging.getLogger("PKTracker").removeHandler(counter)
+            plugin.on_unload()
+
+    total = sum(len(v) for v in latencies.values())
+    all_values = [v for values in latencies.values() for v in values]
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git_revision": _git_revision(),
+            "size": args.size,
+            "threads": args.threads,
+            "duration_seconds": round(elapsed, 3),
+            "scheduler_interval": args.scheduler_interval,
+            "mix": mix,
+            "seed": args.seed,
+        },
+        "dataset": dataset,
+        "throughput_per_second": round(total / elapsed, 2) if elapsed else 0.0,
+        "requests": total,
+        "database_locked_errors": counter.locked,
+        "logged_errors": counter.errors,
+        "failed_replies": dict(failures),
+        "messages_sent": stubs.channel().sent_count,
+        "latency": {"all": summarize(all_values) if all_values else {}},
+        "scheduler_jobs": {job: summarize(values) for job, values in job_latencies.items() if values},
+    }
+    for kind, values in sorted(latencies.items()):
+        report["latency"][kind] = summarize(values)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"吞吐量: {report['throughput_per_second']}/s, 请求数: {total}, "
+          f"database is locked: {counter.locked}, 失败回复: {sum(failures.values())}", file=sys.stderr)
+    for kind, stats in report["latency"].items():
+        if stats:
+            print(f"  {kind:<14} n={stats['runs']:<7} p50 {stats['median_ms']:>9.2f} ms  "
+                  f"p95 {stats['p95_ms']:>9.2f} ms  p99 {stats['p99_ms']:>9.2f} ms", file=sys.stderr)
+    for job, stats in report["scheduler_jobs"].items():
+        print(f"  [job] {job:<22} n={stats['runs']:<4} p50 {stats['median_ms']:>9.2f} ms", file=sys.stderr)
+    print(f"结果已写入 {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""管理器方法的微基准测试
+
+对每个数据规模生成一个合成数据库, 在进程内替身环境中逐个计时:
+
+    handle_checkin / get_ranking(含时间范围) / get_user_bonus_detail / get_task_detail /
+    get_task_list / check_reminders / send_daily_ranking / process_weekly_rewards
+
+用法:
+    python -m benchmark.micro --sizes tiny,small --output bench_results.json
+
+会写库的方法(打卡、周奖励结算)直接作用在合成库上, 多次运行会累积少量数据,
+相对于数据规模可以忽略。
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from benchmark import datagen, stubs
+
+from plugins.PKTracker.analytics import AnalyticsMirror  # noqa: E402
+from plugins.PKTracker.checkin_calendar import CheckinCalendar  # noqa: E402
+from plugins.PKTracker.checkin_manager import CheckinManager  # noqa: E402
+from plugins.PKTracker.checkin_search import CheckinSearch  # noqa: E402
+from plugins.PKTracker.ranking_manager import RankingManager  # noqa: E402
+from plugins.PKTracker.rescore import Rescorer  # noqa: E402
+from plugins.PKTracker.scheduler import TaskScheduler  # noqa: E402
+from plugins.PKTracker.shards import shards  # noqa: E402
+from plugins.PKTracker.task_manager import TaskManager  # noqa: E402
+from plugins.PKTracker.user_manager import UserManager  # noqa: E402
+from lib.gewechat import GewechatClient  # noqa: E402
+
+
+class Fixture:
+    """一个数据规模下的被测对象集合"""
+
+    def __init__(self, db_path, plugin_config=None):
+        self.db_path = db_path
+        self.config = plugin_config or {"super_admins": ["wxid_super"], "daily_ranking_time": "09:10"}
+        client = GewechatClient("http://gewechat.stub", "stub_token")
+        self.user_manager = UserManager(client, "stub_app")
+        self.task_manager = TaskManager(db_path)
+        self.checkin_manager = CheckinManager(db_path)
+        self.ranking_manager = RankingManager(db_path, self.user_manager)
+        self.checkin_calendar = CheckinCalendar(db_path, self.user_manager)
+        self.checkin_search = CheckinSearch(db_path, self.user_manager)
+        self.rescorer = Rescorer(db_path, self.user_manager)
+        self.analytics = AnalyticsMirror(db_path, os.path.join(os.path.dirname(db_path), "analytics_mirror"))
+
+        # TaskScheduler 是进程级单例, 每个规模都需要一个新实例; 这里只调用任务方法, 不启动调度器
+        TaskScheduler._instance = None
+        plugin = SimpleNamespace(config=self.config, user_manager=self.user_manager)
+        self.scheduler = TaskScheduler(db_path, plugin)
+
+        self.group_id = datagen.group_id(0)
+        self.task_name = datagen.task_name(0)
+        self.user_id = datagen.user_id(0, 0)
+        self._seq = 0
+
+    def next_user(self):
+        """每次打卡使用新用户, 保证走完整的打卡成功路径"""
+        self._seq += 1
+        return f"wxid_bench_{os.getpid()}_{self._seq}"
+
+    def add_checkin(self):
+        """新增一条打卡, 让分析库的增量同步有数据可复制"""
+        self.checkin_manager.handle_checkin(self.next_user(), self.group_id, self.task_name, "跑步 5km")
+
+    def sync_analytics(self):
+        self.analytics.sync()
+
+    def arm_reminders(self):
+        """把所有任务的提醒时间设为当前分钟, 让 check_reminders 真正发送提醒
+
+        每个群的成员名单取该群打过卡的用户, 另加同样多从未打卡的成员, 提醒会 @ 今天未打卡的成员。
+        """
+        members = {}
+        for db_path in shards.paths(self.db_path):
+            conn = sqlite3.connect(db_path)
+            conn.execute("UPDATE t_task SET reminder_time=?", (datetime.now().strftime('%H:%M'),))
+            conn.commit()
+            for group_id, user_id in conn.execute("""SELECT DISTINCT t.group_id, l.user_id FROM t_task t
+                                                      JOIN t_checkin_log l ON l.task_id = t.task_id"""):
+                members.setdefault(group_id, []).append(user_id)
+            conn.close()
+        stubs.configure(members={group_id: users + [f"{group_id}_idle_{i}" for i in range(len(users))]
+                                 for group_id, users in members.items()})
+        self.scheduler.refresh_rosters()
+
+
+# (名称, 调用, 默认重复次数, 调用前的准备)
+BENCHMARKS = [
+    ("handle_checkin",
+     lambda f: f.checkin_manager.handle_checkin(f.next_user(), f.group_id, f.task_name, "跑步 5km"), 50, None),
+    ("handle_checkin_msg_id",
+     lambda f: f.checkin_manager.handle_checkin(f.next_user(), f.group_id, f.task_name, "跑步 5km",
+                                                f"bench_msg_{os.getpid()}_{f._seq}"), 50, None),
+    ("handle_checkin_redelivered",
+     lambda f: f.checkin_manager.handle_checkin(f.user_id, f.group_id, f.task_name, "跑步 5km",
+                                                f"bench_msg_{os.getpid()}_1"), 50, None),
+    ("handle_checkin_rejected",
+     lambda f: f.checkin_manager.handle_checkin(f.user_id, f.group_id, f.task_name, "跑步 5km"), 50, None),
+    ("get_ranking", lambda f: f.ranking_manager.get_ranking(f.group_id), 10, None),
+    ("get_ranking_task", lambda f: f.ranking_manager.get_ranking(f.group_id, f.task_name), 10, None),
+    ("get_ranking_page", lambda f: f.ranking_manager.get_ranking(f.group_id, None, None, 3), 10, None),
+    ("get_my_rank", lambda f: f.ranking_manager.get_my_rank(f.group_id, f.user_id), 20, None),
+    ("get_ranking_week", lambda f: f.ranking_manager.get_ranking(f.group_id, None, "本周"), 10, None),
+    ("get_ranking_year", lambda f: f.ranking_manager.get_ranking(f.group_id, None, "366天"), 10, None),
+    ("get_global_ranking", lambda f: f.ranking_manager.get_global_ranking(None, "本月"), 10, None),
+    ("get_user_bonus_detail",
+     lambda f: f.ranking_manager.get_user_bonus_detail(f.group_id, sender_id=f.user_id, page=1), 20, None),
+    ("get_calendar",
+     lambda f: f.checkin_calendar.get_calendar(f.group_id, f.task_name, sender_id=f.user_id), 20, None),
+    ("search_checkins", lambda f: f.checkin_search.search(f.group_id, ["10km", "状态不错"]), 20, None),
+    ("search_checkins_short", lambda f: f.checkin_search.search(f.group_id, ["跑步"], page=2), 20, None),
+    ("analytics_sync", lambda f: f.analytics.sync(), 10, Fixture.add_checkin),
+    ("analytics_trend", lambda f: f.analytics.trend(f.group_id), 10, Fixture.sync_analytics),
+    ("analytics_retention", lambda f: f.analytics.retention(f.group_id), 10, Fixture.sync_analytics),
+    ("rescore_dry_run", lambda f: f.rescorer.rescore(f.group_id, f.task_name), 10, None),
+    ("get_task_detail", lambda f: f.task_manager.get_task_detail(f.group_id, f.task_name), 20, None),
+    ("get_task_list", lambda f: f.task_manager.get_task_list(f.group_id), 20, None),
+    ("check_reminders", lambda f: f.scheduler.check_reminders(), 5, Fixture.arm_reminders),
+    ("send_daily_ranking", lambda f: f.scheduler.send_daily_ranking(), 3, None),
+    ("process_weekly_rewards", lambda f: f.scheduler.process_weekly_rewards(), 3, None),
+    ("process_monthly_rewards", lambda f: f.scheduler.process_monthly_rewards(), 3, None),
+]
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(durations_ms):
+    """把一组耗时(毫秒)汇总为统计值"""
+    values = sorted(durations_ms)
+    return {
+        "runs": len(values),
+        "min_ms": round(values[0], 3),
+        "median_ms": round(statistics.median(values), 3),
+        "mean_ms": round(statistics.fmean(values), 3),
+        "p95_ms": round(_percentile(values, 95), 3),
+        "p99_ms": round(_percentile(values, 99), 3),
+        "max_ms": round(values[-1], 3),
+    }
+
+
+def time_call(fixture, call, repeat, prepare=None, budget=None):
+    """重复调用并计时
+
+    重复次数不少于 5 次时先预热一次; 累计耗时超过 budget 秒后提前结束, 至少保留一次结果。
+    """
+    warmup = 1 if repeat >= 5 else 0
+    durations = []
+    spent = 0.0
+    for i in range(warmup + repeat):
+        if prepare:
+            prepare(fixture)
+        start = time.perf_counter()
+        call(fixture)
+        elapsed = time.perf_counter() - start
+        spent += elapsed
+        if i >= warmup:
+            durations.append(elapsed * 1000)
+        if budget and spent >= budget and durations:
+            break
+    stats = summarize(durations)
+    stats["truncated"] = len(durations) < repeat
+    return stats
+
+
+def run_size(size, params, data_dir, seed, only=None, repeat_scale=1.0, budget=None):
+    db_path = os.path.join(data_dir, f"bench_{size}_{seed}.db")
+    start = time.perf_counter()
+    dataset = datagen.generate(db_path, seed=seed, **params)
+    dataset["generate_seconds"] = round(time.perf_counter() - start, 3)
+
+    fixture = Fixture(db_path)
+    results = {}
+    for name, call, repeat, prepare in BENCHMARKS:
+        if only and name not in only:
+            continue
+        runs = max(1, int(repeat * repeat_scale))
+        results[name] = time_call(fixture, call, runs, prepare, budget)
+        print(f"  {size:<8} {name:<26} median {results[name]['median_ms']:>10.3f} ms"
+              f"  p95 {results[name]['p95_ms']:>10.3f} ms", file=sys.stderr)
+    return {"size": size, "dataset": dataset, "benchmarks": results}
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=stubs.PLUGIN_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PKTracker 微基准测试")
+    parser.add_argument("--sizes", default="tiny,small", help=f"逗号分隔的数据规模: {','.join(datagen.SIZES)}")
+    parser.add_argument("--only", help="逗号分隔, 只运行指定的基准项")
+    parser.add_argument("--repeat-scale", type=float, default=1.0, help="按比例调整各项的重复次数")
+    parser.add_argument("--budget", type=float, default=20.0, help="每个基准项的累计耗时上限(秒)")
+    parser.add_argument("--seed", type=int, default=20240101)
+    parser.add_argument("--data-dir", help="合成数据库存放目录, 默认使用临时目录")
+    parser.add_argument("--output", default="bench_results.json", help="JSON 结果文件")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="每次 channel.send 的模拟耗时(毫秒)")
+    parser.add_argument("--http-latency", type=float, default=0.0, help="每次 gewechat 接口调用的模拟耗时(毫秒)")
+    args = parser.parse_args(argv)
+
+    sizes = [s for s in args.sizes.split(",") if s]
+    unknown = [s for s in sizes if s not in datagen.SIZES]
+    if unknown:
+        parser.error(f"未知的数据规模: {','.join(unknown)}")
+    only = set(args.only.split(",")) if args.only else None
+    stubs.configure(send_latency=args.send_latency / 1000, http_latency=args.http_latency / 1000)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "send_latency_ms": args.send_latency,
+            "http_latency_ms": args.http_latency,
+        },
+        "results": [],
+    }
+
+    with tempfile.TemporaryDirectory(prefix="pktracker_bench_") as tmp:
+        data_dir = args.data_dir or tmp
+        os.makedirs(data_dir, exist_ok=True)
+        for size in sizes:
+            report["results"].append(run_size(size, datagen.SIZES[size], data_dir, args.seed,
+                                              only, args.repeat_scale, args.budget))
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
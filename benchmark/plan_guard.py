@@ -0,0 +1,197 @@
+"""执行计划回归检查
+
+静态提取 checkin_manager / ranking_manager / task_manager / admin_manager / scheduler / consistency / daily_stats /
+checkin_calendar / rank_index / task_stats / checkin_search / analytics / rescore / roster 中所有传给 execute()/executemany() 的 SQL 字面量(f-string 中的插值按空字符串处理)以及模块级的 SQL 常量, 在合成数据库上执行
+EXPLAIN QUERY PLAN, 出现以下情况时判定为违规:
+
+- 对大表(默认 t_checkin_log / t_bonus)做全表扫描, 包括每次查询都要全表扫描构建的自动索引
+- 使用临时 B-TREE 做排序或分组(通常意味着缺少合适的索引)
+
+已知且可接受的违规记录在 plan_allowlist.json 中, 以 "模块.函数:SQL指纹" 为键, 需要写明原因;
+--update 新增的条目原因为 TODO 占位, 未改写前同样判定为失败。
+SQL 文本变化后指纹随之变化, 必须重新评审。
+analytics 中读写分析库(mirror_* 表)的语句不在主库上执行, 不参与检查。
+
+用法:
+    python -m benchmark.plan_guard              # 有未登记的违规或白名单原因仍为 TODO 时返回非 0
+    python -m benchmark.plan_guard --update     # 把当前的违规写入白名单(保留已有原因), 供评审
+"""
+import argparse
+import ast
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+from benchmark import datagen, stubs
+
+from plugins.PKTracker.metrics import normalize_sql  # noqa: E402
+from plugins.PKTracker.slow_query import explain  # noqa: E402
+
+MODULES = ["checkin_manager.py", "ranking_manager.py", "task_manager.py", "admin_manager.py", "scheduler.py",
+           "consistency.py", "daily_stats.py", "checkin_calendar.py",
+           "rank_index.py", "task_stats.py", "checkin_search.py",
+           "analytics.py", "rescore.py", "roster.py"]
+DEFAULT_LARGE_TABLES = ["t_checkin_log", "t_bonus"]
+MIRROR_TABLE = re.compile(r"\bmirror_\w+")
+# --update 为新条目写入的原因占位, 以 TODO 开头的原因视为尚未评审
+TODO_REASON = "TODO: 说明为什么可以接受"
+ALLOWLIST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plan_allowlist.json")
+
+
+def _literal_sql(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.JoinedStr):
+        return "".join(part.value for part in node.values
+                       if isinstance(part, ast.Constant) and isinstance(part.value, str))
+    return None
+
+
+def _is_sql(text):
+    return text.lstrip().split(" ", 1)[0].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+def extract_statements(path):
+    """返回文件中所有 SQL 字面量: [(函数名, SQL, 行号)]
+
+    包括传给 execute()/executemany() 的字面量, 以及模块级常量(或常量列表)中的 SQL 语句。
+    """
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=path)
+
+    statements = []
+
+    def visit(node, func):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            func = node.name
+        if func == "<module>" and isinstance(node, ast.Assign):
+            values = node.value.elts if isinstance(node.value, (ast.List, ast.Tuple)) else [node.value]
+            for value in values:
+                if isinstance(value, ast.Constant) and isinstance(value.value, str) and _is_sql(value.value):
+                    statements.append((func, value.value, value.lineno))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) \
+                and node.func.attr in ("execute", "executemany") and node.args:
+            sql = _literal_sql(node.args[0])
+            if sql is not None:
+                statements.append((func, sql, node.lineno))
+        for child in ast.iter_child_nodes(node):
+            visit(child, func)
+
+    visit(tree, "<module>")
+    return statements
+
+
+def statement_key(module, func, sql):
+    digest = hashlib.sha1(normalize_sql(sql).encode("utf-8")).hexdigest()[:8]
+    return f"{module}.{func}:{digest}"
+
+
+def check(conn, large_tables):
+    """对所有语句执行 EXPLAIN QUERY PLAN, 返回 [(key, 位置, SQL, 计划, 违规列表)]"""
+    results = []
+    for filename in MODULES:
+        module = filename[:-3]
+        for func, sql, lineno in extract_statements(os.path.join(stubs.PLUGIN_DIR, filename)):
+            if MIRROR_TABLE.search(sql):
+                continue
+            key = statement_key(module, func, sql)
+            params = [None] * sql.count("?")
+            try:
+                plan, full_scans, temp_btree = explain(conn, sql, params)
+            except sqlite3.Error as e:
+                results.append((key, f"{filename}:{lineno}", sql, [], [f"explain_error:{e}"]))
+                continue
+            violations = sorted({f"full_scan:{t}" for t in full_scans if t in large_tables})
+            if temp_btree:
+                violations.append("temp_btree")
+            results.append((key, f"{filename}:{lineno}", sql, plan, violations))
+    return results
+
+
+def load_allowlist(path):
+    if not os.path.exists(path):
+        return {"large_tables": DEFAULT_LARGE_TABLES, "allowed": {}}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PKTracker 执行计划回归检查")
+    parser.add_argument("--allowlist", default=ALLOWLIST_PATH)
+    parser.add_argument("--size", choices=sorted(datagen.SIZES), default="tiny")
+    parser.add_argument("--seed", type=int, default=20240101)
+    parser.add_argument("--update", action="store_true", help="把当前违规写入白名单, 已有条目保留原因")
+    parser.add_argument("--verbose", action="store_true", help="输出每条语句的执行计划")
+    args = parser.parse_args(argv)
+
+    allowlist = load_allowlist(args.allowlist)
+    large_tables = set(allowlist.get("large_tables", DEFAULT_LARGE_TABLES))
+    allowed = allowlist.get("allowed", {})
+
+    with tempfile.TemporaryDirectory(prefix="pktracker_plan_") as tmp:
+        db_path = os.path.join(tmp, "plan.db")
+        datagen.generate(db_path, seed=args.seed, **datagen.SIZES[args.size])
+        conn = sqlite3.connect(db_path)
+        try:
+            results = check(conn, large_tables)
+        finally:
+            conn.close()
+
+    failures = []
+    seen = set()
+    for key, location, sql, plan, violations in results:
+        seen.add(key)
+        unexpected = [v for v in violations if v not in allowed.get(key, {}).get("allow", [])]
+        if unexpected:
+            failures.append((key, location, sql, plan, unexpected))
+        if args.verbose:
+            status = "FAIL" if unexpected else ("ALLOW" if violations else "OK")
+            print(f"[{status}] {key} ({location})")
+            for line in plan:
+                print(f"        {line}")
+
+    stale = sorted(set(allowed) - seen)
+    unreviewed = sorted(key for key, entry in allowed.items() if entry.get("reason", "").startswith("TODO"))
+
+    if args.update:
+        new_allowed = {}
+        for key, location, sql, plan, violations in results:
+            if not violations:
+                continue
+            entry = allowed.get(key, {})
+            new_allowed[key] = {
+                "location": location,
+                "sql": normalize_sql(sql)[:200],
+                "plan": plan,
+                "allow": violations,
+                "reason": entry.get("reason", TODO_REASON),
+            }
+        allowlist["large_tables"] = sorted(large_tables)
+        allowlist["allowed"] = dict(sorted(new_allowed.items()))
+        with open(args.allowlist, "w", encoding="utf-8") as f:
+            json.dump(allowlist, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"已更新 {args.allowlist}: {len(new_allowed)} 条", file=sys.stderr)
+        return 0
+
+    for key, location, sql, plan, unexpected in failures:
+        print(f"❌ {key} ({location}): {', '.join(unexpected)}")
+        print(f"   {normalize_sql(sql)[:160]}")
+        for line in plan:
+            print(f"      {line}")
+    for key in stale:
+        print(f"⚠️ 白名单条目已不存在, 请删除: {key}")
+    for key in unreviewed:
+        print(f"❌ 白名单条目缺少原因, 请把 TODO 改写为可以接受的理由: {key}")
+
+    print(f"共检查 {len(results)} 条语句, 违规 {len(failures)} 条, 过期白名单 {len(stale)} 条, "
+          f"缺少原因 {len(unreviewed)} 条", file=sys.stderr)
+    return 1 if failures or unreviewed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,376 @@
+"""dify-on-wechat 运行环境的进程内替身
+
+基准测试和压测需要在没有微信、没有 gewechat 服务的环境下导入并运行插件代码。
+install() 会向 sys.modules 注册以下模块的最小实现:
+
+- common.log / config
+- bridge.context / bridge.reply
+- channel.channel_factory / channel.chat_message
+- lib.gewechat
+- plugins (并把 plugins.PKTracker 指向当前插件目录)
+
+gewechat 的 HTTP 接口(requests.post)和 channel.send 都在进程内完成, 可以通过
+configure() 注入固定延迟来模拟慢网络。
+"""
+import logging
+import os
+import sys
+import threading
+import time
+import types
+from collections import deque
+from enum import Enum
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class _State:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contacts = []
+        self.members = {}
+        self.plugin_config = {}
+        self.root_config = {
+            "channel_type": "gewechat",
+            "gewechat_app_id": "stub_app",
+            "gewechat_base_url": "http://gewechat.stub",
+            "gewechat_token": "stub_token",
+        }
+        self.send_latency = 0.0
+        self.http_latency = 0.0
+        self.http_calls = 0
+        self.channel = None
+
+
+_state = _State()
+
+
+# 替身环境中机器人登录账号的 wxid, 群成员列表接口与真实环境一样包含机器人自己
+BOT_WXID = "wxid_bench_bot"
+
+
+def nickname(user_id):
+    """替身环境中用户的昵称, 由 wxid 确定性生成"""
+    return f"昵称_{user_id}"
+
+
+def configure(contacts=None, plugin_config=None, send_latency=None, http_latency=None, members=None):
+    """调整替身行为
+
+    Args:
+        contacts: 通讯录中的 wxid 列表, 用于按昵称查找用户
+        plugin_config: 插件 config.json 的内容
+        send_latency: 每次 channel.send 的模拟耗时(秒)
+        http_latency: 每次 gewechat HTTP 调用的模拟耗时(秒)
+        members: {群 ID: wxid 列表}, 群成员列表接口的返回; 未设置的群返回通讯录
+    """
+    if contacts is not None:
+        _state.contacts = list(contacts)
+    if plugin_config is not None:
+        _state.plugin_config = dict(plugin_config)
+    if send_latency is not None:
+        _state.send_latency = send_latency
+    if http_latency is not None:
+        _state.http_latency = http_latency
+    if members is not None:
+        _state.members = {group_id: list(wxids) for group_id, wxids in members.items()}
+
+
+def root_config():
+    """dify-on-wechat 根目录 config.json 的替身内容"""
+    return _state.root_config
+
+
+def channel():
+    """返回全局唯一的替身 channel"""
+    with _state.lock:
+        if _state.channel is None:
+            _state.channel = StubChannel()
+        return _state.channel
+
+
+def http_calls():
+    """替身 gewechat 接口被调用的总次数"""
+    return _state.http_calls
+
+
+# ---------------------------------------------------------------- common / config
+
+def _build_common():
+    common = types.ModuleType("common")
+    log = types.ModuleType("common.log")
+    logger = logging.getLogger("PKTracker")
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+        logger.setLevel(logging.WARNING)
+        logger.propagate = False
+    log.logger = logger
+    common.log = log
+    return {"common": common, "common.log": log}
+
+
+def _build_config():
+    config = types.ModuleType("config")
+    config.conf = root_config
+    return {"config": config}
+
+
+# ---------------------------------------------------------------- bridge
+
+class ContextType(Enum):
+    TEXT = 1
+    IMAGE = 3
+
+
+class Context:
+    def __init__(self, type=None, content=None, kwargs=None):
+        self.type = type
+        self.content = content
+        self.kwargs = kwargs if kwargs is not None else {}
+
+    def __contains__(self, key):
+        if key == "type":
+            return self.type is not None
+        if key == "content":
+            return self.content is not None
+        return key in self.kwargs
+
+    def __getitem__(self, key):
+        if key == "type":
+            return self.type
+        if key == "content":
+            return self.content
+        return self.kwargs[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key == "type":
+            self.type = value
+        elif key == "content":
+            self.content = value
+        else:
+            self.kwargs[key] = value
+
+
+class ReplyType(Enum):
+    TEXT = 1
+    INFO = 9
+    ERROR = 10
+
+
+class Reply:
+    def __init__(self, type=None, content=None):
+        self.type = type
+        self.content = content
+
+
+def _build_bridge():
+    bridge = types.ModuleType("bridge")
+    context = types.ModuleType("bridge.context")
+    context.Context = Context
+    context.ContextType = ContextType
+    reply = types.ModuleType("bridge.reply")
+    reply.Reply = Reply
+    reply.ReplyType = ReplyType
+    bridge.context = context
+    bridge.reply = reply
+    return {"bridge": bridge, "bridge.context": context, "bridge.reply": reply}
+
+
+# ---------------------------------------------------------------- channel
+
+class StubChannel:
+    """记录发送的消息而不真正发送"""
+
+    def __init__(self, keep=1000):
+        self._lock = threading.Lock()
+        self.sent_count = 0
+        self.messages = deque(maxlen=keep)
+
+    def send(self, reply, context):
+        if _state.send_latency:
+            time.sleep(_state.send_latency)
+        with self._lock:
+            self.sent_count += 1
+            self.messages.append((context.get("receiver"), reply.content))
+
+    def reset(self):
+        with self._lock:
+            self.sent_count = 0
+            self.messages.clear()
+
+
+class ChatMessage:
+    def __init__(self, _rawmsg):
+        self._rawmsg = _rawmsg
+        self.is_group = False
+        self.other_user_id = None
+        self.to_user_id = None
+        self.actual_user_id = None
+
+
+def _build_channel():
+    pkg = types.ModuleType("channel")
+    pkg.__path__ = []
+    factory = types.ModuleType("channel.channel_factory")
+    factory.create_channel = lambda channel_type: channel()
+    chat_message = types.ModuleType("channel.chat_message")
+    chat_message.ChatMessage = ChatMessage
+    pkg.channel_factory = factory
+    pkg.chat_message = chat_message
+    return {"channel": pkg, "channel.channel_factory": factory, "channel.chat_message": chat_message}
+
+
+# ---------------------------------------------------------------- gewechat
+
+def _http_call():
+    if _state.http_latency:
+        time.sleep(_state.http_latency)
+    with _state.lock:
+        _state.http_calls += 1
+
+
+class GewechatClient:
+    def __init__(self, base_url, token):
+        self.base_url = base_url
+        self.token = token
+
+    def fetch_contacts_list(self, app_id):
+        _http_call()
+        return {"ret": 200, "data": {"friends": list(_state.contacts)}}
+
+    def get_detail_info(self, app_id, wxids):
+        _http_call()
+        return {"ret": 200, "data": [{"userName": w, "nickName": nickname(w), "remark": ""} for w in wxids]}
+
+    def get_profile(self, app_id):
+        _http_call()
+        return {"ret": 200, "data": {"wxid": BOT_WXID, "nickName": nickname(BOT_WXID)}}
+
+    def get_chatroom_member_list(self, app_id, chatroom_id):
+        _http_call()
+        wxids = _state.members.get(chatroom_id, _state.contacts) + [BOT_WXID]
+        members = [{"wxid": w, "nickName": nickname(w)} for w in wxids]
+        return {"ret": 200, "data": {"memberList": members}}
+
+
+class _Response:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+
+class StubRequests(types.ModuleType):
+    """只实现 user_manager 用到的 requests.post"""
+
+    def __init__(self):
+        super().__init__("requests")
+
+    def post(self, url, json=None, headers=None, **kwargs):
+        _http_call()
+        if url.endswith("/contacts/getBriefInfo"):
+            wxids = (json or {}).get("wxids", [])
+            data = [{"userName": w, "nickName": nickname(w)} for w in wxids]
+            return _Response(200, {"ret": 200, "data": data})
+        return _Response(404, {"ret": 404})
+
+
+def _build_lib():
+    lib = types.ModuleType("lib")
+    lib.__path__ = []
+    gewechat = types.ModuleType("lib.gewechat")
+    gewechat.GewechatClient = GewechatClient
+    lib.gewechat = gewechat
+    return {"lib": lib, "lib.gewechat": gewechat}
+
+
+# ---------------------------------------------------------------- plugins
+
+class Event(Enum):
+    ON_RECEIVE_MESSAGE = 1
+    ON_HANDLE_CONTEXT = 2
+    ON_DECORATE_REPLY = 3
+    ON_SEND_REPLY = 4
+
+
+class EventAction(Enum):
+    CONTINUE = 1
+    BREAK = 2
+    BREAK_PASS = 3
+
+
+class EventContext:
+    def __init__(self, event, econtext=None):
+        self.event = event
+        self.econtext = econtext if econtext is not None else {}
+        self.action = EventAction.CONTINUE
+
+    def __getitem__(self, key):
+        return self.econtext[key]
+
+    def __setitem__(self, key, value):
+        self.econtext[key] = value
+
+    def __delitem__(self, key):
+        del self.econtext[key]
+
+    def is_pass(self):
+        return self.action == EventAction.BREAK_PASS
+
+    def is_break(self):
+        return self.action in (EventAction.BREAK, EventAction.BREAK_PASS)
+
+
+class Plugin:
+    def __init__(self):
+        self.handlers = {}
+        self.path = PLUGIN_DIR
+
+    def load_config(self):
+        return dict(_state.plugin_config)
+
+
+def _build_plugins():
+    pkg = types.ModuleType("plugins")
+    pkg.__path__ = []
+    pkg.Plugin = Plugin
+    pkg.Event = Event
+    pkg.EventAction = EventAction
+    pkg.EventContext = EventContext
+    pkg.register = lambda **kwargs: (lambda cls: cls)
+
+    # 只把插件目录挂到 plugins.PKTracker 下, 不执行包的 __init__.py
+    plugin_pkg = types.ModuleType("plugins.PKTracker")
+    plugin_pkg.__path__ = [PLUGIN_DIR]
+    pkg.PKTracker = plugin_pkg
+    return {"plugins": pkg, "plugins.PKTracker": plugin_pkg}
+
+
+_installed = False
+
+
+def install(**kwargs):
+    """注册所有替身模块, 可重复调用; 参数同 configure()"""
+    global _installed
+    configure(**kwargs)
+    if _installed:
+        return
+    modules = {}
+    for builder in (_build_common, _build_config, _build_bridge, _build_channel, _build_lib, _build_plugins):
+        modules.update(builder())
+    sys.modules.update(modules)
+
+    # gewechat 的 HTTP 接口由 user_manager 直接通过 requests.post 调用
+    stub_requests = StubRequests()
+    sys.modules.setdefault("requests", stub_requests)
+    from plugins.PKTracker import user_manager
+    user_manager.requests = stub_requests
+    _installed = True
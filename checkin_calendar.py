@@ -0,0 +1,212 @@
+from datetime import date, datetime, timedelta
+
+from common.log import logger
+from plugins.PKTracker.consistency import register_aggregate
+from plugins.PKTracker.database import get_connection
+from plugins.PKTracker.shards import shards
+
+# 每个 (任务, 用户, 年份) 一个 366 位的位图, 第 i 位表示该年第 i+1 天是否打过卡
+BITMAP_BYTES = 46
+
+UPSERT_BITMAP = """
+    INSERT INTO t_checkin_calendar (task_id, user_id, year, bits) VALUES (?, ?, ?, ?)
+    ON CONFLICT(task_id, user_id, year) DO UPDATE SET bits = excluded.bits
+"""
+
+
+def day_index(d):
+    """日期在当年位图中的位置"""
+    return d.timetuple().tm_yday - 1
+
+
+def to_int(bits):
+    return int.from_bytes(bits, "little") if bits else 0
+
+
+def to_blob(value):
+    return value.to_bytes(BITMAP_BYTES, "little")
+
+
+def count_days(value, start, end):
+    """统计位图中 [start, end] (含) 范围内打卡的天数"""
+    if end < start:
+        return 0
+    return ((value >> start) & ((1 << (end - start + 1)) - 1)).bit_count()
+
+
+def run_ending_at(value, idx):
+    """以第 idx 位结尾的连续打卡天数"""
+    gaps = ~value & ((1 << (idx + 1)) - 1)
+    return idx + 1 if not gaps else idx - (gaps.bit_length() - 1)
+
+
+def longest_run(value):
+    """位图中最长的连续打卡天数: 每次与左移一位的自身相与, 最长的一段最后消失"""
+    length = 0
+    while value:
+        value &= value << 1
+        length += 1
+    return length
+
+
+def load_bitmaps(cursor, task_id, user_id, years):
+    """读取用户在若干年份的位图, 返回 {年份: 整数}"""
+    placeholders = ",".join("?" * len(years))
+    cursor.execute(f"""SELECT year, bits FROM t_checkin_calendar
+                       WHERE task_id = ? AND user_id = ? AND year IN ({placeholders})""",
+                   (task_id, user_id) + tuple(years))
+    return {year: to_int(bits) for year, bits in cursor.fetchall()}
+
+
+def current_streak(bitmaps, day):
+    """截至 day (含) 的连续打卡天数, 跨年时继续向前一年累加"""
+    streak = 0
+    while True:
+        value = bitmaps.get(day.year, 0)
+        idx = day_index(day)
+        run = run_ending_at(value, idx)
+        streak += run
+        if run <= idx:
+            return streak
+        day = date(day.year - 1, 12, 31)
+        if day.year not in bitmaps:
+            return streak
+
+
+def record_checkin(cursor, task_id, user_id, day):
+    """在打卡的事务中把当天对应的位置 1
+
+    Returns:
+        tuple: (当天此前是否已经打过卡, 截至当天的连续打卡天数)
+    """
+    bitmaps = load_bitmaps(cursor, task_id, user_id, (day.year, day.year - 1))
+    value = bitmaps.get(day.year, 0)
+    mask = 1 << day_index(day)
+    seen = bool(value & mask)
+    if not seen:
+        bitmaps[day.year] = value | mask
+        cursor.execute(UPSERT_BITMAP, (task_id, user_id, day.year, to_blob(bitmaps[day.year])))
+    return seen, current_streak(bitmaps, day)
+
+
+def period_counts(cursor, task_id, start, end):
+    """统计任务下每个用户在 [start, end] (含) 内的打卡天数, 返回 {user_id: 天数}"""
+    cursor.execute("""SELECT user_id, year, bits FROM t_checkin_calendar
+                      WHERE task_id = ? AND year BETWEEN ? AND ?""", (task_id, start.year, end.year))
+    counts = {}
+    for user_id, year, bits in cursor.fetchall():
+        first = day_index(start) if year == start.year else 0
+        last = day_index(end) if year == end.year else day_index(date(year, 12, 31))
+        days = count_days(to_int(bits), first, last)
+        if days:
+            counts[user_id] = counts.get(user_id, 0) + days
+    return counts
+
+
+def rebuild_task(cursor, task_id):
+    """按打卡记录重新生成一个任务的全部位图, 返回写入的行数; 调用方负责提交"""
+    # 先执行 DELETE 开启写事务, 计算期间不会有新的打卡提交
+    cursor.execute("DELETE FROM t_checkin_calendar WHERE task_id = ?", (task_id,))
+    rows = _expected_rows(cursor, task_id)
+    cursor.executemany("INSERT INTO t_checkin_calendar (task_id, user_id, year, bits) VALUES (?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+def _expected_rows(cursor, task_id):
+    cursor.execute("""SELECT user_id, checkin_time FROM t_checkin_log
+                      WHERE task_id = ? ORDER BY user_id, checkin_time""", (task_id,))
+    bitmaps = {}
+    for user_id, checkin_time in cursor.fetchall():
+        day = datetime.strptime(checkin_time[:10], '%Y-%m-%d').date()
+        key = (user_id, day.year)
+        bitmaps[key] = bitmaps.get(key, 0) | (1 << day_index(day))
+    return [(task_id, user_id, year, to_blob(value)) for (user_id, year), value in bitmaps.items()]
+
+
+def _actual_rows(cursor, task_id):
+    cursor.execute("SELECT task_id, user_id, year, bits FROM t_checkin_calendar WHERE task_id = ?", (task_id,))
+    return cursor.fetchall()
+
+
+aggregate = register_aggregate("t_checkin_calendar", _expected_rows, _actual_rows, rebuild_task, "打卡日历")
+
+
+class CheckinCalendar:
+    def __init__(self, db_path, user_manager):
+        self.db_path = db_path
+        self.user_manager = user_manager
+
+    def backfill(self, pause=0.01):
+        """按历史打卡记录回填所有任务的位图
+
+        Returns:
+            int: 写入的行数
+        """
+        return aggregate.backfill(self.db_path, pause)
+
+    def get_calendar(self, group_id: str, task_name: str, user_name: str = None, sender_id: str = None,
+                     year: int = None) -> str:
+        """生成用户某个任务全年的打卡日历
+
+        Args:
+            group_id: 群组ID
+            task_name: 任务名称
+            user_name: 用户名称，可选，不指定时查询发送者
+            sender_id: 发送者ID
+            year: 年份，默认为今年
+        """
+        user_id = sender_id
+        display_name = "你"
+        if user_name:
+            user_id = self.user_manager._get_user_id_by_nickname(user_name)
+            if not user_id:
+                return f"❌ 未找到用户 [{user_name}]"
+            display_name = user_name
+
+        today = date.today()
+        year = year or today.year
+        conn = None
+        try:
+            conn = get_connection(shards.path(self.db_path, group_id), readonly=True)
+            c = conn.cursor()
+            c.execute("SELECT task_id FROM t_task WHERE group_id=? AND task_name=?", (group_id, task_name))
+            task = c.fetchone()
+            if not task:
+                return f"❌ 任务 [{task_name}] 不存在"
+            bitmaps = load_bitmaps(c, task[0], user_id, (year, year - 1))
+        except Exception as e:
+            logger.exception(f"[PKTracker] 获取打卡日历异常: {str(e)}")
+            return "❌ 获取打卡日历失败,请稍后重试"
+        finally:
+            if conn is not None:
+                conn.close()
+
+        value = bitmaps.get(year, 0)
+        if not value:
+            return f"📅 {display_name}在 {year} 年没有 [{task_name}] 的打卡记录"
+
+        # 只画到今天为止, 之后的日期留空
+        last_day = min(date(year, 12, 31), today)
+        message = f"📅 {display_name}的 [{task_name}] {year} 年打卡日历\n"
+        message += "===================\n"
+        for month in range(1, 13):
+            first = date(year, month, 1)
+            if first > last_day:
+                break
+            month_end = (date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)) - timedelta(days=1)
+            cells = "".join("■" if value >> day_index(first + timedelta(days=i)) & 1 else "□"
+                            for i in range((min(month_end, last_day) - first).days + 1))
+            days = count_days(value, day_index(first), day_index(month_end))
+            message += f"{month:02d}月 {cells} {days}天\n"
+
+        message += "===================\n"
+        message += f"🔸 全年打卡: {value.bit_count()}天\n"
+        message += f"🔸 最长连续: {longest_run(value)}天\n"
+        if year == today.year:
+            # 今天还没打卡时, 截至昨天的连续天数仍然有效
+            streak = current_streak(bitmaps, today) or current_streak(bitmaps, today - timedelta(days=1))
+            message += f"🔸 当前连续: {streak}天\n"
+        week_start = today - timedelta(days=today.weekday())
+        if year == today.year and week_start.year == year:
+            message += f"🔸 本周打卡: {count_days(value, day_index(week_start), day_index(today))}天\n"
+        return message
@@ -2,28 +2,55 @@ import sqlite3
 from datetime import datetime, timedelta
 
 from common.log import logger
+from plugins.PKTracker import checkin_calendar, task_stats
+from plugins.PKTracker.checkin_search import checkin_index
+from plugins.PKTracker.content_store import checkin_content
+from plugins.PKTracker.daily_stats import record_checkin
+from plugins.PKTracker.database import get_connection
+from plugins.PKTracker.shards import shards
+from plugins.PKTracker.dedup import checkin_dedup
+from plugins.PKTracker.reward_rules import CheckinState, compile_rules
 
 
 class CheckinManager:
     def __init__(self, db_path):
         self.db_path = db_path
 
-    def handle_checkin(self, user_id, group_id, task_name, content):
-        """处理打卡"""
-        global conn
+    def handle_checkin(self, user_id, group_id, task_name, content, msg_id=None):
+        """处理打卡
+
+        Args:
+            msg_id: 通道消息 ID。同一条消息重复投递时返回第一次的结果, 不会重复记录打卡和积分
+        """
+        replay = checkin_dedup.get(msg_id)
+        if replay is not None:
+            return replay
+
+        conn = None
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id))
             c = conn.cursor()
 
-            # 检查任务是否存在
-            c.execute("""SELECT task_id, frequency, max_checkins FROM t_task 
+            # 内存缓存未命中(如进程重启后)时按唯一索引确认该消息是否已经打过卡
+            replay = self._find_checkin(c, msg_id)
+            if replay is not None:
+                return replay
+
+            # 检查任务是否存在, 奖励设置随任务一起读出, 相同的设置只编译一次
+            c.execute("""SELECT task_id, frequency, max_checkins, base_score,
+                               first_checkin_reward_enabled, first_checkin_reward,
+                               consecutive_checkin_reward_enabled, consecutive_checkin_reward, reward_rules
+                        FROM t_task
                         WHERE group_id=? AND task_name=? AND enable=1""",
                       (group_id, task_name))
             task = c.fetchone()
             if not task:
-                return f"任务 [{task_name}] 不存在或未启用"
+                reply = f"任务 [{task_name}] 不存在或未启用"
+                checkin_dedup.put(msg_id, reply)
+                return reply
 
-            task_id, frequency, max_checkins = task
+            task_id, frequency, max_checkins = task[:3]
+            rules = compile_rules(*task[3:])
             now = datetime.now()
 
             # 根据频率检查打卡次数
@@ -46,25 +73,42 @@ class CheckinManager:
                 date_end = last_day.strftime('%Y-%m-%d 23:59:59')
 
             # 检查当前周期内的打卡次数
+            # checkin_time 统一为 '%Y-%m-%d %H:%M:%S' 格式, 直接按字符串比较才能使用索引
             c.execute("""SELECT COUNT(*) FROM t_checkin_log 
                         WHERE task_id=? AND user_id=? 
-                        AND datetime(checkin_time) >= datetime(?)
-                        AND datetime(checkin_time) <= datetime(?)""",
+                        AND checkin_time >= ?
+                        AND checkin_time <= ?""",
                       (task_id, user_id, date_start, date_end))
             current_checkins = c.fetchone()[0]
 
             if max_checkins > 0 and current_checkins >= max_checkins:
+                # 同一条消息的另一次投递可能刚刚提交, 此时应返回那一次的结果而不是次数已满
+                replay = self._find_checkin(c, msg_id)
+                if replay is not None:
+                    return replay
                 period_map = {'day': '今日', 'week': '本周', 'month': '本月'}
-                return f"❌ {period_map[frequency]}已达到最大打卡次数 ({max_checkins}次)"
+                reply = f"❌ {period_map[frequency]}已达到最大打卡次数 ({max_checkins}次)"
+                checkin_dedup.put(msg_id, reply)
+                return reply
 
             # 记录打卡
-            c.execute("""INSERT INTO t_checkin_log (task_id, user_id, checkin_time, content)
-                        VALUES (?, ?, ?, ?)""",
-                      (task_id, user_id, now.strftime('%Y-%m-%d %H:%M:%S'), content))
+            try:
+                c.execute("""INSERT INTO t_checkin_log (task_id, user_id, checkin_time, msg_id)
+                            VALUES (?, ?, ?, ?)""",
+                          (task_id, user_id, now.strftime('%Y-%m-%d %H:%M:%S'), msg_id))
+            except sqlite3.IntegrityError:
+                # 同一条消息的另一次投递已经并发提交, 返回那一次的结果
+                conn.rollback()
+                return self._find_checkin(c, msg_id) or "❌ 打卡失败,请稍后重试"
             checkin_id = c.lastrowid
+            checkin_content.save(c, checkin_id, content)
+            checkin_index.add(c, checkin_id, content)
 
-            # 计算奖励
-            bonus_details = self._calculate_bonus(c, task_id, user_id, now)
+            # 更新打卡日历并读取任务统计, 得到本次打卡的状态, 所有奖励规则都据此计算, 不再另外查询
+            seen, streak = checkin_calendar.record_checkin(c, task_id, user_id, now.date())
+            snapshot = task_stats.load(c, task_id, now.date())
+            bonus_details = rules.evaluate(CheckinState(now.hour * 60 + now.minute, seen, streak,
+                                                        snapshot.today_checkins + 1))
 
             # 记录积分明细
             for bonus_type, bonus_value in bonus_details.items():
@@ -74,68 +118,56 @@ class CheckinManager:
                                 VALUES (?, ?, ?, ?, ?, ?)""",
                               (task_id, user_id, checkin_id, bonus_type, bonus_value,
                                now.strftime('%Y-%m-%d %H:%M:%S')))
+            record_checkin(c, task_id, user_id, now.strftime('%Y-%m-%d %H:%M:%S'), bonus_details)
+            task_stats.record_checkin(c, task_id, user_id, now.strftime('%Y-%m-%d %H:%M:%S'), seen, streak,
+                                     snapshot)
 
-            total_bonus = sum(bonus_details.values())
             conn.commit()
 
-            # 生成积分明细消息
-            bonus_msg = "\n".join([
-                f"🎯 {desc}: +{value}分" for desc, value in [
-                    ("基础打卡", bonus_details.get("base", 0)),
-                    ("首次打卡", bonus_details.get("first", 0)),
-                    ("连续打卡", bonus_details.get("consecutive", 0))
-                ] if value > 0
-            ])
-
-            return f"""✅ 打卡成功!
-{bonus_msg}
-━━━━━━━━━━
-💫 总计: {total_bonus}分"""
+            reply = self._format_reply(bonus_details)
+            checkin_dedup.put(msg_id, reply)
+            return reply
 
         except Exception as e:
             logger.exception(f"[PKTracker] 打卡异常: {str(e)}")
             return "❌ 打卡失败,请稍后重试"
         finally:
-            if 'conn' in locals() and conn is not None:
+            if conn is not None:
                 conn.close()
 
-    def _calculate_bonus(self, cursor, task_id, user_id, checkin_time):
-        """计算打卡奖励"""
-        bonus = {
-            "base": 1,  # 基础打卡积分
-            "first": 0,  # 首次打卡奖励
-            "consecutive": 0  # 连续打卡奖励
-        }
-
-        # 获取任务配置
-        cursor.execute("""SELECT first_checkin_reward_enabled, first_checkin_reward,
-                         consecutive_checkin_reward_enabled, consecutive_checkin_reward
-                         FROM t_task WHERE task_id=?""", (task_id,))
-        task_info = cursor.fetchone()
-
-        # 检查首次打卡奖励
-        if task_info[0]:  # first_checkin_reward_enabled
-            today = checkin_time.date()
-            cursor.execute("""SELECT COUNT(*) FROM t_checkin_log 
-                            WHERE task_id=? AND date(checkin_time)=?""",
-                           (task_id, today))
-            if cursor.fetchone()[0] == 1:
-                bonus["first"] = task_info[1]  # first_checkin_reward
-
-        # 检查连续打卡奖励
-        if task_info[2]:  # consecutive_checkin_reward_enabled
-            cursor.execute("""SELECT date(checkin_time) FROM t_checkin_log
-                            WHERE task_id=? AND user_id=?
-                            ORDER BY checkin_time DESC LIMIT 3""",
-                           (task_id, user_id))
-            dates = cursor.fetchall()
-
-            if len(dates) == 3:
-                date1 = datetime.strptime(dates[0][0], '%Y-%m-%d')
-                date2 = datetime.strptime(dates[1][0], '%Y-%m-%d')
-                date3 = datetime.strptime(dates[2][0], '%Y-%m-%d')
-
-                if (date1 - date2).days == 1 and (date2 - date3).days == 1:
-                    bonus["consecutive"] = task_info[3]  # consecutive_checkin_reward
-
-        return bonus
+    def _find_checkin(self, cursor, msg_id):
+        """该消息已经打过卡时, 按已记录的积分明细重新生成第一次打卡的回复, 否则返回 None"""
+        if not msg_id:
+            return None
+        cursor.execute("SELECT checkin_id FROM t_checkin_log WHERE msg_id=?", (msg_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        checkin_id = row[0]
+        cursor.execute("SELECT bonus_type, bonus_value FROM t_bonus WHERE checkin_id=?", (checkin_id,))
+        bonus_details = {}
+        for bonus_type, bonus_value in cursor.fetchall():
+            bonus_details[bonus_type] = bonus_details.get(bonus_type, 0) + bonus_value
+        reply = self._format_reply(bonus_details)
+        checkin_dedup.record_db_hit()
+        checkin_dedup.put(msg_id, reply)
+        logger.info(f"[PKTracker] 忽略重复投递的打卡消息: {msg_id}")
+        return reply
+
+    @staticmethod
+    def _format_reply(bonus_details):
+        """生成打卡成功的积分明细消息"""
+        bonus_msg = "\n".join([
+            f"🎯 {desc}: +{value}分" for desc, value in [
+                ("基础打卡", bonus_details.get("base", 0)),
+                ("首次打卡", bonus_details.get("first", 0)),
+                ("连续打卡", bonus_details.get("consecutive", 0))
+            ] if value > 0
+        ])
+        # 周/月冠军奖励不属于打卡回复的一部分
+        total_bonus = sum(bonus_details.get(key, 0) for key in ("base", "first", "consecutive"))
+
+        return f"""✅ 打卡成功!
+{bonus_msg}
+━━━━━━━━━━
+💫 总计: {total_bonus}分"""
@@ -0,0 +1,226 @@
+import re
+import time
+
+from common.log import logger
+from plugins.PKTracker.consistency import register_check
+from plugins.PKTracker.content_store import checkin_content
+from plugins.PKTracker.database import get_connection
+from plugins.PKTracker.shards import shards
+
+# 搜索结果每页的条数
+SEARCH_PAGE_SIZE = 5
+
+# 一次搜索最多的关键词数
+MAX_TERMS = 5
+
+# trigram 分词只能用全文索引匹配不少于 3 个字符的关键词, 更短的关键词在群内的打卡中逐条查找
+MIN_INDEXED_CHARS = 3
+
+# 摘要的长度(字符)
+SNIPPET_CHARS = 40
+
+
+class SearchIndex:
+    """打卡内容的全文索引
+
+    t_checkin_fts 使用 trigram 分词, 中文不需要分词也能按任意子串搜索。
+    打卡内容在 t_checkin_content 中可能是压缩存储的, 无法作为外部内容表, 因此索引中保存一份原文, 用于匹配和生成摘要。
+    SQLite 不支持 FTS5 时(见 DatabaseManager.fts_enabled)不写入索引。
+    """
+
+    def __init__(self):
+        self.enabled = True
+
+    def configure(self, enabled=True):
+        self.enabled = enabled
+
+    def add(self, cursor, checkin_id, text):
+        """在打卡的事务中写入索引, 空内容不写入; 删除由 t_checkin_log 上的触发器完成"""
+        if self.enabled and text:
+            cursor.execute("INSERT INTO t_checkin_fts (rowid, body) VALUES (?, ?)", (checkin_id, text))
+
+
+checkin_index = SearchIndex()
+
+
+def make_snippet(text, terms, width=SNIPPET_CHARS):
+    """截取第一个关键词附近的一段内容, 关键词用【】标出"""
+    lowered = text.lower()
+    positions = [pos for pos in (lowered.find(term.lower()) for term in terms) if pos >= 0]
+    start = max(0, min(positions) - width // 4) if positions else 0
+    end = min(len(text), start + width)
+    start = max(0, end - width)
+    pattern = re.compile("|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    fragment = pattern.sub(lambda m: f"【{m.group(0)}】", text[start:end])
+    return ("…" if start > 0 else "") + fragment + ("…" if end < len(text) else "")
+
+
+def _missing_rows(conn):
+    c = conn.cursor()
+    c.execute("""SELECT checkin_id FROM t_checkin_content
+                 EXCEPT SELECT rowid FROM t_checkin_fts""")
+    missing = [row[0] for row in c.fetchall()]
+    c.execute("""SELECT rowid FROM t_checkin_fts
+                 EXCEPT SELECT checkin_id FROM t_checkin_content""")
+    extra = [row[0] for row in c.fetchall()]
+    return missing, extra
+
+
+def _fts_exists(conn):
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 't_checkin_fts'")
+    return c.fetchone() is not None
+
+
+def verify(conn):
+    """比较索引与打卡内容表中的 checkin_id, 返回不一致的行数"""
+    if not _fts_exists(conn):
+        return 0
+    missing, extra = _missing_rows(conn)
+    return len(missing) + len(extra)
+
+
+def rebuild(conn, batch_size=1000, pause=0.01):
+    """补齐缺失的索引并删除多余的索引, 每批一个事务, 返回处理的行数"""
+    if not _fts_exists(conn):
+        return 0
+    missing, extra = _missing_rows(conn)
+    c = conn.cursor()
+    for i in range(0, len(extra), batch_size):
+        c.executemany("DELETE FROM t_checkin_fts WHERE rowid = ?", [(rowid,) for rowid in extra[i:i + batch_size]])
+        conn.commit()
+        time.sleep(pause)
+    for i in range(0, len(missing), batch_size):
+        contents = checkin_content.load(c, missing[i:i + batch_size])
+        # 读取之后打卡可能已被删除, 只为仍然存在的打卡写入索引
+        c.executemany("""INSERT INTO t_checkin_fts (rowid, body)
+                         SELECT ?, ? WHERE EXISTS (SELECT 1 FROM t_checkin_log WHERE checkin_id = ?)
+                         AND NOT EXISTS (SELECT 1 FROM t_checkin_fts WHERE rowid = ?)""",
+                      [(checkin_id, text, checkin_id, checkin_id) for checkin_id, text in contents.items()])
+        conn.commit()
+        time.sleep(pause)
+    return len(missing) + len(extra)
+
+
+register_check("t_checkin_fts", verify, rebuild)
+
+
+class CheckinSearch:
+    def __init__(self, db_path, user_manager):
+        self.db_path = db_path
+        self.user_manager = user_manager
+
+    def backfill(self, batch_size=1000, pause=0.01):
+        """为已有的打卡内容建立全文索引, 每批一个事务
+
+        Returns:
+            int: 写入的行数
+        """
+        start = time.perf_counter()
+        conn = None
+        rows = 0
+        try:
+            conn = get_connection(self.db_path)
+            rows = rebuild(conn, batch_size, pause)
+        finally:
+            if conn:
+                conn.close()
+        logger.info(f"[PKTracker] 打卡全文索引回填完成: {rows}行, 耗时 {time.perf_counter() - start:.2f}s")
+        return rows
+
+    def search(self, group_id: str, terms: list, task_name: str = None, user_name: str = None,
+               sender_id: str = None, page: int = 1) -> str:
+        """在群内的打卡内容中搜索, 多个关键词需要同时出现, 按打卡时间倒序分页
+
+        Args:
+            group_id: 群组ID
+            terms: 关键词列表
+            task_name: 任务名称，可选，只搜索该任务
+            user_name: 用户名称，可选，只搜索该用户的打卡, "我" 表示发送者
+            sender_id: 发送者ID
+            page: 页码，默认为1，每页 SEARCH_PAGE_SIZE 条
+        """
+        if not checkin_index.enabled:
+            return "❌ 当前环境的 SQLite 不支持全文搜索"
+        terms = list(dict.fromkeys(term for term in terms if term))[:MAX_TERMS]
+        if not terms:
+            return "格式错误,请使用: PKTracker 搜索打卡 关键词 [任务名称] u[用户名] p[页码]"
+
+        user_id = None
+        if user_name == "我":
+            user_id = sender_id
+        elif user_name:
+            user_id = self.user_manager._get_user_id_by_nickname(user_name)
+            if not user_id:
+                return f"❌ 未找到用户 [{user_name}]"
+
+        # 短关键词、任务和用户作为附加条件, 两种查询方式共用
+        filters = ""
+        filter_params = []
+        for term in terms:
+            if len(term) < MIN_INDEXED_CHARS:
+                filters += " AND instr(lower(f.body), lower(?)) > 0"
+                filter_params.append(term)
+        if task_name:
+            filters += " AND t.task_name = ?"
+            filter_params.append(task_name)
+        if user_id:
+            filters += " AND cl.user_id = ?"
+            filter_params.append(user_id)
+        # 每个可以走全文索引的关键词作为一个短语, 多个短语之间是 AND
+        indexed = [term for term in terms if len(term) >= MIN_INDEXED_CHARS]
+        match = " ".join('"' + term.replace('"', '""') + '"' for term in indexed)
+
+        conn = None
+        try:
+            conn = get_connection(shards.path(self.db_path, group_id), readonly=True)
+            c = conn.cursor()
+            if indexed:
+                # 先按全文索引找到匹配的打卡, 再按群和任务过滤
+                params = [match, group_id] + filter_params
+                c.execute(f"""SELECT COUNT(*) FROM t_checkin_fts f
+                              CROSS JOIN t_checkin_log cl ON cl.checkin_id = f.rowid
+                              JOIN t_task t ON t.task_id = cl.task_id
+                              WHERE t_checkin_fts MATCH ? AND t.group_id = ? AND t.enable = 1{filters}""", params)
+            else:
+                # 只有短关键词时, 从群内的任务出发逐条比较打卡内容
+                params = [group_id] + filter_params
+                c.execute(f"""SELECT COUNT(*) FROM t_task t
+                              CROSS JOIN t_checkin_log cl ON cl.task_id = t.task_id
+                              CROSS JOIN t_checkin_fts f ON f.rowid = cl.checkin_id
+                              WHERE t.group_id = ? AND t.enable = 1{filters}""", params)
+            total = c.fetchone()[0]
+            total_pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+            page = max(1, min(page, total_pages)) if total_pages > 0 else 1
+            params += [SEARCH_PAGE_SIZE, (page - 1) * SEARCH_PAGE_SIZE]
+            if indexed:
+                c.execute(f"""SELECT cl.user_id, t.task_name, cl.checkin_time, f.body FROM t_checkin_fts f
+                              CROSS JOIN t_checkin_log cl ON cl.checkin_id = f.rowid
+                              JOIN t_task t ON t.task_id = cl.task_id
+                              WHERE t_checkin_fts MATCH ? AND t.group_id = ? AND t.enable = 1{filters}
+                              ORDER BY f.rowid DESC LIMIT ? OFFSET ?""", params)
+            else:
+                c.execute(f"""SELECT cl.user_id, t.task_name, cl.checkin_time, f.body FROM t_task t
+                              CROSS JOIN t_checkin_log cl ON cl.task_id = t.task_id
+                              CROSS JOIN t_checkin_fts f ON f.rowid = cl.checkin_id
+                              WHERE t.group_id = ? AND t.enable = 1{filters}
+                              ORDER BY cl.checkin_id DESC LIMIT ? OFFSET ?""", params)
+            rows = c.fetchall()
+        except Exception as e:
+            logger.exception(f"[PKTracker] 搜索打卡异常: {str(e)}")
+            return "❌ 搜索打卡失败,请稍后重试"
+        finally:
+            if conn is not None:
+                conn.close()
+
+        keywords = " ".join(terms)
+        if not rows:
+            return f"🔍 没有找到包含 [{keywords}] 的打卡"
+
+        nickname_map = self.user_manager._get_nickname_by_user_ids(list({row[0] for row in rows}))
+        message = f"🔍 包含 [{keywords}] 的打卡: 共{total}条 (第{page}/{total_pages}页)\n"
+        message += "===================\n\n"
+        for user_id, task, checkin_time, body in rows:
+            message += f"{nickname_map.get(user_id, user_id)} [{task}] {checkin_time}\n"
+            message += f"{make_snippet(body, terms)}\n\n"
+        return message
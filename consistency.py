@@ -0,0 +1,411 @@
+import json
+import time
+from datetime import datetime
+
+from common.log import logger
+from plugins.PKTracker.database import get_connection
+from plugins.PKTracker.reward_rules import compile_rules
+from plugins.PKTracker.shards import shards
+
+# 每条打卡最多只能有一条的积分类型
+PER_CHECKIN_TYPES = ("base", "first", "consecutive")
+
+# 每类问题在报告中保留的样例数
+MAX_SAMPLES = 5
+
+FINDING_TITLES = {
+    "orphan_bonus": "积分记录对应的打卡不存在",
+    "orphan_task": "打卡记录对应的任务不存在",
+    "mismatched_bonus": "积分记录与打卡的任务/用户不一致",
+    "duplicate_bonus": "同一打卡重复发放积分",
+    "missing_base": "打卡缺少基础积分",
+    "duplicate_settlement": "周/月奖励重复结算",
+}
+
+# 派生数据的校验: 名称 -> (verify(conn) -> 不一致的行数, rebuild(conn, batch_size, pause) -> 重建的行数)
+AGGREGATES = {}
+
+
+def register_check(name, verify, rebuild):
+    """登记一项由 t_checkin_log / t_bonus 派生的数据, 一致性检查时会校验并在修复模式下重建"""
+    AGGREGATES[name] = (verify, rebuild)
+
+
+def register_aggregate(table, expected, actual, rebuild_task, title):
+    """登记一张按任务维护的聚合表, 返回对应的 TaskAggregate
+
+    Args:
+        table: 聚合表名
+        expected: expected(cursor, task_id) -> 按原始记录计算的行
+        actual: actual(cursor, task_id) -> 聚合表中的行, 与 expected 的行格式相同
+        rebuild_task: rebuild_task(cursor, task_id) -> 写入的行数, 按原始记录重建一个任务, 调用方负责提交
+        title: 日志中的名称
+    """
+    aggregate = TaskAggregate(table, expected, actual, rebuild_task, title)
+    register_check(table, aggregate.verify, aggregate.rebuild)
+    return aggregate
+
+
+class TaskAggregate:
+    """按任务维护的聚合表的校验、重建和回填
+
+    各表只提供期望行、实际行和单个任务的重建; 逐个任务比较、跳过正在清理的任务、每个任务一个事务以及任务之间的休眠都在这里。
+    """
+
+    def __init__(self, table, expected, actual, rebuild_task, title):
+        self.table = table
+        self.expected = expected
+        self.actual = actual
+        self.rebuild_task = rebuild_task
+        self.title = title
+
+    @staticmethod
+    def _checked_tasks(conn):
+        # 正在后台清理的任务数据处于删除中途, 不参与校验
+        c = conn.cursor()
+        c.execute("""SELECT task_id FROM t_task
+                     WHERE task_id NOT IN (SELECT task_id FROM t_task_purge WHERE status = 'pending')
+                     ORDER BY task_id""")
+        return [row[0] for row in c.fetchall()]
+
+    def mismatched(self, conn, task_id):
+        """一个任务不一致的行数"""
+        # 原始记录和聚合表在同一个读事务中读取, 不受并发打卡影响
+        c = conn.cursor()
+        own_transaction = not conn.in_transaction
+        if own_transaction:
+            c.execute("BEGIN")
+        try:
+            expected = set(self.expected(c, task_id))
+            actual = set(self.actual(c, task_id))
+        finally:
+            if own_transaction:
+                conn.rollback()
+        return len(expected ^ actual)
+
+    def verify(self, conn):
+        """逐个任务比较聚合表与原始记录, 返回不一致的行数"""
+        return sum(self.mismatched(conn, task_id) for task_id in self._checked_tasks(conn))
+
+    def rebuild(self, conn, batch_size=1000, pause=0.01):
+        """重建所有不一致的任务, 每个任务一个事务, 返回重建的行数"""
+        rebuilt = 0
+        for task_id in self._checked_tasks(conn):
+            if self.mismatched(conn, task_id):
+                rebuilt += self.rebuild_task(conn.cursor(), task_id)
+                conn.commit()
+                time.sleep(pause)
+        return rebuilt
+
+    def backfill(self, db_path, pause=0.01):
+        """按原始记录回填所有任务, 每个任务一个事务, 与并发的打卡互不干扰, 可以在运行中执行
+
+        Returns:
+            int: 写入的行数
+        """
+        start = time.perf_counter()
+        conn = None
+        rows = 0
+        try:
+            conn = get_connection(db_path)
+            c = conn.cursor()
+            c.execute("SELECT task_id FROM t_task ORDER BY task_id")
+            task_ids = [row[0] for row in c.fetchall()]
+            for task_id in task_ids:
+                rows += self.rebuild_task(c, task_id)
+                conn.commit()
+                time.sleep(pause)
+        finally:
+            if conn:
+                conn.close()
+        logger.info(f"[PKTracker] {self.title}回填完成: {len(task_ids)}个任务, {rows}行, "
+                    f"耗时 {time.perf_counter() - start:.2f}s")
+        return rows
+
+
+class ConsistencyChecker:
+    """打卡和积分数据的一致性检查
+
+    按 checkin_id 顺序分批流式读取 t_checkin_log 和 t_bonus 并做归并, 内存中只保留一批数据、
+    各类问题的计数和少量样例。每批读取完成后立即结束读事务并短暂休眠, 不会长时间阻塞打卡。
+    扫描范围限定在开始时的最大 checkin_id 以内, 检查期间新增的打卡不会被误判。
+
+    修复模式下, 修复语句按批提交, 并且都带有条件(例如只删除打卡确实不存在的积分), 与并发写入竞争时是安全的。
+    对应任务已不存在的打卡登记到 t_task_purge, 由后台清理任务分批删除。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def run(self, repair=False, batch_size=1000, pause=0.01):
+        """执行一次检查, 返回报告"""
+        start = time.perf_counter()
+        report = {
+            "time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "repair": repair,
+            "checkins": 0,
+            "bonuses": 0,
+            "findings": {name: 0 for name in FINDING_TITLES},
+            "samples": {},
+            "repaired": {},
+            "aggregates": {},
+        }
+        # 按群组分库时依次检查每个分库, 结果合并到同一份报告
+        for db_path in shards.paths(self.db_path):
+            self._check_database(db_path, report, repair, batch_size, pause)
+
+        report["duration_s"] = round(time.perf_counter() - start, 3)
+        return report
+
+    def _check_database(self, db_path, report, repair, batch_size, pause):
+        self._pending = []
+        # 只检查时使用只读连接
+        conn = get_connection(db_path, readonly=not repair)
+        try:
+            c = conn.cursor()
+            c.execute("SELECT COALESCE(MAX(checkin_id), 0) FROM t_checkin_log")
+            max_checkin_id = c.fetchone()[0]
+            # 任务的奖励规则, 补齐缺失的基础积分时按打卡时间计算分值
+            c.execute("""SELECT task_id, base_score, first_checkin_reward_enabled, first_checkin_reward,
+                                consecutive_checkin_reward_enabled, consecutive_checkin_reward, reward_rules
+                         FROM t_task""")
+            tasks = {row[0]: compile_rules(*row[1:]) for row in c.fetchall()}
+            # 正在后台清理的任务, 其数据处于删除中途, 不参与检查
+            c.execute("SELECT task_id FROM t_task_purge WHERE status='pending'")
+            purging = {row[0] for row in c.fetchall()}
+
+            self._merge(conn, report, max_checkin_id, tasks, purging, repair, batch_size, pause)
+            self._check_settlements(conn, report, repair)
+            self._flush(conn, report)
+
+            for name, (verify, rebuild) in AGGREGATES.items():
+                mismatched = verify(conn)
+                entry = report["aggregates"].setdefault(name, {"mismatched": 0, "rebuilt": 0})
+                entry["mismatched"] += mismatched
+                if repair and mismatched:
+                    entry["rebuilt"] += rebuild(conn, batch_size, pause)
+        finally:
+            conn.close()
+
+    def _scan_checkins(self, conn, max_checkin_id, batch_size, pause):
+        last_id = 0
+        while True:
+            c = conn.cursor()
+            c.execute("""
+                SELECT checkin_id, task_id, user_id, checkin_time
+                FROM t_checkin_log
+                WHERE checkin_id > ? AND checkin_id <= ?
+                ORDER BY checkin_id
+                LIMIT ?
+            """, (last_id, max_checkin_id, batch_size))
+            rows = c.fetchall()
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+            time.sleep(pause)
+
+    def _scan_bonuses(self, conn, max_checkin_id, batch_size, pause):
+        last_key = (-1, -1)
+        while True:
+            c = conn.cursor()
+            c.execute("""
+                SELECT checkin_id, bonus_id, task_id, user_id, bonus_type
+                FROM t_bonus
+                WHERE (checkin_id, bonus_id) > (?, ?) AND checkin_id <= ?
+                ORDER BY checkin_id, bonus_id
+                LIMIT ?
+            """, (*last_key, max_checkin_id, batch_size))
+            rows = c.fetchall()
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            last_key = rows[-1][:2]
+            time.sleep(pause)
+
+    def _merge(self, conn, report, max_checkin_id, tasks, purging, repair, batch_size, pause):
+        """按 checkin_id 归并打卡和积分两个有序流"""
+        bonuses = self._scan_bonuses(conn, max_checkin_id, batch_size, pause)
+        bonus = next(bonuses, None)
+        orphan_tasks = set()
+
+        for checkin_id, task_id, user_id, checkin_time in self._scan_checkins(conn, max_checkin_id,
+                                                                            batch_size, pause):
+            report["checkins"] += 1
+            while bonus and bonus[0] < checkin_id:
+                self._orphan_bonus(conn, report, bonus, purging, repair, batch_size, pause)
+                bonus = next(bonuses, None)
+            group = []
+            while bonus and bonus[0] == checkin_id:
+                group.append(bonus)
+                bonus = next(bonuses, None)
+            report["bonuses"] += len(group)
+
+            if task_id in purging:
+                continue
+            if task_id not in tasks:
+                if task_id not in orphan_tasks:
+                    orphan_tasks.add(task_id)
+                    self._finding(report, "orphan_task", {"task_id": task_id})
+                    if repair:
+                        self._repair(conn, report, "orphan_task", """
+                            INSERT OR IGNORE INTO t_task_purge (task_id, group_id, task_name)
+                            SELECT ?, '', '#' || ?
+                            WHERE NOT EXISTS (SELECT 1 FROM t_task WHERE task_id = ?)
+                        """, (task_id, task_id, task_id), batch_size, pause)
+                continue
+            self._check_checkin(conn, report, (checkin_id, task_id, user_id, checkin_time), group,
+                                tasks[task_id], repair, batch_size, pause)
+
+        while bonus:
+            self._orphan_bonus(conn, report, bonus, purging, repair, batch_size, pause)
+            bonus = next(bonuses, None)
+
+    def _orphan_bonus(self, conn, report, bonus, purging, repair, batch_size, pause):
+        report["bonuses"] += 1
+        checkin_id, bonus_id, task_id, user_id, bonus_type = bonus
+        if task_id in purging:
+            return
+        self._finding(report, "orphan_bonus", {"bonus_id": bonus_id, "checkin_id": checkin_id,
+                                               "bonus_type": bonus_type})
+        if repair:
+            self._repair(conn, report, "orphan_bonus", """
+                DELETE FROM t_bonus WHERE bonus_id = ?
+                    AND NOT EXISTS (SELECT 1 FROM t_checkin_log WHERE checkin_id = ?)
+            """, (bonus_id, checkin_id), batch_size, pause)
+
+    def _check_checkin(self, conn, report, checkin, group, rules, repair, batch_size, pause):
+        checkin_id, task_id, user_id, checkin_time = checkin
+        seen = set()
+        for _, bonus_id, bonus_task_id, bonus_user_id, bonus_type in group:
+            if bonus_task_id != task_id or bonus_user_id != user_id:
+                self._finding(report, "mismatched_bonus", {"bonus_id": bonus_id, "checkin_id": checkin_id,
+                                                           "bonus_type": bonus_type})
+                # 周/月奖励挂在哪条打卡上本身不确定, 只报告不修复
+                if repair and bonus_type in PER_CHECKIN_TYPES:
+                    self._repair(conn, report, "mismatched_bonus", """
+                        UPDATE t_bonus SET task_id = ?, user_id = ?
+                        WHERE bonus_id = ? AND checkin_id = ?
+                    """, (task_id, user_id, bonus_id, checkin_id), batch_size, pause)
+            if bonus_type in PER_CHECKIN_TYPES:
+                if bonus_type in seen:
+                    self._finding(report, "duplicate_bonus", {"bonus_id": bonus_id, "checkin_id": checkin_id,
+                                                              "bonus_type": bonus_type})
+                    if repair:
+                        self._repair(conn, report, "duplicate_bonus", """
+                            DELETE FROM t_bonus WHERE bonus_id = ? AND EXISTS (
+                                SELECT 1 FROM t_bonus b
+                                WHERE b.checkin_id = ? AND b.bonus_type = ? AND b.bonus_id < ?
+                            )
+                        """, (bonus_id, checkin_id, bonus_type, bonus_id), batch_size, pause)
+                seen.add(bonus_type)
+
+        if "base" in seen:
+            return
+        # 基础积分为 0(如基础分设为 0)时本来就没有基础积分记录
+        base = rules.base_value(int(checkin_time[11:13]) * 60 + int(checkin_time[14:16]))
+        if base > 0:
+            self._finding(report, "missing_base", {"checkin_id": checkin_id})
+            if repair:
+                self._repair(conn, report, "missing_base", """
+                    INSERT INTO t_bonus (task_id, user_id, checkin_id, bonus_type, bonus_value, create_time)
+                    SELECT ?, ?, ?, 'base', ?, ?
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM t_bonus WHERE checkin_id = ? AND bonus_type = 'base'
+                    )
+                """, (task_id, user_id, checkin_id, base, checkin_time, checkin_id),
+                             batch_size, pause)
+
+    def _check_settlements(self, conn, report, repair):
+        """同一任务同一周期内的周/月奖励只应结算一次"""
+        c = conn.cursor()
+        c.execute("""
+            SELECT task_id, bonus_type,
+                   strftime(CASE bonus_type WHEN 'week' THEN '%Y-%W' ELSE '%Y-%m' END, create_time) AS period,
+                   MIN(bonus_id), COUNT(*)
+            FROM t_bonus
+            WHERE bonus_type IN ('week', 'month')
+            GROUP BY task_id, bonus_type, period
+            HAVING COUNT(*) > 1
+        """)
+        for task_id, bonus_type, period, keep_id, count in c.fetchall():
+            for _ in range(count - 1):
+                self._finding(report, "duplicate_settlement", {"task_id": task_id, "bonus_type": bonus_type,
+                                                               "period": period})
+            if repair:
+                # 保留最早的一条
+                c.execute("""
+                    DELETE FROM t_bonus
+                    WHERE task_id = ? AND bonus_type = ? AND bonus_type IN ('week', 'month')
+                        AND strftime(CASE bonus_type WHEN 'week' THEN '%Y-%W' ELSE '%Y-%m' END, create_time) = ?
+                        AND bonus_id > ?
+                """, (task_id, bonus_type, period, keep_id))
+                report["repaired"]["duplicate_settlement"] = \
+                    report["repaired"].get("duplicate_settlement", 0) + c.rowcount
+                conn.commit()
+
+    @staticmethod
+    def _finding(report, name, sample):
+        report["findings"][name] += 1
+        samples = report["samples"].setdefault(name, [])
+        if len(samples) < MAX_SAMPLES:
+            samples.append(sample)
+
+    def _repair(self, conn, report, name, sql, params, batch_size, pause):
+        """暂存一条修复语句, 攒够一批后统一提交"""
+        self._pending.append((name, sql, params))
+        if len(self._pending) >= batch_size:
+            self._flush(conn, report)
+            time.sleep(pause)
+
+    def _flush(self, conn, report):
+        if not self._pending:
+            return
+        c = conn.cursor()
+        for name, sql, params in self._pending:
+            c.execute(sql, params)
+            report["repaired"][name] = report["repaired"].get(name, 0) + c.rowcount
+        conn.commit()
+        self._pending = []
+
+    @staticmethod
+    def format_report(report):
+        """生成适合在群里发送的检查报告"""
+        if not report:
+            return "暂无一致性检查报告, 使用 PKTracker 一致性检查 执行 进行检查"
+        message = f"🩺 数据一致性检查 ({report['time']}, {'修复' if report['repair'] else '只检查'})\n"
+        message += "===================\n"
+        message += f"🔸 扫描: {report['checkins']}条打卡, {report['bonuses']}条积分, 耗时 {report['duration_s']}s"
+        problems = {name: count for name, count in report["findings"].items() if count}
+        if not problems and not any(a["mismatched"] for a in report["aggregates"].values()):
+            return message + "\n\n✅ 未发现问题"
+        for name, count in problems.items():
+            message += f"\n\n⚠️ {FINDING_TITLES[name]}: {count}条"
+            repaired = report["repaired"].get(name)
+            if repaired is not None:
+                message += f" (已修复 {repaired}条)"
+            for sample in report["samples"].get(name, []):
+                message += f"\n   - {json.dumps(sample, ensure_ascii=False)}"
+        for name, entry in report["aggregates"].items():
+            if entry["mismatched"]:
+                message += f"\n\n⚠️ 聚合表 {name}: {entry['mismatched']}行不一致"
+                if entry["rebuilt"]:
+                    message += f" (已重建 {entry['rebuilt']}行)"
+        return message
+
+
+def load_report(path):
+    """读取最近一次检查报告, 不存在时返回 None"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"[PKTracker] 读取一致性检查报告失败: {str(e)}")
+        return None
+
+
+def save_report(path, report):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
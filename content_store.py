@@ -0,0 +1,97 @@
+import sqlite3
+import time
+import zlib
+
+from common.log import logger
+from plugins.PKTracker.database import get_connection
+
+
+class ContentStore:
+    """打卡内容的存储
+
+    打卡内容长度不定, 放在 t_checkin_log 中会让所有按任务、用户、时间扫描的查询读入大量用不到的页。
+    内容单独存放在以 checkin_id 为主键的 t_checkin_content 中, 超过阈值(UTF-8 字节数)且压缩后确实变小的内容
+    用 zlib 压缩后以 BLOB 存储, 其余按原文存储。
+    """
+
+    def __init__(self, threshold=200):
+        self.configure(threshold)
+
+    def configure(self, threshold=200):
+        """设置压缩阈值(字节), 0 表示不压缩"""
+        self.threshold = threshold
+
+    def encode(self, text):
+        """返回 (存储的值, 是否压缩)"""
+        raw = text.encode("utf-8")
+        if self.threshold and len(raw) > self.threshold:
+            packed = zlib.compress(raw)
+            if len(packed) < len(raw):
+                return packed, 1
+        return text, 0
+
+    @staticmethod
+    def decode(body, compressed):
+        return zlib.decompress(body).decode("utf-8") if compressed else body
+
+    def save(self, cursor, checkin_id, text):
+        """在打卡的事务中保存内容, 空内容不占用行"""
+        if not text:
+            return
+        body, compressed = self.encode(text)
+        cursor.execute("INSERT INTO t_checkin_content (checkin_id, compressed, body) VALUES (?, ?, ?)",
+                       (checkin_id, compressed, body))
+
+    def load(self, cursor, checkin_ids):
+        """按 checkin_id 读取内容, 返回 {checkin_id: 内容}, 没有内容的打卡不在结果中"""
+        if not checkin_ids:
+            return {}
+        placeholders = ",".join("?" * len(checkin_ids))
+        cursor.execute(f"""SELECT checkin_id, compressed, body FROM t_checkin_content
+                           WHERE checkin_id IN ({placeholders})""", tuple(checkin_ids))
+        return {checkin_id: self.decode(body, compressed) for checkin_id, compressed, body in cursor.fetchall()}
+
+    def migrate(self, db_path, batch_size=1000, pause=0.01):
+        """把旧版本存放在 t_checkin_log.content 中的内容迁移到 t_checkin_content
+
+        按 checkin_id 分批迁移, 每批一个事务; 新的打卡只写入内容表, 迁移期间可以正常打卡。
+        全部迁移后删除该列(需要 SQLite 3.35 及以上, 否则保留为全部为空的列)。
+
+        Returns:
+            int: 迁移的内容条数
+        """
+        start = time.perf_counter()
+        conn = None
+        moved = 0
+        last_id = 0
+        try:
+            conn = get_connection(db_path)
+            c = conn.cursor()
+            while True:
+                c.execute("""SELECT checkin_id, content FROM t_checkin_log
+                            WHERE checkin_id > ? ORDER BY checkin_id LIMIT ?""", (last_id, batch_size))
+                rows = c.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                rows = [(checkin_id, content) for checkin_id, content in rows if content]
+                c.executemany("""INSERT OR IGNORE INTO t_checkin_content (checkin_id, body, compressed)
+                                VALUES (?, ?, ?)""",
+                              [(checkin_id,) + self.encode(content) for checkin_id, content in rows])
+                c.executemany("UPDATE t_checkin_log SET content = NULL WHERE checkin_id = ?",
+                              [(checkin_id,) for checkin_id, _ in rows])
+                conn.commit()
+                moved += len(rows)
+                time.sleep(pause)
+
+            if sqlite3.sqlite_version_info >= (3, 35, 0):
+                c.execute("ALTER TABLE t_checkin_log DROP COLUMN content")
+                conn.commit()
+        finally:
+            if conn:
+                conn.close()
+        logger.info(f"[PKTracker] 打卡内容迁移完成: {moved}条, 耗时 {time.perf_counter() - start:.2f}s")
+        return moved
+
+
+checkin_content = ContentStore()
@@ -0,0 +1,199 @@
+from datetime import date, datetime, timedelta
+
+from plugins.PKTracker.consistency import register_aggregate
+
+# 时间窗口最多覆盖的天数, 每个用户每个任务最多累加这么多行
+MAX_WINDOW_DAYS = 366
+
+# 打卡: 打卡次数、各类积分都计入打卡当天
+UPSERT_CHECKIN = """
+    INSERT INTO t_daily_stats (task_id, day, user_id, checkins, points,
+                               base_points, first_points, consecutive_points, last_checkin)
+    VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?)
+    ON CONFLICT(task_id, day, user_id) DO UPDATE SET
+        checkins = checkins + 1,
+        points = points + excluded.points,
+        base_points = base_points + excluded.base_points,
+        first_points = first_points + excluded.first_points,
+        consecutive_points = consecutive_points + excluded.consecutive_points,
+        last_checkin = MAX(COALESCE(last_checkin, ''), excluded.last_checkin)
+"""
+
+# 周/月奖励: 计入被结算周期的最后一天, 与 t_bonus.create_time(该日 23:59:59, 本地时间)的日期一致
+UPSERT_SETTLEMENT = """
+    INSERT INTO t_daily_stats (task_id, day, user_id, points, week_points, month_points)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(task_id, day, user_id) DO UPDATE SET
+        points = points + excluded.points,
+        week_points = week_points + excluded.week_points,
+        month_points = month_points + excluded.month_points
+"""
+
+# 重新计分: 按积分记录 create_time 的日期累加积分的变化量, 打卡次数不变
+UPSERT_RESCORE = """
+    INSERT INTO t_daily_stats (task_id, day, user_id, points, base_points, first_points, consecutive_points)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(task_id, day, user_id) DO UPDATE SET
+        points = points + excluded.points,
+        base_points = base_points + excluded.base_points,
+        first_points = first_points + excluded.first_points,
+        consecutive_points = consecutive_points + excluded.consecutive_points
+"""
+
+# 按原始记录计算某个任务的日汇总, 打卡按 checkin_time 的日期、积分按 create_time 的日期归属
+EXPECTED_ROWS = """
+    SELECT task_id, day, user_id, SUM(checkins), SUM(points),
+           SUM(base_points), SUM(first_points), SUM(consecutive_points), SUM(week_points), SUM(month_points),
+           MAX(last_checkin)
+    FROM (
+        SELECT task_id, substr(checkin_time, 1, 10) AS day, user_id, COUNT(*) AS checkins, 0 AS points,
+               0 AS base_points, 0 AS first_points, 0 AS consecutive_points, 0 AS week_points, 0 AS month_points,
+               MAX(checkin_time) AS last_checkin
+        FROM t_checkin_log WHERE task_id = ?
+        GROUP BY user_id, day
+        UNION ALL
+        SELECT task_id, substr(create_time, 1, 10), user_id, 0, SUM(bonus_value),
+               SUM(CASE bonus_type WHEN 'base' THEN bonus_value ELSE 0 END),
+               SUM(CASE bonus_type WHEN 'first' THEN bonus_value ELSE 0 END),
+               SUM(CASE bonus_type WHEN 'consecutive' THEN bonus_value ELSE 0 END),
+               SUM(CASE bonus_type WHEN 'week' THEN bonus_value ELSE 0 END),
+               SUM(CASE bonus_type WHEN 'month' THEN bonus_value ELSE 0 END),
+               NULL
+        FROM t_bonus WHERE task_id = ?
+        GROUP BY user_id, substr(create_time, 1, 10)
+    )
+    GROUP BY task_id, day, user_id
+"""
+
+ACTUAL_ROWS = """
+    SELECT task_id, day, user_id, checkins, points,
+           base_points, first_points, consecutive_points, week_points, month_points, last_checkin
+    FROM t_daily_stats WHERE task_id = ?
+"""
+
+
+def record_checkin(cursor, task_id, user_id, checkin_time, bonus_details):
+    """在打卡的事务中累加日汇总
+
+    Args:
+        checkin_time: 打卡时间, '%Y-%m-%d %H:%M:%S' 格式
+        bonus_details: 本次打卡的积分明细 {积分类型: 分值}
+    """
+    base, first, consecutive = (bonus_details.get(key, 0) for key in ("base", "first", "consecutive"))
+    cursor.execute(UPSERT_CHECKIN, (task_id, checkin_time[:10], user_id, base + first + consecutive,
+                                    base, first, consecutive, checkin_time))
+
+
+def record_settlement(cursor, task_id, user_id, bonus_type, bonus_value, day):
+    """在周/月奖励结算的事务中累加日汇总, bonus_type 为 'week' 或 'month', day 为被结算周期的最后一天 'YYYY-MM-DD'"""
+    cursor.execute(UPSERT_SETTLEMENT, (task_id, day, user_id, bonus_value,
+                                       bonus_value if bonus_type == "week" else 0,
+                                       bonus_value if bonus_type == "month" else 0))
+
+
+def record_rescore(cursor, task_id, rows):
+    """在重新计分的事务中按积分变化量调整日汇总
+
+    Args:
+        rows: [(日期, user_id, 基础积分变化, 首次打卡积分变化, 连续打卡积分变化)], 日期为 'YYYY-MM-DD'
+    """
+    cursor.executemany(UPSERT_RESCORE, [(task_id, day, user_id, base + first + consecutive, base, first, consecutive)
+                                        for day, user_id, base, first, consecutive in rows])
+    # 积分减少后, 没有打卡也没有积分的行与按原始记录计算的结果不一致, 需要删除
+    cursor.executemany("""DELETE FROM t_daily_stats
+                          WHERE task_id = ? AND day = ? AND user_id = ? AND checkins = 0
+                          AND points = 0 AND week_points = 0 AND month_points = 0""",
+                       [(task_id, day, user_id) for day, user_id, base, first, consecutive in rows
+                        if min(base, first, consecutive) < 0])
+
+
+def parse_window(text, today=None):
+    """解析积分榜的时间窗口
+
+    支持 今天/昨天/本周/上周/本月/上月/今年、N天(最近 N 天, 含今天)以及 2024-01-01~2024-01-31。
+
+    Returns:
+        tuple: (开始日期, 结束日期, 展示名称), 日期为 'YYYY-MM-DD' 字符串
+
+    Raises:
+        ValueError: 无法识别或超过 MAX_WINDOW_DAYS 天
+    """
+    today = today or date.today()
+    text = text.strip()
+    if text in ("今天", "今日"):
+        start = end = today
+    elif text == "昨天":
+        start = end = today - timedelta(days=1)
+    elif text == "本周":
+        start, end = today - timedelta(days=today.weekday()), today
+    elif text == "上周":
+        end = today - timedelta(days=today.weekday() + 1)
+        start = end - timedelta(days=6)
+    elif text == "本月":
+        start, end = today.replace(day=1), today
+    elif text == "上月":
+        end = today.replace(day=1) - timedelta(days=1)
+        start = end.replace(day=1)
+    elif text == "今年":
+        start, end = today.replace(month=1, day=1), today
+    elif text.endswith("天") and text[:-1].isdigit():
+        days = int(text[:-1])
+        if not 1 <= days <= MAX_WINDOW_DAYS:
+            raise ValueError(f"天数需在 1~{MAX_WINDOW_DAYS} 之间")
+        start, end = today - timedelta(days=days - 1), today
+        return start.isoformat(), end.isoformat(), f"最近{days}天"
+    elif "~" in text:
+        first, _, last = text.partition("~")
+        try:
+            start = datetime.strptime(first.strip(), '%Y-%m-%d').date()
+            end = datetime.strptime(last.strip(), '%Y-%m-%d').date()
+        except ValueError:
+            raise ValueError("日期格式应为 YYYY-MM-DD~YYYY-MM-DD")
+        if start > end:
+            raise ValueError("开始日期不能晚于结束日期")
+        if (end - start).days + 1 > MAX_WINDOW_DAYS:
+            raise ValueError(f"时间范围不能超过 {MAX_WINDOW_DAYS} 天")
+        return start.isoformat(), end.isoformat(), f"{start.isoformat()}~{end.isoformat()}"
+    else:
+        raise ValueError("时间范围应为 今天/昨天/本周/上周/本月/上月/今年/N天/YYYY-MM-DD~YYYY-MM-DD")
+    return start.isoformat(), end.isoformat(), text
+
+
+def _expected_rows(cursor, task_id):
+    cursor.execute(EXPECTED_ROWS, (task_id, task_id))
+    return cursor.fetchall()
+
+
+def rebuild_task(cursor, task_id):
+    """按原始记录重新计算一个任务的日汇总, 返回写入的行数; 调用方负责提交"""
+    # 先执行 DELETE 开启写事务, 计算期间不会有新的打卡提交
+    cursor.execute("DELETE FROM t_daily_stats WHERE task_id = ?", (task_id,))
+    rows = _expected_rows(cursor, task_id)
+    cursor.executemany("""
+        INSERT INTO t_daily_stats (task_id, day, user_id, checkins, points,
+                                   base_points, first_points, consecutive_points, week_points, month_points,
+                                   last_checkin)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    return len(rows)
+
+
+def _actual_rows(cursor, task_id):
+    cursor.execute(ACTUAL_ROWS, (task_id,))
+    return cursor.fetchall()
+
+
+aggregate = register_aggregate("t_daily_stats", _expected_rows, _actual_rows, rebuild_task, "日汇总")
+
+
+class DailyStats:
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def backfill(self, pause=0.01):
+        """按历史记录回填所有任务的日汇总
+
+        Returns:
+            int: 写入的行数
+        """
+        return aggregate.backfill(self.db_path, pause)
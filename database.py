@@ -1,14 +1,125 @@
+import os
 import sqlite3
+import time
+from urllib.request import pathname2url
+
+from common.log import logger
+from plugins.PKTracker.metrics import metrics, normalize_sql
+from plugins.PKTracker.slow_query import slow_queries
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """记录每条 SQL 耗时的游标, 耗时包含 execute 和随后的 fetch"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sql = None
+        self._params = ()
+        self._elapsed = 0.0
+
+    def _flush(self):
+        if self._sql is not None:
+            sql, params, elapsed = self._sql, self._params, self._elapsed
+            self._sql = None
+            self._params = ()
+            self._elapsed = 0.0
+            metrics.record("sql", normalize_sql(sql), elapsed)
+            if elapsed >= slow_queries.threshold:
+                slow_queries.observe(self.connection, self.connection.db_path, sql, params, elapsed)
+
+    def _run(self, method, sql, params):
+        self._flush()
+        start = time.perf_counter()
+        try:
+            return method(sql, params)
+        finally:
+            self._sql = sql
+            self._params = params
+            self._elapsed = time.perf_counter() - start
+
+    def execute(self, sql, params=()):
+        return self._run(super().execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        # 参数可能是生成器, 慢查询只需要第一组参数来生成执行计划
+        seq_of_params = list(seq_of_params)
+        self._run(super().executemany, sql, seq_of_params)
+        self._params = seq_of_params[0] if seq_of_params else ()
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._elapsed += time.perf_counter() - start
+        if row is None:
+            self._flush()
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        start = time.perf_counter()
+        rows = super().fetchmany(*args, **kwargs)
+        self._elapsed += time.perf_counter() - start
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._elapsed += time.perf_counter() - start
+        self._flush()
+        return rows
+
+    def close(self):
+        self._flush()
+        super().close()
+
+    def __del__(self):
+        self._flush()
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self.db_path = database
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+
+def get_connection(db_path, readonly=False):
+    """打开数据库连接, 开启性能统计或慢查询记录时每条 SQL 的耗时都会被记录
+
+    Args:
+        db_path: 数据库文件路径
+        readonly: 是否打开只读连接。排行榜、任务详情等只读查询使用只读连接(mode=ro 且 query_only),
+            在 WAL 模式下读不会阻塞打卡等写操作的提交, 误写也会直接报错
+    """
+    database, uri = db_path, False
+    if readonly:
+        database, uri = f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro", True
+    if metrics.enabled or slow_queries.enabled:
+        conn = sqlite3.connect(database, uri=uri, factory=InstrumentedConnection)
+        # 慢查询在连接关闭后需要用文件路径重新打开数据库
+        conn.db_path = db_path
+    else:
+        conn = sqlite3.connect(database, uri=uri)
+    if readonly:
+        conn.execute("PRAGMA query_only = 1")
+    return conn
+
 
 class DatabaseManager:
-    def __init__(self, db_path):
+    def __init__(self, db_path, wal=True):
         self.db_path = db_path
+        self.wal = wal
         self.init_database()
 
     def init_database(self):
         """初始化数据库表结构"""
-        conn = sqlite3.connect(self.db_path)
+        conn = get_connection(self.db_path)
         c = conn.cursor()
+
+        # WAL 模式下读写互不阻塞, 设置会持久化在数据库文件中
+        c.execute(f"PRAGMA journal_mode = {'WAL' if self.wal else 'DELETE'}")
     
         # 修改任务表,添加 max_checkins 字段
         c.execute('''CREATE TABLE IF NOT EXISTS t_task
@@ -30,7 +141,13 @@ class DatabaseManager:
                         remind_text TEXT,
                         enable INTEGER DEFAULT 1,
                         create_time DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        update_time DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+                        update_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        reward_rules TEXT)''')
+
+        # 旧版本的任务表没有 reward_rules 字段, 保存附加奖励规则(JSON), 见 reward_rules.compile_rules
+        c.execute("PRAGMA table_info(t_task)")
+        if "reward_rules" not in {row[1] for row in c.fetchall()}:
+            c.execute("ALTER TABLE t_task ADD COLUMN reward_rules TEXT")
     
         # 创建打卡记录表
         c.execute('''CREATE TABLE IF NOT EXISTS t_checkin_log
@@ -38,11 +155,36 @@ class DatabaseManager:
                         task_id INTEGER,
                         user_id TEXT NOT NULL,
                         checkin_time DATETIME NOT NULL,
-                        content TEXT,
                         create_time DATETIME DEFAULT CURRENT_TIMESTAMP,
                         update_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        msg_id TEXT,
                         FOREIGN KEY(task_id) REFERENCES t_task(task_id))''')
     
+        # 旧版本的打卡记录表没有 msg_id 字段, 用于识别通道重复投递的消息
+        c.execute("PRAGMA table_info(t_checkin_log)")
+        columns = {row[1] for row in c.fetchall()}
+        if "msg_id" not in columns:
+            c.execute("ALTER TABLE t_checkin_log ADD COLUMN msg_id TEXT")
+        # 旧版本的打卡内容存放在打卡记录表中, 启动后迁移到打卡内容表
+        self.inline_content = "content" in columns
+
+        # 创建打卡内容表, 打卡记录表只保留定长的字段, 按任务/用户/时间扫描时不会读入内容
+        c.execute('''CREATE TABLE IF NOT EXISTS t_checkin_content
+                       (checkin_id INTEGER PRIMARY KEY,
+                        compressed INTEGER NOT NULL DEFAULT 0,
+                        body BLOB NOT NULL)''')
+
+        # 创建打卡内容全文索引, trigram 分词不需要中文分词就能按子串搜索
+        # 需要 SQLite 3.34 及以上并启用 FTS5, 不满足时不提供搜索功能
+        c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='t_checkin_fts'")
+        self.checkin_fts_created = c.fetchone() is None
+        try:
+            c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS t_checkin_fts USING fts5(body, tokenize='trigram')")
+            self.fts_enabled = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"[PKTracker] 当前 SQLite 不支持 FTS5 trigram 分词, 搜索打卡不可用: {e}")
+            self.fts_enabled = self.checkin_fts_created = False
+    
         # 创建管理员表
         c.execute('''CREATE TABLE IF NOT EXISTS t_admin
                        (group_id TEXT NOT NULL,
@@ -64,6 +206,112 @@ class DatabaseManager:
                         FOREIGN KEY(task_id) REFERENCES t_task(task_id),
                         FOREIGN KEY(checkin_id) REFERENCES t_checkin_log(checkin_id))''')
     
+        # 创建调度器租约表, 多进程部署时用于选出唯一执行定时任务的进程
+        c.execute('''CREATE TABLE IF NOT EXISTS t_scheduler_lease
+                       (name TEXT PRIMARY KEY,
+                        holder TEXT NOT NULL,
+                        term INTEGER NOT NULL,
+                        acquired_at REAL NOT NULL,
+                        heartbeat_at REAL NOT NULL,
+                        expires_at REAL NOT NULL)''')
+    
+        # 创建任务清理表, 删除任务后其打卡和积分记录由后台任务分批清理
+        c.execute('''CREATE TABLE IF NOT EXISTS t_task_purge
+                       (task_id INTEGER PRIMARY KEY,
+                        group_id TEXT NOT NULL,
+                        task_name TEXT NOT NULL,
+                        total_rows INTEGER NOT NULL DEFAULT 0,
+                        deleted_rows INTEGER NOT NULL DEFAULT 0,
+                        status TEXT CHECK(status IN ('pending','done')) DEFAULT 'pending',
+                        create_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        finish_time DATETIME)''')
+    
+        # 创建打卡日汇总表, 打卡和周/月结算时在同一事务中维护, 用于按时间范围统计排行榜
+        c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='t_daily_stats'")
+        self.daily_stats_created = c.fetchone() is None
+        c.execute('''CREATE TABLE IF NOT EXISTS t_daily_stats
+                       (task_id INTEGER NOT NULL,
+                        day TEXT NOT NULL,
+                        user_id TEXT NOT NULL,
+                        checkins INTEGER NOT NULL DEFAULT 0,
+                        points INTEGER NOT NULL DEFAULT 0,
+                        base_points INTEGER NOT NULL DEFAULT 0,
+                        first_points INTEGER NOT NULL DEFAULT 0,
+                        consecutive_points INTEGER NOT NULL DEFAULT 0,
+                        week_points INTEGER NOT NULL DEFAULT 0,
+                        month_points INTEGER NOT NULL DEFAULT 0,
+                        last_checkin TEXT,
+                        PRIMARY KEY(task_id, day, user_id)) WITHOUT ROWID''')
+    
+        # 创建打卡日历表, 每个 (任务, 用户, 年份) 一个 366 位的位图, 第 i 位表示该年第 i+1 天打过卡
+        c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='t_checkin_calendar'")
+        self.checkin_calendar_created = c.fetchone() is None
+        c.execute('''CREATE TABLE IF NOT EXISTS t_checkin_calendar
+                       (task_id INTEGER NOT NULL,
+                        user_id TEXT NOT NULL,
+                        year INTEGER NOT NULL,
+                        bits BLOB NOT NULL,
+                        PRIMARY KEY(task_id, user_id, year)) WITHOUT ROWID''')
+    
+        # 创建群版本号表, 群内排行数据变化时由触发器加 1, 全局排行榜据此判断各群的缓存是否失效
+        c.execute('''CREATE TABLE IF NOT EXISTS t_group_version
+                       (group_id TEXT PRIMARY KEY,
+                        version INTEGER NOT NULL DEFAULT 0)''')
+    
+        # 创建任务统计表, 打卡时在同一事务中更新, 任务详情只读取一行
+        # day 为当日计数(today_users / today_checkins / streak_*)对应的日期, 读取时按日期换算, 不需要定时清零
+        c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='t_task_stats'")
+        self.task_stats_created = c.fetchone() is None
+        c.execute('''CREATE TABLE IF NOT EXISTS t_task_stats
+                       (task_id INTEGER PRIMARY KEY,
+                        participants INTEGER NOT NULL DEFAULT 0,
+                        checkins INTEGER NOT NULL DEFAULT 0,
+                        last_checkin TEXT NOT NULL DEFAULT '',
+                        day TEXT NOT NULL,
+                        today_users INTEGER NOT NULL DEFAULT 0,
+                        streak_today INTEGER NOT NULL DEFAULT 0,
+                        streak_prev INTEGER NOT NULL DEFAULT 0,
+                        streak_carried INTEGER NOT NULL DEFAULT 0,
+                        today_checkins INTEGER NOT NULL DEFAULT 0)''')
+        # 旧版本的任务统计没有当日打卡次数(首次打卡奖励据此判断名次), 添加后与新建一样在启动时回填
+        c.execute("PRAGMA table_info(t_task_stats)")
+        if "today_checkins" not in {row[1] for row in c.fetchall()}:
+            c.execute("ALTER TABLE t_task_stats ADD COLUMN today_checkins INTEGER NOT NULL DEFAULT 0")
+            self.task_stats_created = True
+    
+        # 创建用户累计数据表, 由日汇总表上的触发器维护, 用于累计积分榜分页和查询个人排名
+        c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='t_user_total'")
+        self.user_total_created = c.fetchone() is None
+        c.execute('''CREATE TABLE IF NOT EXISTS t_user_total
+                       (task_id INTEGER NOT NULL,
+                        user_id TEXT NOT NULL,
+                        group_id TEXT NOT NULL,
+                        checkins INTEGER NOT NULL DEFAULT 0,
+                        points INTEGER NOT NULL DEFAULT 0,
+                        last_checkin TEXT NOT NULL DEFAULT '',
+                        seq INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY(task_id, user_id)) WITHOUT ROWID''')
+
+        # 创建重新计分记录表, 重新计分改写历史积分时在同一事务中写入, 分析库同步时据此重新复制该任务的积分记录
+        c.execute('''CREATE TABLE IF NOT EXISTS t_rescore_log
+                       (rescore_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        task_id INTEGER NOT NULL,
+                        create_time DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+
+        # 创建索引
+        c.execute("CREATE INDEX IF NOT EXISTS idx_task_group_name ON t_task(group_id, task_name)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_checkin_task_user_time ON t_checkin_log(task_id, user_id, checkin_time)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_checkin_task_time ON t_checkin_log(task_id, checkin_time)")
+        # 同一条消息只能产生一条打卡记录, 没有消息 ID 的打卡不受限制
+        c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS idx_checkin_msg ON t_checkin_log(msg_id)
+                   WHERE msg_id IS NOT NULL""")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_user_total_group_seq ON t_user_total(group_id, seq)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_bonus_checkin ON t_bonus(checkin_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_bonus_task ON t_bonus(task_id)")
+        # 部分索引只包含周/月奖励, 几乎不增加打卡写入的开销
+        c.execute("""CREATE INDEX IF NOT EXISTS idx_bonus_settlement ON t_bonus(task_id, bonus_type, create_time)
+                   WHERE bonus_type IN ('week', 'month')""")
+    
         # 创建触发器,用于自动更新update_time
         c.execute('''CREATE TRIGGER IF NOT EXISTS tg_task_update 
                    AFTER UPDATE ON t_task
@@ -79,6 +327,20 @@ class DatabaseManager:
                        WHERE checkin_id = NEW.checkin_id;
                    END;''')
     
+        # 打卡记录删除时(清理已删除的任务、一致性修复)同时删除内容
+        c.execute('''CREATE TRIGGER IF NOT EXISTS tg_checkin_log_delete_content
+                   AFTER DELETE ON t_checkin_log
+                   BEGIN
+                       DELETE FROM t_checkin_content WHERE checkin_id = OLD.checkin_id;
+                   END;''')
+
+        if self.fts_enabled:
+            c.execute('''CREATE TRIGGER IF NOT EXISTS tg_checkin_log_delete_fts
+                       AFTER DELETE ON t_checkin_log
+                       BEGIN
+                           DELETE FROM t_checkin_fts WHERE rowid = OLD.checkin_id;
+                       END;''')
+    
         c.execute('''CREATE TRIGGER IF NOT EXISTS tg_admin_update 
                    AFTER UPDATE ON t_admin
                    BEGIN
@@ -93,5 +355,69 @@ class DatabaseManager:
                        WHERE bonus_id = NEW.bonus_id;
                    END;''')
     
+        # 日汇总变化时递增所属群的版本号, 并同步用户累计数据。两步放在同一个触发器中保证先后顺序:
+        # 先加版本号再把它写入 seq, 每次变化的 seq 都大于之前所有的 seq, 排名索引据此只读取变化的行
+        c.execute("DROP TRIGGER IF EXISTS tg_daily_stats_insert_version")
+        c.execute("DROP TRIGGER IF EXISTS tg_daily_stats_update_version")
+        c.execute("DROP TRIGGER IF EXISTS tg_daily_stats_delete_version")
+        bump_version = """
+                       INSERT INTO t_group_version (group_id, version)
+                       SELECT group_id, 1 FROM t_task WHERE task_id = {row}.task_id
+                       ON CONFLICT(group_id) DO UPDATE SET version = version + 1;"""
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS tg_daily_stats_insert
+                   AFTER INSERT ON t_daily_stats
+                   BEGIN{bump_version.format(row="NEW")}
+                       INSERT INTO t_user_total (task_id, user_id, group_id, checkins, points, last_checkin, seq)
+                       SELECT NEW.task_id, NEW.user_id, t.group_id, NEW.checkins, NEW.points,
+                              COALESCE(NEW.last_checkin, ''), v.version
+                       FROM t_task t JOIN t_group_version v ON v.group_id = t.group_id
+                       WHERE t.task_id = NEW.task_id
+                       ON CONFLICT(task_id, user_id) DO UPDATE SET
+                           checkins = checkins + excluded.checkins,
+                           points = points + excluded.points,
+                           last_checkin = MAX(last_checkin, excluded.last_checkin),
+                           seq = excluded.seq;
+                   END;''')
+    
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS tg_daily_stats_update
+                   AFTER UPDATE ON t_daily_stats
+                   BEGIN{bump_version.format(row="NEW")}
+                       UPDATE t_user_total SET
+                           checkins = checkins + NEW.checkins - OLD.checkins,
+                           points = points + NEW.points - OLD.points,
+                           last_checkin = MAX(last_checkin, COALESCE(NEW.last_checkin, '')),
+                           seq = COALESCE((SELECT version FROM t_group_version v
+                                           WHERE v.group_id = t_user_total.group_id), 0)
+                       WHERE task_id = NEW.task_id AND user_id = NEW.user_id;
+                   END;''')
+    
+        # 删除只发生在重建和清理任务时, 这时会删除任务的全部日汇总, 减到 0 的用户同时清空最后打卡时间
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS tg_daily_stats_delete
+                   AFTER DELETE ON t_daily_stats
+                   BEGIN{bump_version.format(row="OLD")}
+                       UPDATE t_user_total SET
+                           checkins = checkins - OLD.checkins,
+                           points = points - OLD.points,
+                           last_checkin = CASE WHEN checkins = OLD.checkins AND points = OLD.points
+                                               THEN '' ELSE last_checkin END,
+                           seq = COALESCE((SELECT version FROM t_group_version v
+                                           WHERE v.group_id = t_user_total.group_id), 0)
+                       WHERE task_id = OLD.task_id AND user_id = OLD.user_id;
+                   END;''')
+    
+        c.execute('''CREATE TRIGGER IF NOT EXISTS tg_task_update_version
+                   AFTER UPDATE OF enable, task_name ON t_task
+                   BEGIN
+                       INSERT INTO t_group_version (group_id, version) VALUES (NEW.group_id, 1)
+                       ON CONFLICT(group_id) DO UPDATE SET version = version + 1;
+                   END;''')
+    
+        c.execute('''CREATE TRIGGER IF NOT EXISTS tg_task_delete_version
+                   AFTER DELETE ON t_task
+                   BEGIN
+                       INSERT INTO t_group_version (group_id, version) VALUES (OLD.group_id, 1)
+                       ON CONFLICT(group_id) DO UPDATE SET version = version + 1;
+                   END;''')
+    
         conn.commit()
         conn.close()
\ No newline at end of file
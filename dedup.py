@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+
+class RecentResults:
+    """最近处理过的消息 ID 及其回复
+
+    微信通道断线重连后可能重复投递同一条消息。打卡的回复按消息 ID 缓存在有容量上限的 LRU 中,
+    重复投递直接返回第一次的回复而不访问数据库; 进程重启或被淘汰后由 t_checkin_log.msg_id 上的唯一索引兜底。
+    """
+
+    def __init__(self, max_size=4096):
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self.configure(max_size)
+
+    def configure(self, max_size=4096):
+        """设置缓存容量, 0 表示关闭内存缓存(数据库唯一索引仍然生效)"""
+        with self._lock:
+            self.max_size = max_size
+            self._results.clear()
+            self._reset_stats()
+
+    def reset(self):
+        """清空统计(不影响缓存内容)"""
+        with self._lock:
+            self._reset_stats()
+
+    def _reset_stats(self):
+        self.since = datetime.now()
+        self.stats = {"memory_hits": 0, "db_hits": 0}
+
+    def get(self, msg_id):
+        """返回该消息第一次处理时的回复, 未处理过返回 None"""
+        if not msg_id or not self.max_size:
+            return None
+        with self._lock:
+            reply = self._results.get(msg_id)
+            if reply is not None:
+                self._results.move_to_end(msg_id)
+                self.stats["memory_hits"] += 1
+            return reply
+
+    def put(self, msg_id, reply):
+        if not msg_id or not self.max_size:
+            return
+        with self._lock:
+            self._results[msg_id] = reply
+            self._results.move_to_end(msg_id)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+
+    def record_db_hit(self):
+        with self._lock:
+            self.stats["db_hits"] += 1
+
+    def format_report(self):
+        with self._lock:
+            stats, size = dict(self.stats), len(self._results)
+        return (f"🔁 重复消息 (自 {self.since.strftime('%Y-%m-%d %H:%M:%S')} 起):\n"
+                f"   - 内存命中: {stats['memory_hits']}次 | 数据库命中: {stats['db_hits']}次\n"
+                f"   - 缓存消息: {size}/{self.max_size}条")
+
+
+checkin_dedup = RecentResults()
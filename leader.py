@@ -0,0 +1,120 @@
+import os
+import socket
+import threading
+import time
+import uuid
+
+from common.log import logger
+from plugins.PKTracker.database import get_connection
+
+# 租约记录的名称, 同一个数据库中所有进程竞争同一行
+LEASE_NAME = "scheduler"
+
+
+class SchedulerLease:
+    """基于 SQLite 租约行的调度器选主
+
+    多个进程共用同一个数据库时, 只有持有租约的进程执行定时任务。持有者每隔 heartbeat_interval 秒续约一次,
+    租约在 ttl 秒内没有续约即视为失效, 其他进程在下一次心跳时接管。每次换主 term 加 1,
+    执行任务前再次续约, 续约失败(租约已被接管)则放弃本次执行。
+
+    心跳使用独立线程而不是调度器任务: 调度器只有一个工作线程, 耗时较长的任务会阻塞心跳导致租约被误接管。
+    """
+
+    def __init__(self, db_path, ttl=15, heartbeat_interval=5, holder=None):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.term = None
+        self._is_leader = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_leader(self):
+        return self._is_leader
+
+    def try_acquire(self):
+        """获取或续约租约, 返回当前是否为主"""
+        now = time.time()
+        conn = None
+        try:
+            conn = get_connection(self.db_path)
+            c = conn.cursor()
+            # 租约属于自己或已过期时才会更新, 整个判断在一条语句中完成
+            c.execute("""
+                INSERT INTO t_scheduler_lease (name, holder, term, acquired_at, heartbeat_at, expires_at)
+                VALUES (?, ?, 1, ?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    term = CASE WHEN holder = excluded.holder THEN term ELSE term + 1 END,
+                    acquired_at = CASE WHEN holder = excluded.holder THEN acquired_at ELSE excluded.acquired_at END,
+                    holder = excluded.holder,
+                    heartbeat_at = excluded.heartbeat_at,
+                    expires_at = excluded.expires_at
+                WHERE holder = excluded.holder OR expires_at < excluded.heartbeat_at
+            """, (LEASE_NAME, self.holder, now, now, now + self.ttl))
+            c.execute("SELECT holder, term FROM t_scheduler_lease WHERE name = ?", (LEASE_NAME,))
+            holder, term = c.fetchone()
+            conn.commit()
+            leader = holder == self.holder
+        except Exception as e:
+            # 数据库暂时不可用时不能确认租约仍然有效, 按失去主身份处理
+            logger.warning(f"[PKTracker] 调度器续约失败: {str(e)}")
+            leader, term = False, None
+        finally:
+            if conn:
+                conn.close()
+
+        with self._lock:
+            if leader and not self._is_leader:
+                logger.info(f"[PKTracker] 调度器成为主节点: {self.holder} (term {term})")
+            elif not leader and self._is_leader:
+                logger.warning(f"[PKTracker] 调度器失去主节点身份: {self.holder}")
+            self._is_leader = leader
+            self.term = term if leader else None
+        return leader
+
+    def release(self):
+        """主动释放租约, 其他进程无需等待过期即可接管"""
+        conn = None
+        try:
+            conn = get_connection(self.db_path)
+            c = conn.cursor()
+            # 只把租约置为过期而不删除记录, 保证 term 在整个生命周期内单调递增
+            c.execute("""
+                UPDATE t_scheduler_lease SET expires_at = 0
+                WHERE name = ? AND holder = ?
+            """, (LEASE_NAME, self.holder))
+            conn.commit()
+        except Exception as e:
+            logger.warning(f"[PKTracker] 释放调度器租约失败: {str(e)}")
+        finally:
+            if conn:
+                conn.close()
+        with self._lock:
+            self._is_leader = False
+            self.term = None
+
+    def start(self):
+        """启动心跳线程"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self.try_acquire()
+        self._thread = threading.Thread(target=self._heartbeat, name="PKTracker-lease", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止心跳并释放租约"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.heartbeat_interval)
+            self._thread = None
+        if self._is_leader:
+            self.release()
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            self.try_acquire()
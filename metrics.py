@@ -0,0 +1,171 @@
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+# 直方图桶的上界(毫秒), 最后一个桶收集所有更慢的调用
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf"))
+
+# 每类指标最多保留的名称数, 超出的归入 "其他"
+MAX_NAMES_PER_KIND = 500
+
+KIND_TITLES = {
+    "command": "命令",
+    "job": "定时任务",
+    "sql": "SQL",
+    "http": "gewechat 接口",
+}
+
+_NUMBER_RE = re.compile(r"\b\d+\b")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_sql(sql: str) -> str:
+    """归一化 SQL 文本: 合并空白, 把内联的数字替换为 ?"""
+    return _NUMBER_RE.sub("?", _SPACE_RE.sub(" ", sql).strip())
+
+
+class Histogram:
+    """固定对数桶的耗时直方图"""
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS_MS)
+
+    def add(self, ms: float):
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+
+    def percentile(self, pct: float) -> float:
+        """按桶估算分位数, 返回所在桶的上界(最后一个桶返回最大值)"""
+        if not self.count:
+            return 0.0
+        target = self.count * pct / 100
+        seen = 0
+        for bound, n in zip(BUCKETS_MS, self.buckets):
+            seen += n
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_ms": round(self.total, 3),
+            "avg_ms": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "max_ms": round(self.max, 3),
+            "buckets": {("inf" if b == float("inf") else str(b)): n
+                        for b, n in zip(BUCKETS_MS, self.buckets) if n},
+        }
+
+
+class Metrics:
+    """进程内的耗时统计
+
+    按 (类别, 名称) 聚合耗时直方图, 类别包括命令、定时任务、SQL 语句和 gewechat 接口调用。
+    所有数据只保存在内存中, 可以通过 dump() 导出为 JSON 文件。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+        self.enabled = True
+        self.since = datetime.now()
+
+    def record(self, kind: str, name: str, seconds: float):
+        """记录一次耗时"""
+        if not self.enabled:
+            return
+        ms = seconds * 1000
+        with self._lock:
+            names = self._data.setdefault(kind, {})
+            hist = names.get(name)
+            if hist is None:
+                if len(names) >= MAX_NAMES_PER_KIND:
+                    name = "其他"
+                hist = names.setdefault(name, Histogram())
+            hist.add(ms)
+
+    @contextmanager
+    def timer(self, kind: str, name: str):
+        """计时上下文, 异常也会被计入"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(kind, name, time.perf_counter() - start)
+
+    def timed(self, kind: str, name: str = None):
+        """计时装饰器, 默认以函数名作为指标名称"""
+
+        def decorator(func):
+            metric_name = name or func.__name__
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(kind, metric_name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def reset(self):
+        with self._lock:
+            self._data = {}
+            self.since = datetime.now()
+
+    def snapshot(self) -> dict:
+        """返回所有指标的快照, 每类按总耗时降序"""
+        with self._lock:
+            data = {kind: {name: hist.to_dict() for name, hist in names.items()}
+                    for kind, names in self._data.items()}
+        return {
+            "since": self.since.strftime('%Y-%m-%d %H:%M:%S'),
+            "generated": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "metrics": {kind: dict(sorted(names.items(), key=lambda kv: kv[1]["total_ms"], reverse=True))
+                        for kind, names in data.items()},
+        }
+
+    def dump(self, path: str) -> str:
+        """把快照写入 JSON 文件, 返回文件路径"""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+        return path
+
+    def format_report(self, top: int = 10) -> str:
+        """生成适合在群里发送的统计摘要"""
+        snapshot = self.snapshot()
+        message = f"📈 性能统计 (自 {snapshot['since']} 起)\n"
+        message += "==================="
+        if not snapshot["metrics"]:
+            return message + "\n\n暂无数据"
+
+        for kind, title in KIND_TITLES.items():
+            names = snapshot["metrics"].get(kind)
+            if not names:
+                continue
+            message += f"\n\n🔸 {title}:"
+            for name, stats in list(names.items())[:top]:
+                label = name if len(name) <= 60 else name[:57] + "..."
+                message += (f"\n   - {label}: {stats['count']}次 | 平均 {stats['avg_ms']:.1f}ms"
+                            f" | p95 {stats['p95_ms']:.1f}ms | 最大 {stats['max_ms']:.1f}ms")
+        return message
+
+
+metrics = Metrics()
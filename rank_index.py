@@ -0,0 +1,201 @@
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+from plugins.PKTracker.consistency import register_aggregate
+
+# 内存中最多保留排名索引的群数
+RANK_INDEX_GROUPS = 1024
+
+# 按日汇总表计算一个任务每个用户的累计数据, seq 取所属群当前的版本号
+EXPECTED_ROWS = """
+    SELECT s.task_id, s.user_id, t.group_id, SUM(s.checkins), SUM(s.points), COALESCE(MAX(s.last_checkin), '')
+    FROM t_daily_stats s
+    JOIN t_task t ON t.task_id = s.task_id
+    WHERE s.task_id = ?
+    GROUP BY s.user_id
+    HAVING SUM(s.checkins) > 0 OR SUM(s.points) > 0
+"""
+
+ACTUAL_ROWS = """
+    SELECT task_id, user_id, group_id, checkins, points, last_checkin
+    FROM t_user_total
+    WHERE task_id = ? AND (checkins > 0 OR points > 0)
+"""
+
+
+def rank_key(points, last_checkin, user_id):
+    """排名顺序: 积分降序, 最后打卡时间升序, 用户 ID 升序, 与积分榜一致"""
+    return -points, last_checkin, user_id
+
+
+class _GroupRanks:
+    """一个群的累计数据和按任务范围排好序的索引"""
+
+    def __init__(self):
+        self.seq = -1
+        # user_id -> {task_id: (打卡次数, 积分, 最后打卡时间)}
+        self.totals = {}
+        # 任务范围(task_id 元组) -> (有序的排名键列表, {user_id: 排名键})
+        self.scopes = {}
+
+    def apply(self, rows):
+        """合并 seq 之后变化的累计数据, 已建好的索引只更新变化的用户"""
+        changed = set()
+        for task_id, user_id, checkins, points, last_checkin, seq in rows:
+            self.totals.setdefault(user_id, {})[task_id] = (checkins, points, last_checkin)
+            changed.add(user_id)
+            self.seq = max(self.seq, seq)
+        for scope, (keys, key_of) in self.scopes.items():
+            for user_id in changed:
+                old = key_of.pop(user_id, None)
+                if old is not None:
+                    del keys[bisect_left(keys, old)]
+                key = self._key(user_id, scope)
+                if key is not None:
+                    insort(keys, key)
+                    key_of[user_id] = key
+
+    def scope(self, task_ids):
+        """返回任务范围的索引, 第一次使用时用全部用户构建"""
+        if task_ids not in self.scopes:
+            key_of = {}
+            for user_id in self.totals:
+                key = self._key(user_id, task_ids)
+                if key is not None:
+                    key_of[user_id] = key
+            self.scopes[task_ids] = (sorted(key_of.values()), key_of)
+        return self.scopes[task_ids]
+
+    def summary(self, user_id, task_ids):
+        """用户在任务范围内的 (打卡次数, 积分, 最后打卡时间)"""
+        checkins, points, last_checkin = 0, 0, ""
+        for task_id, (task_checkins, task_points, task_last) in self.totals.get(user_id, {}).items():
+            if task_id in task_ids:
+                checkins += task_checkins
+                points += task_points
+                last_checkin = max(last_checkin, task_last)
+        return checkins, points, last_checkin
+
+    def _key(self, user_id, task_ids):
+        checkins, points, last_checkin = self.summary(user_id, task_ids)
+        if not checkins and not points:
+            return None
+        return rank_key(points, last_checkin, user_id)
+
+
+class RankIndex:
+    """按群维护的累计积分排名索引
+
+    t_user_total 由日汇总表上的触发器维护, 每行的 seq 取自所属群的版本号, 群内严格递增。
+    每次查询只读取该群 seq 大于上次读取位置的行并更新内存中的有序列表, 之后的排名查询是一次二分查找,
+    分页和上下相邻的用户直接按下标切片, 与群内参与人数无关。多个进程共用数据库时各自按 seq 追赶, 不需要额外通知。
+    """
+
+    def __init__(self, max_groups=RANK_INDEX_GROUPS):
+        self.max_groups = max_groups
+        self._lock = threading.Lock()
+        self._groups = OrderedDict()
+
+    def _refresh(self, cursor, group_id):
+        ranks = self._groups.get(group_id)
+        if ranks is None:
+            ranks = self._groups[group_id] = _GroupRanks()
+        self._groups.move_to_end(group_id)
+        while len(self._groups) > self.max_groups:
+            self._groups.popitem(last=False)
+        cursor.execute("""SELECT task_id, user_id, checkins, points, last_checkin, seq FROM t_user_total
+                          WHERE group_id = ? AND seq > ? ORDER BY seq""", (group_id, ranks.seq))
+        ranks.apply(cursor.fetchall())
+        return ranks
+
+    def page(self, cursor, group_id, task_ids, offset, limit):
+        """按排名顺序取一页
+
+        Returns:
+            tuple: (参与人数, [(user_id, 打卡次数, 积分, 最后打卡时间, {task_id: (打卡次数, 积分)})])
+        """
+        task_ids = tuple(sorted(task_ids))
+        with self._lock:
+            ranks = self._refresh(cursor, group_id)
+            keys, _ = ranks.scope(task_ids)
+            rows = [self._row(ranks, key[2], task_ids) for key in keys[offset:offset + limit]]
+            return len(keys), rows
+
+    def around(self, cursor, group_id, task_ids, user_id, radius):
+        """查询用户的名次以及上下各 radius 名用户
+
+        Returns:
+            tuple: (名次, 参与人数, 第一个相邻用户的名次, 相邻用户列表), 用户没有记录时名次为 None
+        """
+        task_ids = tuple(sorted(task_ids))
+        with self._lock:
+            ranks = self._refresh(cursor, group_id)
+            keys, key_of = ranks.scope(task_ids)
+            key = key_of.get(user_id)
+            if key is None:
+                return None, len(keys), 0, []
+            index = bisect_left(keys, key)
+            first = max(0, index - radius)
+            rows = [self._row(ranks, k[2], task_ids) for k in keys[first:index + radius + 1]]
+            return index + 1, len(keys), first + 1, rows
+
+    @staticmethod
+    def _row(ranks, user_id, task_ids):
+        checkins, points, last_checkin = ranks.summary(user_id, task_ids)
+        per_task = {task_id: total[:2] for task_id, total in ranks.totals[user_id].items()
+                    if task_id in task_ids and (total[0] or total[1])}
+        return user_id, checkins, points, last_checkin, per_task
+
+
+def rebuild_task(cursor, task_id):
+    """按日汇总表重新计算一个任务的累计数据, 返回写入的行数; 调用方负责提交
+
+    已有的行先清零再写入, 并把所属群的版本号加 1 作为新的 seq, 内存中的索引会在下次查询时看到所有变化(包括清零的用户)。
+    """
+    cursor.execute("SELECT group_id FROM t_task WHERE task_id = ?", (task_id,))
+    task = cursor.fetchone()
+    if not task:
+        return 0
+    group_id = task[0]
+    cursor.execute("""INSERT INTO t_group_version (group_id, version) VALUES (?, 1)
+                      ON CONFLICT(group_id) DO UPDATE SET version = version + 1""", (group_id,))
+    cursor.execute("SELECT version FROM t_group_version WHERE group_id = ?", (group_id,))
+    seq = cursor.fetchone()[0]
+    cursor.execute("""UPDATE t_user_total SET checkins = 0, points = 0, last_checkin = '', seq = ?
+                      WHERE task_id = ?""", (seq, task_id))
+    rows = _expected_rows(cursor, task_id)
+    cursor.executemany("""
+        INSERT INTO t_user_total (task_id, user_id, group_id, checkins, points, last_checkin, seq)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(task_id, user_id) DO UPDATE SET
+            checkins = excluded.checkins, points = excluded.points,
+            last_checkin = excluded.last_checkin, seq = excluded.seq
+    """, [row + (seq,) for row in rows])
+    return len(rows)
+
+
+def _expected_rows(cursor, task_id):
+    cursor.execute(EXPECTED_ROWS, (task_id,))
+    return cursor.fetchall()
+
+
+def _actual_rows(cursor, task_id):
+    cursor.execute(ACTUAL_ROWS, (task_id,))
+    return cursor.fetchall()
+
+
+aggregate = register_aggregate("t_user_total", _expected_rows, _actual_rows, rebuild_task, "累计排名数据")
+
+
+class UserTotals:
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def backfill(self, pause=0.01):
+        """按日汇总表回填所有任务的累计数据
+
+        Returns:
+            int: 写入的行数
+        """
+        return aggregate.backfill(self.db_path, pause)
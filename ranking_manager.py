@@ -1,13 +1,59 @@
-import sqlite3
-from datetime import datetime
+import heapq
+import threading
+from collections import OrderedDict
+from itertools import islice
 
 from common.log import logger
+from plugins.PKTracker.content_store import checkin_content
+from plugins.PKTracker.daily_stats import parse_window
+from plugins.PKTracker.database import get_connection
+from plugins.PKTracker.shards import shards
+from plugins.PKTracker.rank_index import RankIndex
+
+
+# 全局排行榜展示的人数, 也是每个群参与归并的人数
+GLOBAL_TOP_N = 10
+
+# 积分榜每页的人数
+RANKING_PAGE_SIZE = 10
+
+# 我的排名上下各展示的人数
+MY_RANK_RADIUS = 5
+
+# 全局排行榜最多缓存的 (群, 任务, 时间范围) 组合数
+GROUP_TOP_CACHE_SIZE = 4096
+
+
+class VersionedCache:
+    """按版本号校验的 LRU 缓存, 取出时版本号不一致视为未命中"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, value):
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
 
 
 class RankingManager:
     def __init__(self, db_path, user_manager):
         self.db_path = db_path
         self.user_manager = user_manager
+        self._group_top_cache = VersionedCache(GROUP_TOP_CACHE_SIZE)
+        self._rank_index = RankIndex()
 
     def get_user_bonus_detail(self, group_id: str, user_name: str = None, sender_id: str = None, page: int = 1) -> str:
         """获取用户的积分详情
@@ -31,7 +77,7 @@ class RankingManager:
                     return f"❌ 未找到用户 [{user_name}]"
                 display_name = user_name
 
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id), readonly=True)
             c = conn.cursor()
 
             # 先获取总记录数
@@ -50,12 +96,12 @@ class RankingManager:
             page = max(1, min(page, total_pages)) if total_pages > 0 else 1
             offset = (page - 1) * page_size
 
-            # 获取分页数据
+            # 获取分页数据, 内容只按本页的打卡读取
             c.execute("""
                 SELECT 
+                    cl.checkin_id,
                     t.task_name,
                     cl.checkin_time,
-                    cl.content,
                     SUM(b.bonus_value) as total_bonus
                 FROM t_checkin_log cl
                 JOIN t_task t ON cl.task_id = t.task_id
@@ -67,6 +113,7 @@ class RankingManager:
             """, (group_id, user_id, page_size, offset))
 
             records = c.fetchall()
+            contents = checkin_content.load(c, [row[0] for row in records])
 
             if not records:
                 if page > 1:
@@ -76,8 +123,9 @@ class RankingManager:
             message = f"📊 {display_name}的打卡记录 (第{page}/{total_pages}页)\n"
             message += "===================\n\n"
 
-            for task_name, checkin_time, content, total_bonus in records:
+            for checkin_id, task_name, checkin_time, total_bonus in records:
                 message += f"[{task_name}] {checkin_time} (+{total_bonus}分)\n"
+                content = contents.get(checkin_id)
                 if content:
                     message += f"内容: {content}\n"
                 message += "\n"
@@ -91,100 +139,290 @@ class RankingManager:
             if 'conn' in locals() and conn is not None:
                 conn.close()
 
-    def get_ranking(self, group_id: str, task_name: str = None) -> str:
+    def get_ranking(self, group_id: str, task_name: str = None, window: str = None, page: int = 1) -> str:
+        """获取排行榜
+
+        Args:
+            group_id: 群组ID
+            task_name: 任务名称，可选，不指定时统计全部任务
+            window: 时间范围，可选，如 本周/上月/7天/2024-01-01~2024-01-31，不指定时统计全部历史
+            page: 页码，默认为1，每页 RANKING_PAGE_SIZE 人
+        """
+        if window:
+            try:
+                window = parse_window(window)
+            except ValueError as e:
+                return f"❌ {str(e)}"
+
+        conn = None
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id), readonly=True)
             c = conn.cursor()
 
             # 检查任务是否存在
-            if task_name:
-                c.execute("""SELECT task_id FROM t_task 
-                            WHERE group_id=? AND task_name=? AND enable=1""",
-                          (group_id, task_name))
-                task = c.fetchone()
-                if not task:
-                    return f"❌ 任务 [{task_name}] 不存在或未启用"
-                task_filter = f"AND cl.task_id = {task[0]}"
-                title = f"[{task_name}]"
-            else:
-                task_filter = ""
-                title = "[全部任务]"
-
-            # 修改查询以使用新的积分表结构
-            c.execute(f"""
-                WITH task_points AS (
-                    SELECT 
-                        cl.user_id,
-                        t.task_name,
-                        COUNT(*) as task_checkin_count,
-                        SUM(COALESCE(b.bonus_value, 0)) as task_total_points
-                    FROM t_checkin_log cl
-                    JOIN t_task t ON cl.task_id = t.task_id
-                    LEFT JOIN t_bonus b ON cl.checkin_id = b.checkin_id
-                    WHERE t.group_id = ? AND t.enable = 1 {task_filter}
-                    GROUP BY cl.user_id, t.task_id, t.task_name
-                ),
-                user_points AS (
-                    SELECT 
-                        cl.user_id,
-                        COUNT(DISTINCT cl.checkin_id) as total_checkins,
-                        SUM(COALESCE(b.bonus_value, 0)) as total_points,
-                        MAX(cl.checkin_time) as last_checkin,
-                        GROUP_CONCAT(DISTINCT tp.task_name || ':' || tp.task_checkin_count || ':' || tp.task_total_points) as task_details
-                    FROM t_checkin_log cl
-                    JOIN t_task t ON cl.task_id = t.task_id
-                    LEFT JOIN t_bonus b ON cl.checkin_id = b.checkin_id
-                    LEFT JOIN task_points tp ON cl.user_id = tp.user_id
-                    WHERE t.group_id = ? AND t.enable = 1 {task_filter}
-                    GROUP BY cl.user_id
-                )
-                SELECT 
-                    up.user_id,
-                    up.total_checkins,
-                    up.total_points,
-                    up.last_checkin,
-                    up.task_details
-                FROM user_points up
-                ORDER BY up.total_points DESC, up.last_checkin ASC
-                LIMIT 10
-            """, (group_id, group_id))
-
-            rankings = c.fetchall()
+            task_names = self._enabled_tasks(c, group_id, task_name)
+            if not task_names:
+                return f"❌ 任务 [{task_name}] 不存在或未启用" if task_name else "📊 [全部任务] 暂无打卡记录"
+            title = f"[{task_name}]" if task_name else "[全部任务]"
 
-            if not rankings:
+            if window:
+                return self._get_window_ranking(c, group_id, task_name, title, *window, page=page)
+
+            # 累计排名由内存索引按页切片, 不需要汇总全部打卡记录
+            offset = (page - 1) * RANKING_PAGE_SIZE
+            total, rankings = self._rank_index.page(c, group_id, task_names, offset, RANKING_PAGE_SIZE)
+            if not total:
                 return f"📊 {title} 暂无打卡记录"
+            if not rankings:
+                return f"❌ 第{page}页没有记录"
 
             # 获取所有用户的昵称
             user_ids = [row[0] for row in rankings]
             nickname_map = self.user_manager._get_nickname_by_user_ids(user_ids)
 
             # 生成排行榜消息
-            message = f"📊 {title} 排行榜 TOP 10\n"
+            pages = (total + RANKING_PAGE_SIZE - 1) // RANKING_PAGE_SIZE
+            if page == 1:
+                message = f"📊 {title} 排行榜 TOP {RANKING_PAGE_SIZE}\n"
+            else:
+                message = f"📊 {title} 排行榜 (第{page}/{pages}页)\n"
             message += "===================\n"
 
-            # 修改排行榜消息生成部分
-            for idx, (user_id, checkins, points, last_checkin, task_details) in enumerate(rankings, 1):
+            for idx, (user_id, checkins, points, last_checkin, per_task) in enumerate(rankings, offset + 1):
                 medal = "🥇" if idx == 1 else "🥈" if idx == 2 else "🥉" if idx == 3 else "👑"
-                last_time = datetime.strptime(last_checkin, '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d %H:%M:%S')
                 nickname = nickname_map.get(user_id, user_id)
 
                 message += f"{medal} {idx}. {nickname}\n"
                 message += f"   总打卡: {checkins}次 | 总积分: {points}\n"
 
                 # 添加各任务打卡和积分详情
-                if task_details:
-                    task_list = []
-                    for task_info in task_details.split(','):
-                        task_name, count, task_points = task_info.split(':')
-                        task_list.append(f"[{task_name}]{count}次/{task_points}分")
+                if per_task:
+                    task_list = [f"[{task_names[task_id]}]{count}次/{task_points}分"
+                                 for task_id, (count, task_points) in sorted(per_task.items())]
                     message += f"   任务详情: {' '.join(task_list)}\n"
 
-                message += f"   最后打卡: {last_time}\n"
+                if last_checkin:
+                    message += f"   最后打卡: {last_checkin}\n"
+
+            if pages > 1:
+                message += f"\n共 {total} 人参与, 使用 p[页码] 查看更多"
 
             return message
 
         except Exception as e:
             logger.exception(f"[PKTracker] 获取排行榜异常: {str(e)}")
             return "❌ 获取排行榜失败,请稍后重试"
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def get_my_rank(self, group_id: str, user_id: str, task_name: str = None) -> str:
+        """查询用户的累计排名、与上一名的分差以及上下各 MY_RANK_RADIUS 名用户
+
+        Args:
+            group_id: 群组ID
+            user_id: 用户ID
+            task_name: 任务名称，可选，不指定时统计全部任务
+        """
+        conn = None
+        try:
+            conn = get_connection(shards.path(self.db_path, group_id), readonly=True)
+            c = conn.cursor()
+
+            task_names = self._enabled_tasks(c, group_id, task_name)
+            if not task_names:
+                return f"❌ 任务 [{task_name}] 不存在或未启用" if task_name else "📍 本群还没有启用的任务"
+            title = f"[{task_name}]" if task_name else "[全部任务]"
+
+            rank, total, first_rank, neighbours = self._rank_index.around(
+                c, group_id, task_names, user_id, MY_RANK_RADIUS)
+        except Exception as e:
+            logger.exception(f"[PKTracker] 查询个人排名异常: {str(e)}")
+            return "❌ 查询排名失败,请稍后重试"
+        finally:
+            if conn is not None:
+                conn.close()
+
+        if rank is None:
+            return f"📍 你在 {title} 还没有打卡记录, 共 {total} 人参与"
+
+        nickname_map = self.user_manager._get_nickname_by_user_ids([row[0] for row in neighbours])
+        me = neighbours[rank - first_rank]
+
+        message = f"📍 你在 {title} 的排名\n"
+        message += "===================\n"
+        message += f"🏅 第 {rank} 名 / 共 {total} 人\n"
+        message += f"💰 积分: {me[2]} | 打卡: {me[1]}次\n"
+        if rank > 1:
+            # 积分相同时最后打卡更早的排在前面, 因此追平还不够, 需要多 1 分
+            gap = neighbours[rank - first_rank - 1][2] - me[2] + 1
+            message += f"⬆️ 距第 {rank - 1} 名还差 {gap} 分\n"
+        else:
+            message += "👑 你是第一名!\n"
+        message += "-------------------\n"
+        for idx, (row_user_id, checkins, points, last_checkin, per_task) in enumerate(neighbours, first_rank):
+            marker = "👉" if row_user_id == user_id else "  "
+            message += f"{marker} {idx}. {nickname_map.get(row_user_id, row_user_id)} {points}分\n"
+
+        return message
+
+    @staticmethod
+    def _enabled_tasks(c, group_id, task_name=None):
+        """群内启用的任务 {task_id: task_name}, 指定任务名称时只返回该任务"""
+        c.execute("""SELECT task_id, task_name FROM t_task
+                    WHERE group_id = ? AND enable = 1 AND (? IS NULL OR task_name = ?)""",
+                  (group_id, task_name, task_name))
+        return dict(c.fetchall())
+
+    def _query_top_users(self, c, group_id, task_name, start, end, limit, offset=0):
+        """按日汇总表统计一个群在时间范围内从第 offset + 1 名开始的 limit 名
+
+        CROSS JOIN 固定先按群找到任务, 再按主键 (task_id, day) 范围读取窗口内的汇总行。
+        排序与全局榜归并使用的顺序一致: 积分降序, 最后打卡时间升序, 用户 ID 升序。
+
+        Returns:
+            list: [(user_id, 打卡次数, 积分, 最后打卡时间)]
+        """
+        c.execute("""
+            SELECT s.user_id, SUM(s.checkins) AS checkins, SUM(s.points) AS points,
+                   COALESCE(MAX(s.last_checkin), '') AS last_checkin
+            FROM t_task t
+            CROSS JOIN t_daily_stats s ON s.task_id = t.task_id AND s.day BETWEEN ? AND ?
+            WHERE t.group_id = ? AND t.enable = 1 AND (? IS NULL OR t.task_name = ?)
+            GROUP BY s.user_id
+            HAVING SUM(s.checkins) > 0 OR SUM(s.points) > 0
+            ORDER BY points DESC, last_checkin ASC, s.user_id ASC
+            LIMIT ? OFFSET ?
+        """, (start, end, group_id, task_name, task_name, limit, offset))
+        return c.fetchall()
+
+    def _get_window_ranking(self, c, group_id, task_name, title, start, end, label, page=1):
+        """按日汇总表统计时间范围内的排行榜, 每个用户每个任务最多累加窗口天数行"""
+        offset = (page - 1) * RANKING_PAGE_SIZE
+        rankings = self._query_top_users(c, group_id, task_name, start, end, RANKING_PAGE_SIZE, offset)
+
+        period = label if label == f"{start}~{end}" else f"{label} ({start}~{end})"
+        if not rankings:
+            return f"📊 {title} {period} 暂无打卡记录" if page == 1 else f"❌ 第{page}页没有记录"
+
+        # 前 10 名用户在各任务上的打卡和积分
+        user_ids = [row[0] for row in rankings]
+        placeholders = ",".join("?" * len(user_ids))
+        c.execute(f"""
+            SELECT s.user_id, t.task_name, SUM(s.checkins), SUM(s.points)
+            FROM t_task t
+            CROSS JOIN t_daily_stats s ON s.task_id = t.task_id AND s.day BETWEEN ? AND ?
+            WHERE t.group_id = ? AND t.enable = 1 AND (? IS NULL OR t.task_name = ?)
+                AND s.user_id IN ({placeholders})
+            GROUP BY s.user_id, t.task_id
+            ORDER BY t.task_id
+        """, (start, end, group_id, task_name, task_name) + tuple(user_ids))
+        task_details = {}
+        for user_id, name, checkins, points in c.fetchall():
+            task_details.setdefault(user_id, []).append(f"[{name}]{checkins}次/{points}分")
+
+        nickname_map = self.user_manager._get_nickname_by_user_ids(user_ids)
+
+        if page == 1:
+            message = f"📊 {title} {period} 排行榜 TOP {RANKING_PAGE_SIZE}\n"
+        else:
+            message = f"📊 {title} {period} 排行榜 (第{page}页)\n"
+        message += "===================\n"
+        for idx, (user_id, checkins, points, last_checkin) in enumerate(rankings, offset + 1):
+            medal = "🥇" if idx == 1 else "🥈" if idx == 2 else "🥉" if idx == 3 else "👑"
+            message += f"{medal} {idx}. {nickname_map.get(user_id, user_id)}\n"
+            message += f"   打卡: {checkins}次 | 积分: {points}\n"
+            if task_details.get(user_id):
+                message += f"   任务详情: {' '.join(task_details[user_id])}\n"
+            if last_checkin:
+                message += f"   最后打卡: {last_checkin}\n"
+
+        return message
+
+    def get_global_ranking(self, task_name: str = None, window: str = None, page: int = 1) -> str:
+        """跨群的全局排行榜(超级管理员)
+
+        第 page 页只需要每个群的前 page * GLOBAL_TOP_N 名, 由日汇总表计算并按群缓存, 缓存以 t_group_version 中该群的版本号校验:
+        群内有新的打卡、结算或任务变更时版本号由触发器加 1, 只有这些群需要重新计算。
+        最后对各群已排好序的前 N 名做 k 路归并, 取出这一页, 不会扫描任何群的原始打卡记录。
+
+        Args:
+            task_name: 任务名称，可选，按任务名称匹配各群的同名任务
+            window: 时间范围，可选，不指定时统计全部历史
+            page: 页码，默认为1，每页 GLOBAL_TOP_N 人
+        """
+        if window:
+            try:
+                start, end, label = parse_window(window)
+            except ValueError as e:
+                return f"❌ {str(e)}"
+            period = label if label == f"{start}~{end}" else f"{label} ({start}~{end})"
+        else:
+            start, end, period = "0000-01-01", "9999-12-31", "全部历史"
+
+        offset = (page - 1) * GLOBAL_TOP_N
+        try:
+            group_ids, per_group, computed = [], [], 0
+            # 按群组分库时依次读取每个分库, 各群的前 N 名最后一起归并
+            for db_path in shards.paths(self.db_path):
+                computed += self._collect_group_tops(db_path, task_name, start, end, offset + GLOBAL_TOP_N,
+                                                     group_ids, per_group)
+
+            rankings = list(islice(heapq.merge(*per_group, key=lambda row: (-row[3], row[4], row[0])),
+                                   offset, offset + GLOBAL_TOP_N))
+            logger.debug(f"[PKTracker] 全局排行榜: {len(group_ids)}个群, 重新计算 {computed}个")
+
+            title = f"[{task_name}]" if task_name else "[全部任务]"
+            if not rankings:
+                return f"🌏 {title} {period} 全局暂无打卡记录" if page == 1 else f"❌ 第{page}页没有记录"
+
+            # 群的昵称接口同样支持查询群名
+            ids = list(dict.fromkeys([row[0] for row in rankings] + [row[1] for row in rankings]))
+            nickname_map = self.user_manager._get_nickname_by_user_ids(ids)
+
+            if page == 1:
+                message = f"🌏 {title} {period} 全局排行榜 TOP {GLOBAL_TOP_N}\n"
+            else:
+                message = f"🌏 {title} {period} 全局排行榜 (第{page}页)\n"
+            message += f"共 {len(group_ids)} 个群参与\n"
+            message += "===================\n"
+            for idx, (user_id, group_id, checkins, points, last_checkin) in enumerate(rankings, offset + 1):
+                medal = "🥇" if idx == 1 else "🥈" if idx == 2 else "🥉" if idx == 3 else "👑"
+                message += f"{medal} {idx}. {nickname_map.get(user_id, user_id)} ({nickname_map.get(group_id, group_id)})\n"
+                message += f"   打卡: {checkins}次 | 积分: {points}\n"
+            return message
+
+        except Exception as e:
+            logger.exception(f"[PKTracker] 获取全局排行榜异常: {str(e)}")
+            return "❌ 获取全局排行榜失败,请稍后重试"
+
+    def _collect_group_tops(self, db_path, task_name, start, end, limit, group_ids, per_group):
+        """读取一个数据库中各群的前 limit 名, 追加到 group_ids / per_group, 返回重新计算的群数"""
+        conn = get_connection(db_path, readonly=True)
+        try:
+            c = conn.cursor()
+            # 版本号和各群排名在同一个读事务中读取, 缓存的结果与版本号严格对应
+            c.execute("BEGIN")
+            c.execute("""SELECT DISTINCT group_id FROM t_task
+                        WHERE enable = 1 AND (? IS NULL OR task_name = ?)""", (task_name, task_name))
+            shard_groups = [row[0] for row in c.fetchall()]
+            c.execute("SELECT group_id, version FROM t_group_version")
+            versions = dict(c.fetchall())
+
+            computed = 0
+            for group_id in shard_groups:
+                key = (group_id, task_name, start, end, limit)
+                version = versions.get(group_id, 0)
+                top = self._group_top_cache.get(key, version)
+                if top is None:
+                    top = [(user_id, group_id, checkins, points, last_checkin)
+                           for user_id, checkins, points, last_checkin
+                           in self._query_top_users(c, group_id, task_name, start, end, limit)]
+                    self._group_top_cache.put(key, version, top)
+                    computed += 1
+                group_ids.append(group_id)
+                per_group.append(top)
+            conn.rollback()
+            return computed
         finally:
             conn.close()
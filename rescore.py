@@ -0,0 +1,285 @@
+import time
+from datetime import date
+from itertools import chain
+from operator import itemgetter
+
+from common.log import logger
+from plugins.PKTracker import daily_stats
+from plugins.PKTracker.database import get_connection
+from plugins.PKTracker.shards import shards
+from plugins.PKTracker.reward_rules import BONUS_TYPES, CheckinState, compile_rules
+
+try:
+    import numpy as np
+except ImportError:  # 可选依赖, 只有重新计分需要
+    np = None
+
+# 儒略日整数部分与 date.toordinal() 的差
+JULIAN_ORDINAL_OFFSET = 1721424
+
+# 预览中列出的积分变化最大的用户数
+TOP_CHANGED_USERS = 5
+
+
+def checkin_states(checkin_ids, user_codes, days, minutes):
+    """按打卡记录还原每条打卡在打卡时的状态, 与打卡时由打卡日历和任务统计得到的状态一致
+
+    Args:
+        checkin_ids: 按升序排列的 checkin_id 数组
+        user_codes: 与 checkin_ids 对应的用户编号数组
+        days: 与 checkin_ids 对应的日期序号数组(相邻日期相差 1)
+        minutes: 与 checkin_ids 对应的打卡时间在当天的分钟数
+
+    Returns:
+        CheckinState: 各字段为与 checkin_ids 等长的数组
+    """
+    n = len(checkin_ids)
+    positions = np.arange(n)
+
+    # 任务当天的第几次打卡: checkin_id 已经升序, 按日期稳定排序后在每天内的位置 + 1
+    order = np.argsort(days, kind="stable")
+    sorted_days = days[order]
+    new_day = np.ones(n, dtype=bool)
+    new_day[1:] = sorted_days[1:] != sorted_days[:-1]
+    day_rank = np.empty(n, dtype=np.int64)
+    day_rank[order] = positions - np.maximum.accumulate(np.where(new_day, positions, 0)) + 1
+
+    # 按 (用户, 日期, checkin_id) 排序, 每个用户每天的第一条打卡之外都是当天已经打过卡
+    order = np.lexsort((checkin_ids, days, user_codes))
+    users, user_days = user_codes[order], days[order]
+    first_of_day = np.ones(n, dtype=bool)
+    first_of_day[1:] = (users[1:] != users[:-1]) | (user_days[1:] != user_days[:-1])
+    heads = np.flatnonzero(first_of_day)
+    users, user_days = users[heads], user_days[heads]
+    # 换了用户或与前一个打卡日不相邻时开始新的一段, 段内的位置 + 1 就是截至当天的连续天数
+    run_start = np.ones(len(heads), dtype=bool)
+    run_start[1:] = (users[1:] != users[:-1]) | (user_days[1:] - user_days[:-1] != 1)
+    head_positions = np.arange(len(heads))
+    head_streak = head_positions - np.maximum.accumulate(np.where(run_start, head_positions, 0)) + 1
+    seen = np.empty(n, dtype=bool)
+    seen[order] = ~first_of_day
+    streak = np.empty(n, dtype=np.int64)
+    streak[order] = head_streak[np.cumsum(first_of_day) - 1]
+    return CheckinState(minutes, seen, streak, day_rank)
+
+
+def compute_bonuses(checkin_ids, user_codes, days, minutes, rules):
+    """按任务的奖励规则计算每条打卡应得的积分, 规则与打卡时使用的是同一个 RuleSet
+
+    Returns:
+        ndarray: 形状为 (len(BONUS_TYPES), n), 每行是一种积分类型在每条打卡上的分值
+    """
+    n = len(checkin_ids)
+    if n == 0:
+        return np.zeros((len(BONUS_TYPES), 0), dtype=np.int64)
+    values = rules.evaluate(checkin_states(checkin_ids, user_codes, days, minutes), zero=np.zeros(n, dtype=np.int64))
+    return np.stack([values[bonus_type] for bonus_type in BONUS_TYPES])
+
+
+def diff_bonuses(checkin_ids, days, expected, existing):
+    """比较应得积分与已有的积分记录
+
+    Args:
+        checkin_ids: 按升序排列的 checkin_id 数组
+        days: 与 checkin_ids 对应的日期序号数组
+        expected: compute_bonuses 的结果
+        existing: 已有的积分记录, 形状为 (m, 5) 的数组, 每行是 (bonus_id, checkin_id, 类型序号, 分值, 日期序号);
+            对应打卡不存在的记录由一致性检查处理, 这里忽略
+
+    Returns:
+        tuple: (deletes, updates, inserts, adjustments)
+            deletes: 要删除的 bonus_id 数组(包括重复的记录)
+            updates: (bonus_id 数组, 新分值数组)
+            inserts: (类型序号数组, 打卡位置数组, 分值数组)
+            adjustments: 日汇总的变化 (类型序号数组, 打卡位置数组, 日期序号数组, 变化量数组);
+                已有记录的变化计入其 create_time 的日期, 新增记录计入打卡日期
+    """
+    n = len(checkin_ids)
+    current = np.zeros_like(expected)
+    row_ids = np.zeros_like(expected)
+    row_days = np.broadcast_to(days, expected.shape).copy()
+    duplicates = np.zeros((0, 6), dtype=np.int64)
+    if len(existing) and n:
+        positions = np.minimum(np.searchsorted(checkin_ids, existing[:, 1]), n - 1)
+        found = checkin_ids[positions] == existing[:, 1]
+        existing, positions = existing[found], positions[found]
+        # 同一打卡同一类型有多条时保留 bonus_id 最小的一条
+        order = np.argsort(existing[:, 0])
+        existing, positions = existing[order], positions[order]
+        keys = existing[:, 2] * n + positions
+        _, keep = np.unique(keys, return_index=True)
+        kept = np.zeros(len(keys), dtype=bool)
+        kept[keep] = True
+        duplicates = np.column_stack([existing[~kept], positions[~kept]])
+        current.ravel()[keys[keep]] = existing[keep, 3]
+        row_ids.ravel()[keys[keep]] = existing[keep, 0]
+        row_days.ravel()[keys[keep]] = existing[keep, 4]
+
+    has_row = row_ids > 0
+    deletes = np.concatenate([row_ids[has_row & (expected == 0)], duplicates[:, 0]])
+    changed = has_row & (expected > 0) & (expected != current)
+    updates = (row_ids[changed], expected[changed])
+    missing = ~has_row & (expected > 0)
+    type_index, positions = np.nonzero(missing)
+    inserts = (type_index, positions, expected[missing])
+
+    delta = expected - current
+    type_index, positions = np.nonzero(delta)
+    adjustments = (np.concatenate([type_index, duplicates[:, 2]]),
+                   np.concatenate([positions, duplicates[:, 5]]),
+                   np.concatenate([row_days[type_index, positions], duplicates[:, 4]]),
+                   np.concatenate([delta[type_index, positions], -duplicates[:, 3]]))
+    return deletes, updates, inserts, adjustments
+
+
+def daily_adjustments(users, adjustments):
+    """把积分变化按 (日期序号, 用户编号) 汇总
+
+    Returns:
+        list: [(日期序号, 用户编号, 基础积分变化, 首次打卡积分变化, 连续打卡积分变化)]
+    """
+    type_index, positions, days, delta = adjustments
+    if not len(delta):
+        return []
+    keys = np.column_stack([days, users[positions]])
+    unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    totals = np.zeros((len(unique_keys), len(BONUS_TYPES)), dtype=np.int64)
+    np.add.at(totals, (inverse.ravel(), type_index), delta)
+    return np.column_stack([unique_keys, totals]).tolist()
+
+
+def _int_rows(rows, columns):
+    """把整数结果集直接转换为 (len(rows), columns) 的数组, 不逐行构造 Python 列表"""
+    return np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=len(rows) * columns).reshape(-1, columns)
+
+
+class Rescorer:
+    """按任务当前的奖励规则重新计算历史打卡的积分
+
+    修改基础分、首次打卡或连续打卡奖励后, 默认只影响之后的打卡。重新计分一次读出任务的全部打卡,
+    用 NumPy 按数组计算每条打卡应得的基础/首次/连续积分, 与已有记录比较后只改写有差异的行,
+    并在同一个事务中按变化量调整日汇总(累计排名数据由触发器同步)。周/月奖励不受影响。
+    有变化时同时写入 t_rescore_log, 分析库下次同步时重新复制该任务的积分记录。
+    """
+
+    def __init__(self, db_path, user_manager):
+        self.db_path = db_path
+        self.user_manager = user_manager
+
+    def rescore(self, group_id: str, task_name: str, apply: bool = False) -> str:
+        """重新计分, 默认只预览差异
+
+        Args:
+            group_id: 群组ID
+            task_name: 任务名称
+            apply: 是否写入; 写入时整个过程在一个写事务中完成, 期间的打卡会等待事务提交
+        """
+        if np is None:
+            return "❌ 重新计分需要安装 numpy"
+        start = time.perf_counter()
+        conn = None
+        try:
+            conn = get_connection(shards.path(self.db_path, group_id), readonly=not apply)
+            c = conn.cursor()
+            if apply:
+                # 读取和改写在同一个写事务中, 不会与并发的打卡交错
+                c.execute("BEGIN IMMEDIATE")
+            c.execute("""SELECT task_id, base_score, first_checkin_reward_enabled, first_checkin_reward,
+                                consecutive_checkin_reward_enabled, consecutive_checkin_reward, reward_rules
+                         FROM t_task WHERE group_id = ? AND task_name = ?""", (group_id, task_name))
+            task = c.fetchone()
+            if not task:
+                return f"❌ 任务 [{task_name}] 不存在"
+            task_id = task[0]
+            rules = compile_rules(*task[1:])
+
+            # 日期序号取日期的儒略日整数部分, 相邻日期相差 1; 与日汇总一样按时间的前 10 个字符取日期
+            c.execute("""SELECT checkin_id, user_id, CAST(julianday(substr(checkin_time, 1, 10)) AS INTEGER),
+                                CAST(substr(checkin_time, 12, 2) AS INTEGER) * 60
+                                + CAST(substr(checkin_time, 15, 2) AS INTEGER)
+                         FROM t_checkin_log WHERE task_id = ?""", (task_id,))
+            rows = c.fetchall()
+            # 用户编号按首次出现的顺序分配
+            user_ids = list(dict.fromkeys(map(itemgetter(1), rows)))
+            user_codes = {user: code for code, user in enumerate(user_ids)}
+            checkin_ids = np.fromiter(map(itemgetter(0), rows), dtype=np.int64, count=len(rows))
+            users = np.fromiter(map(user_codes.__getitem__, map(itemgetter(1), rows)), dtype=np.int64, count=len(rows))
+            days = np.fromiter(map(itemgetter(2), rows), dtype=np.int64, count=len(rows))
+            minutes = np.fromiter(map(itemgetter(3), rows), dtype=np.int64, count=len(rows))
+            rows = None
+            # 查询没有排序(避免临时 B-TREE), 这里按 checkin_id 排序
+            order = np.argsort(checkin_ids)
+            checkin_ids, users, days, minutes = checkin_ids[order], users[order], days[order], minutes[order]
+            expected = compute_bonuses(checkin_ids, users, days, minutes, rules)
+
+            c.execute("""SELECT bonus_id, checkin_id,
+                                CASE bonus_type WHEN 'base' THEN 0 WHEN 'first' THEN 1 ELSE 2 END, bonus_value,
+                                CAST(julianday(substr(create_time, 1, 10)) AS INTEGER)
+                         FROM t_bonus
+                         WHERE task_id = ? AND bonus_type IN ('base', 'first', 'consecutive')""", (task_id,))
+            deletes, updates, inserts, adjustments = diff_bonuses(checkin_ids, days, expected, _int_rows(c.fetchall(), 5))
+
+            if apply:
+                c.executemany("DELETE FROM t_bonus WHERE bonus_id = ?", [(int(i),) for i in deletes])
+                c.executemany("UPDATE t_bonus SET bonus_value = ? WHERE bonus_id = ?",
+                              [(int(value), int(i)) for i, value in zip(*updates)])
+                # 与打卡时一样, 积分的 create_time 取打卡时间
+                c.executemany("""INSERT INTO t_bonus (task_id, user_id, checkin_id, bonus_type, bonus_value, create_time)
+                                 SELECT task_id, user_id, checkin_id, ?, ?, checkin_time
+                                 FROM t_checkin_log WHERE checkin_id = ?""",
+                              [(BONUS_TYPES[t], int(value), int(checkin_ids[p])) for t, p, value in zip(*inserts)])
+                daily_stats.record_rescore(c, task_id, [
+                    (date.fromordinal(day - JULIAN_ORDINAL_OFFSET).isoformat(), user_ids[user], base, first, consecutive)
+                    for day, user, base, first, consecutive in daily_adjustments(users, adjustments)])
+                if len(deletes) or len(updates[0]) or len(inserts[0]):
+                    # 分析库按 bonus_id 的水位线增量复制, 看不到原地修改和删除的积分记录;
+                    # 记录重新计分的任务, 下次同步时删除分析库中该任务的积分记录后重新复制
+                    c.execute("INSERT INTO t_rescore_log (task_id) VALUES (?)", (task_id,))
+                conn.commit()
+        except Exception as e:
+            logger.exception(f"[PKTracker] 重新计分异常: {str(e)}")
+            return "❌ 重新计分失败,请稍后重试"
+        finally:
+            if conn is not None:
+                conn.close()
+
+        elapsed = time.perf_counter() - start
+        if apply:
+            logger.info(f"[PKTracker] 任务 {task_id} 重新计分完成: 删除 {len(deletes)} 条, 修改 {len(updates[0])} 条, "
+                        f"新增 {len(inserts[0])} 条, 耗时 {elapsed:.2f}s")
+        return self._format(task_name, rules, len(checkin_ids), deletes, updates, inserts, adjustments, users,
+                            user_ids, apply, elapsed)
+
+    def _format(self, task_name, rules, total, deletes, updates, inserts, adjustments, users, user_ids, apply, elapsed):
+        type_index, positions, _, delta = adjustments
+        message = f"🧮 [{task_name}] 重新计分{'完成' if apply else '预览(未写入)'}\n"
+        message += f"规则: {'; '.join(rules.describe())}\n"
+        message += "===================\n"
+        message += f"打卡记录: {total}条\n"
+        types = len(BONUS_TYPES)
+        changed = np.bincount(type_index, minlength=types)
+        points = np.bincount(type_index, weights=delta, minlength=types).astype(np.int64)
+        inserted = np.bincount(inserts[0], minlength=types)
+        for i, title in enumerate(("基础积分", "首次打卡", "连续打卡")):
+            message += f"🔸 {title}: {changed[i]}条变化 (新增{inserted[i]}条), 积分 {points[i]:+d}\n"
+        if len(deletes):
+            message += f"🔸 删除的记录(含重复记录): {len(deletes)}条\n"
+
+        per_user = np.bincount(users[positions], weights=delta, minlength=len(user_ids)).astype(np.int64)
+        affected = np.flatnonzero(per_user)
+        message += f"合计积分变化: {int(per_user.sum()):+d}, 涉及 {len(affected)} 人\n"
+        if len(affected):
+            top = affected[np.argsort(-np.abs(per_user[affected]), kind="stable")[:TOP_CHANGED_USERS]]
+            nickname_map = self.user_manager._get_nickname_by_user_ids([user_ids[code] for code in top])
+            message += "变化最大的用户:\n"
+            for code in top:
+                user_id = user_ids[code]
+                message += f"  {nickname_map.get(user_id, user_id)} {per_user[code]:+d}分\n"
+        message += "===================\n"
+        if apply:
+            message += f"⏱ 耗时 {elapsed:.2f}s"
+        elif len(deletes) or len(updates[0]) or len(inserts[0]):
+            message += f"确认无误后发送: PKTracker 重新计分 [{task_name}] 确认"
+        else:
+            message += "✅ 积分与当前规则一致, 无需重新计分"
+        return message
@@ -0,0 +1,253 @@
+import json
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+from common.log import logger
+
+# 连续打卡达标的天数, 也是连续打卡奖励的默认门槛
+STREAK_DAYS = 3
+
+# 每次打卡按规则发放的积分类型, 与 t_bonus.bonus_type 对应
+BONUS_TYPES = ("base", "first", "consecutive")
+BASE, FIRST, CONSECUTIVE = range(len(BONUS_TYPES))
+
+# 附加规则的数量和取值上限
+MAX_FIRST_N = 10
+MAX_STREAK_TIERS = 5
+MAX_WINDOWS = 3
+MAX_MULTIPLIERS = 3
+MAX_MULTIPLIER = 10
+
+# 打卡时的状态, 打卡时由打卡日历和任务统计一次取得, 所有规则都只读取这一条记录。
+# 各字段可以是单个值(打卡时), 也可以是等长的 NumPy 数组(重新计分时), 规则对两者使用同一段计算。
+#   minute: 打卡时间在当天的分钟数
+#   seen: 用户当天此前是否已经打过卡
+#   streak: 截至当天的连续打卡天数
+#   day_rank: 本次打卡是任务当天的第几次打卡(所有用户)
+CheckinState = namedtuple("CheckinState", ["minute", "seen", "streak", "day_rank"])
+
+
+def _in_window(minute, start, end):
+    """minute 是否落在 [start, end) 内, start 大于 end 时表示跨过零点"""
+    if start <= end:
+        return (minute >= start) & (minute < end)
+    return (minute >= start) | (minute < end)
+
+
+def _format_minute(minute):
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def _format_percent(percent):
+    return f"{percent / 100:g}"
+
+
+class BaseRule:
+    """基础积分: 每次打卡都有"""
+
+    def __init__(self, points):
+        self.points = points
+
+    def apply(self, state, bonus):
+        bonus[BASE] = bonus[BASE] + self.points
+
+    def describe(self):
+        return f"基础积分 {self.points}分"
+
+
+class TimeWindowRule:
+    """时段奖励: 在时段内打卡时额外加分, 计入基础积分"""
+
+    def __init__(self, start, end, points):
+        self.start, self.end, self.points = start, end, points
+
+    def apply(self, state, bonus):
+        bonus[BASE] = bonus[BASE] + self.points * _in_window(state.minute, self.start, self.end)
+
+    def describe(self):
+        return f"{_format_minute(self.start)}-{_format_minute(self.end)} 打卡 +{self.points}分"
+
+
+class FirstOfDayRule:
+    """首次打卡奖励: 任务当天的前 top_n 次打卡"""
+
+    def __init__(self, points, top_n=1):
+        self.points, self.top_n = points, top_n
+
+    def apply(self, state, bonus):
+        bonus[FIRST] = bonus[FIRST] + self.points * (state.day_rank <= self.top_n)
+
+    def describe(self):
+        scope = "当天第一个打卡" if self.top_n == 1 else f"当天前{self.top_n}个打卡"
+        return f"首次打卡 {scope} +{self.points}分"
+
+
+class StreakTierRule:
+    """连续打卡奖励: 用户当天的第一次打卡按达到的最高一档发放"""
+
+    def __init__(self, tiers):
+        # [(天数, 分数)], 按天数升序, 后面的档位覆盖前面的
+        self.tiers = sorted(tiers)
+
+    def apply(self, state, bonus):
+        value = 0
+        for days, points in self.tiers:
+            value = value + (points - value) * (state.streak >= days)
+        bonus[CONSECUTIVE] = bonus[CONSECUTIVE] + value * (state.seen == 0)
+
+    def describe(self):
+        return "连续打卡 " + ", ".join(f"满{days}天 +{points}分" for days, points in self.tiers)
+
+
+class MultiplierRule:
+    """倍数: 把此前规则得到的各类积分乘以 percent / 100(四舍五入), 可限定时段"""
+
+    def __init__(self, percent, start=None, end=None):
+        self.percent, self.start, self.end = percent, start, end
+
+    def apply(self, state, bonus):
+        for i, value in enumerate(bonus):
+            scaled = (value * self.percent + 50) // 100
+            if self.start is None:
+                bonus[i] = scaled
+            else:
+                bonus[i] = value + (scaled - value) * _in_window(state.minute, self.start, self.end)
+
+    def describe(self):
+        scope = "" if self.start is None else f"{_format_minute(self.start)}-{_format_minute(self.end)} "
+        return f"{scope}积分 ×{_format_percent(self.percent)}"
+
+
+class RuleSet:
+    """一个任务编译后的奖励规则, 按顺序对同一条打卡状态逐条计算"""
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    def evaluate(self, state, zero=0):
+        """计算一次打卡(或一组打卡)的各类积分
+
+        Args:
+            state: CheckinState
+            zero: 积分的初始值, 按数组计算时传入全 0 数组
+
+        Returns:
+            dict: {积分类型: 分值}
+        """
+        bonus = [zero] * len(BONUS_TYPES)
+        for rule in self.rules:
+            rule.apply(state, bonus)
+        return dict(zip(BONUS_TYPES, bonus))
+
+    def base_value(self, minute):
+        """某个时间打卡应得的基础积分; 基础积分只与打卡时间有关, 供一致性检查补齐缺失的基础积分"""
+        return self.evaluate(CheckinState(minute, True, 0, MAX_FIRST_N + 1))["base"]
+
+    def describe(self):
+        return [rule.describe() for rule in self.rules]
+
+
+def load_extra(text):
+    """读取 t_task.reward_rules 中的附加规则, 无法解析时忽略"""
+    if not text:
+        return {}
+    try:
+        return json.loads(text)
+    except ValueError:
+        logger.warning(f"[PKTracker] 无法解析的奖励规则, 已忽略: {text}")
+        return {}
+
+
+@lru_cache(maxsize=1024)
+def compile_rules(base_score, first_enabled, first_points, consecutive_enabled, consecutive_points, extra=None):
+    """把任务的奖励设置编译为 RuleSet, 参数与 t_task 中的列一一对应
+
+    相同的设置只编译一次: 打卡时随任务一起读出这些列, 设置修改后参数不同, 自然会重新编译。
+
+    Args:
+        extra: t_task.reward_rules, 附加规则的 JSON:
+            {"first_n": 前N个打卡有首次奖励, "streak_tiers": [[天数, 分数], ...],
+             "windows": [["HH:MM", "HH:MM", 分数], ...], "multipliers": [[倍数, "HH:MM", "HH:MM"], ...]}
+    """
+    extra = load_extra(extra)
+    rules = [BaseRule(base_score)]
+    for start, end, points in extra.get("windows", []):
+        rules.append(TimeWindowRule(parse_minute(start), parse_minute(end), points))
+    if first_enabled:
+        rules.append(FirstOfDayRule(first_points, extra.get("first_n", 1)))
+    if consecutive_enabled:
+        rules.append(StreakTierRule([(STREAK_DAYS, consecutive_points)]
+                                    + [tuple(tier) for tier in extra.get("streak_tiers", [])]))
+    for factor, start, end in extra.get("multipliers", []):
+        rules.append(MultiplierRule(round(factor * 100),
+                                    None if start is None else parse_minute(start),
+                                    None if end is None else parse_minute(end)))
+    return RuleSet(rules)
+
+
+def parse_minute(text):
+    """把 HH:MM 解析为当天的分钟数"""
+    match = re.fullmatch(r"(\d{1,2}):(\d{2})", text)
+    if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+        raise ValueError(f"时间格式应为 HH:MM: {text}")
+    return int(match.group(1)) * 60 + int(match.group(2))
+
+
+def _parse_window(text):
+    start, sep, end = text.partition("-")
+    if not sep:
+        raise ValueError(f"时段格式应为 HH:MM-HH:MM: {text}")
+    parse_minute(start)
+    parse_minute(end)
+    return start, end
+
+
+def _parse_int(text, low, high, name):
+    if not text.isdigit() or not low <= int(text) <= high:
+        raise ValueError(f"{name}必须是 {low}~{high} 之间的整数")
+    return int(text)
+
+
+def parse_rule_args(args):
+    """解析设置奖励规则命令的参数, 返回附加规则
+
+    支持 n[前N个] t[天数:分数,...] w[HH:MM-HH:MM:分数] x[倍数] x[HH:MM-HH:MM:倍数], w 和 x 可以出现多次。
+
+    Raises:
+        ValueError: 参数格式错误或超出范围
+    """
+    extra = {}
+    for arg in args:
+        match = re.fullmatch(r"([ntwx])\[(.*)\]", arg)
+        if not match:
+            raise ValueError(f"无法识别的参数: {arg}")
+        key, value = match.groups()
+        if key == "n":
+            extra["first_n"] = _parse_int(value, 1, MAX_FIRST_N, "首次打卡名额")
+        elif key == "t":
+            tiers = []
+            for item in value.split(","):
+                days, _, points = item.partition(":")
+                tiers.append([_parse_int(days, 1, 366, "连续天数"), _parse_int(points, 0, 1000, "分数")])
+            if len(tiers) > MAX_STREAK_TIERS:
+                raise ValueError(f"连续打卡最多设置 {MAX_STREAK_TIERS} 档")
+            extra["streak_tiers"] = sorted(tiers)
+        elif key == "w":
+            window, _, points = value.rpartition(":")
+            extra.setdefault("windows", []).append([*_parse_window(window), _parse_int(points, 0, 1000, "分数")])
+            if len(extra["windows"]) > MAX_WINDOWS:
+                raise ValueError(f"时段奖励最多设置 {MAX_WINDOWS} 个")
+        else:
+            window, _, factor = value.rpartition(":")
+            try:
+                factor = float(factor)
+            except ValueError:
+                raise ValueError(f"倍数必须是数字: {value}")
+            if not 0 <= factor <= MAX_MULTIPLIER:
+                raise ValueError(f"倍数必须在 0~{MAX_MULTIPLIER} 之间")
+            start, end = _parse_window(window) if window else (None, None)
+            extra.setdefault("multipliers", []).append([factor, start, end])
+            if len(extra["multipliers"]) > MAX_MULTIPLIERS:
+                raise ValueError(f"倍数最多设置 {MAX_MULTIPLIERS} 个")
+    return extra
@@ -0,0 +1,113 @@
+import threading
+import time
+from datetime import date
+
+from common.log import logger
+from plugins.PKTracker.checkin_calendar import day_index, to_int
+
+# 群成员名单的默认有效期(秒), 过期后由后台任务重新获取
+ROSTER_TTL = 6 * 3600
+
+
+class GroupRoster:
+    """群成员名单缓存
+
+    名单通过群成员列表接口整群一次获取, 由后台定时任务按有效期刷新; 读取时只查内存, 不调用接口。
+    刷新失败时保留旧名单, 下次刷新再试。
+    """
+
+    def __init__(self, user_manager, ttl=ROSTER_TTL):
+        self.user_manager = user_manager
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # group_id -> (获取时间, {wxid: 昵称}), 昵称按群成员列表的顺序
+        self._rosters = {}
+
+    def members(self, group_id):
+        """缓存的群成员 {wxid: 昵称}, 还没有获取过时返回 None"""
+        with self._lock:
+            entry = self._rosters.get(group_id)
+        return entry[1] if entry else None
+
+    def stale(self, group_ids):
+        """需要刷新的群: 没有缓存或已超过有效期"""
+        now = time.monotonic()
+        with self._lock:
+            return [group_id for group_id in group_ids
+                    if group_id not in self._rosters or now - self._rosters[group_id][0] >= self.ttl]
+
+    def retain(self, group_ids):
+        """只保留这些群的名单, 不再需要提醒的群释放内存"""
+        keep = set(group_ids)
+        with self._lock:
+            for group_id in [g for g in self._rosters if g not in keep]:
+                del self._rosters[group_id]
+
+    def refresh(self, group_id):
+        """重新获取一个群的成员名单, 成功时返回 True"""
+        members = self.user_manager.get_group_members(group_id)
+        if members is None:
+            return False
+        with self._lock:
+            self._rosters[group_id] = (time.monotonic(), members)
+        logger.debug(f"[PKTracker] 已刷新群 {group_id} 的成员名单: {len(members)}人")
+        return True
+
+
+class TodayCheckins:
+    """每个任务今天打过卡的用户集合
+
+    每天第一次用到某个任务时从打卡日历读取今天打过卡的用户, 之后只按 checkin_id 水位线读取新增的打卡记录
+    追加到集合中(按主键范围读取, 与任务和用户数无关)。日历和水位线在同一个读事务中读取, 不会遗漏也不会重复;
+    checkin_id 在写事务中分配, 提交顺序与 checkin_id 顺序一致。跨天后全部清空, 按新的一天重新读取。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._day = None
+        self._watermark = 0
+        # task_id -> 今天打过卡的 user_id 集合
+        self._tasks = {}
+
+    def checked_in(self, conn, task_ids, today=None):
+        """返回 {task_id: 今天打过卡的用户集合(副本)}
+
+        Args:
+            conn: 只读连接, 不能处于事务中
+        """
+        today = today or date.today()
+        c = conn.cursor()
+        with self._lock:
+            # 水位线、新增记录和日历在同一个读事务中读取
+            c.execute("BEGIN")
+            try:
+                if today != self._day:
+                    self._day, self._tasks = today, {}
+                    c.execute("SELECT COALESCE(MAX(checkin_id), 0) FROM t_checkin_log")
+                    self._watermark = c.fetchone()[0]
+                else:
+                    self._catch_up(c, today)
+                for task_id in task_ids:
+                    if task_id not in self._tasks:
+                        self._tasks[task_id] = self._load(c, task_id, today)
+            finally:
+                conn.rollback()
+            return {task_id: set(self._tasks[task_id]) for task_id in task_ids}
+
+    def _catch_up(self, cursor, today):
+        cursor.execute("""SELECT checkin_id, task_id, user_id, checkin_time FROM t_checkin_log
+                          WHERE checkin_id > ?""", (self._watermark,))
+        day = today.isoformat()
+        for checkin_id, task_id, user_id, checkin_time in cursor.fetchall():
+            self._watermark = max(self._watermark, checkin_id)
+            # 还没有读取过的任务以后从日历读取, 不需要在这里记录
+            users = self._tasks.get(task_id)
+            if users is not None and checkin_time[:10] == day:
+                users.add(user_id)
+
+    @staticmethod
+    def _load(cursor, task_id, today):
+        bit = 1 << day_index(today)
+        cursor.execute("SELECT user_id, bits FROM t_checkin_calendar WHERE task_id = ? AND year = ?",
+                       (task_id, today.year))
+        return {user_id for user_id, bits in cursor.fetchall() if to_int(bits) & bit}
@@ -1,8 +1,11 @@
 import gc
-import sqlite3
+import os
 import threading
 import time
-from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta
+from functools import wraps
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
@@ -13,13 +16,48 @@ from bridge.reply import Reply, ReplyType
 from channel import channel_factory
 from channel.chat_message import ChatMessage
 from common.log import logger
+from plugins.PKTracker.backup import BackupManager
+from plugins.PKTracker.checkin_calendar import period_counts
+from plugins.PKTracker.consistency import ConsistencyChecker, save_report
+from plugins.PKTracker.daily_stats import record_settlement
+from plugins.PKTracker.database import get_connection
+from plugins.PKTracker.leader import SchedulerLease
+from plugins.PKTracker.metrics import metrics
+from plugins.PKTracker.rank_index import RankIndex
+from plugins.PKTracker.roster import GroupRoster, TodayCheckins
+from plugins.PKTracker.shards import shards
+from plugins.PKTracker.task_manager import TaskManager
+
+# 提醒中默认最多 @ 的未打卡人数, 其余只显示人数
+REMINDER_MENTION_LIMIT = 20
+
+# 每日排行榜展示的人数
+DAILY_RANKING_TOP_N = 10
+
+# 冠军通知文案: 周期 -> (标题, 冠军称号, 下一周期)
+CHAMPION_TEXT = {
+    "week": ("周冠军公告", "上周冠军", "本周"),
+    "month": ("月度冠军公告", "上月冠军", "本月"),
+}
+
+
+def previous_week(today):
+    """today 之前最近一个完整的周(周一至周日)"""
+    end = today - timedelta(days=today.weekday() + 1)
+    return end - timedelta(days=6), end
+
+
+def previous_month(today):
+    """today 之前最近一个完整的自然月"""
+    end = today.replace(day=1) - timedelta(days=1)
+    return end.replace(day=1), end
 
 
 class TaskScheduler:
     _instance = None
     _initialized = False
     _scheduler = None
-    _lock = threading.Lock()
+    _lock = threading.RLock()
 
     def __new__(cls, *args, **kwargs):
         if not hasattr(cls, '_instance') or cls._instance is None:
@@ -32,12 +70,38 @@ class TaskScheduler:
                     cls._instance._jobs_initialized = False
         return cls._instance
 
-    def __init__(self, db_path, user_manager):
+    def __init__(self, db_path, plugin):
         with self._lock:
             if not self._initialized:
                 self.db_path = db_path
                 self.channel = None
-                self.user_manager = user_manager
+                self.plugin = plugin
+                self.user_manager = plugin.user_manager
+                self.task_manager = TaskManager(db_path)
+                # 提醒时 @ 未打卡成员: 群成员名单由后台任务刷新, 今天的打卡用户集合按水位线增量更新
+                self.roster = GroupRoster(self.user_manager, ttl=plugin.config.get("roster_ttl_minutes", 360) * 60)
+                self._today_checkins_by_db = {}
+                # 每日排行榜与积分榜使用同样的累计排名索引, 按群增量更新
+                self.rank_index = RankIndex()
+                self._consistency_lock = threading.Lock()
+                # 在线备份: 分步复制, 不长时间阻塞打卡
+                backup_config = plugin.config.get("backup", {})
+                self.backup = BackupManager(
+                    db_path,
+                    os.path.join(os.path.dirname(__file__), backup_config.get("directory", "backups")),
+                    keep=backup_config.get("keep", 7),
+                    step_pages=backup_config.get("step_pages", 256),
+                    pause=backup_config.get("pause_ms", 20) / 1000
+                )
+                self._backup_lock = threading.Lock()
+                # 多进程共用数据库时只有持有租约的进程执行定时任务
+                self.lease = None
+                if plugin.config.get("scheduler_leader_election", True):
+                    self.lease = SchedulerLease(
+                        db_path,
+                        ttl=plugin.config.get("scheduler_lease_ttl", 15),
+                        heartbeat_interval=plugin.config.get("scheduler_heartbeat_interval", 5)
+                    )
                 self._scheduler = BackgroundScheduler(
                     timezone='Asia/Shanghai',
                     job_defaults={
@@ -52,12 +116,24 @@ class TaskScheduler:
                         }
                     }
                 )
+                # 定时任务按群组分发到工作线程池并行执行, 调度器本身仍然只有一个工作线程, 任务之间不会重叠
+                self.job_deadline = plugin.config.get("scheduler_job_deadline", 300)
+                self._executor = ThreadPoolExecutor(
+                    max_workers=plugin.config.get("scheduler_job_workers", 8),
+                    thread_name_prefix="PKTracker-job"
+                )
                 self._init_scheduler()
                 self._initialized = True
 
+    @property
+    def scheduler(self):
+        return self._scheduler
+
     def start_scheduler(self):
         """启动调度器"""
         if not self._scheduler.running:
+            if self.lease:
+                self.lease.start()
             self._scheduler.start()
             logger.info("[PKTracker] 调度器已启动")
 
@@ -65,9 +141,81 @@ class TaskScheduler:
         """停止调度器"""
         if self._scheduler and self._scheduler.running:
             self._scheduler.shutdown(wait=False)
+            if self.lease:
+                self.lease.stop()
+            self._executor.shutdown(wait=False, cancel_futures=True)
             self._initialized = False
             logger.info("[PKTracker] 调度器已停止")
 
+    def _leader_only(self, job):
+        """包装定时任务, 只在当前进程持有调度器租约时执行"""
+
+        @wraps(job)
+        def wrapper():
+            # 执行前再续约一次, 确认租约没有在心跳间隔内被其他进程接管
+            if self.lease and not self.lease.try_acquire():
+                logger.debug(f"[PKTracker] 非主节点, 跳过定时任务 {job.__name__}")
+                return
+            return job()
+
+        return wrapper
+
+    def _fan_out(self, job_name, work_by_group, handler):
+        """按群组把工作项分发到线程池执行
+
+        同一群组的工作项在一个线程中按顺序执行(保证群内消息顺序), 不同群组并行;
+        单个工作项失败只记录日志, 不影响同群的其他工作项和其他群组。超过截止时间后,
+        尚未开始的群组被取消, 正在执行的群组跳过剩余工作项。每个群组的耗时记录在
+        "<任务名>/群组" 指标中。
+
+        Args:
+            job_name: 定时任务名称, 用于日志和指标
+            work_by_group: {group_id: [工作项参数元组, ...]}
+            handler: 处理单个工作项的函数, 以 handler(*工作项) 调用
+
+        Returns:
+            dict: 群组总数, 以及完成、失败、超时取消和超时后仍在执行的群组数
+        """
+        deadline = time.monotonic() + self.job_deadline
+        result = {"groups": len(work_by_group), "done": 0, "failed": 0, "timeout": 0}
+        counter_lock = threading.Lock()
+
+        def run_group(group_id, items):
+            start = time.perf_counter()
+            outcome = "done"
+            try:
+                for idx, item in enumerate(items):
+                    if time.monotonic() > deadline:
+                        logger.warning(f"[PKTracker] {job_name} 群组 {group_id} 超过截止时间, "
+                                       f"跳过剩余 {len(items) - idx} 项")
+                        outcome = "timeout"
+                        break
+                    try:
+                        handler(*item)
+                    except Exception as e:
+                        logger.error(f"[PKTracker] {job_name} 群组 {group_id} 处理失败: {str(e)}")
+                        outcome = "failed"
+            finally:
+                metrics.record("job", f"{job_name}/群组", time.perf_counter() - start)
+                with counter_lock:
+                    result[outcome] += 1
+
+        futures = {self._executor.submit(run_group, group_id, items): group_id
+                   for group_id, items in work_by_group.items()}
+        _, not_done = wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+        for future in not_done:
+            if future.cancel():
+                with counter_lock:
+                    result["timeout"] += 1
+                logger.warning(f"[PKTracker] {job_name} 群组 {futures[future]} 超过截止时间, 已取消")
+        with counter_lock:
+            # 超过截止时间时仍在执行的群组, 会在跳过剩余工作项后结束
+            result["running"] = result["groups"] - result["done"] - result["failed"] - result["timeout"]
+
+        if result["failed"] or result["timeout"] or result["running"]:
+            logger.warning(f"[PKTracker] {job_name} 完成: {result}")
+        return result
+
     def _init_scheduler(self):
         """初始化定时任务"""
         with self._lock:
@@ -78,20 +226,30 @@ class TaskScheduler:
 
             # 添加新任务，使用固定的任务ID
             self.scheduler.add_job(
-                self.check_reminders,
+                self._leader_only(self.check_reminders),
                 CronTrigger(minute='*'),
                 id='check_reminders',
                 replace_existing=True,
                 max_instances=1
             )
 
+        # 定时刷新设置了提醒的群的成员名单, 启动后立即执行一次, 提醒时只读取缓存
+        roster_interval = self.plugin.config.get("roster_refresh_minutes", 10)
+        if roster_interval:
+            self.scheduler.add_job(
+                self._leader_only(self.refresh_rosters),
+                CronTrigger(minute=f'*/{roster_interval}'),
+                id='refresh_rosters',
+                next_run_time=datetime.now(self.scheduler.timezone)
+            )
+
         # 从配置文件获取每日排行榜发送时间
-        daily_ranking_time = self.user_manager.config.get("daily_ranking_time")  # 从配置文件获取时间
+        daily_ranking_time = self.plugin.config.get("daily_ranking_time")  # 从配置文件获取时间
         if daily_ranking_time:  # 只有在设置了时间时才添加定时任务
             try:
                 hour, minute = map(int, daily_ranking_time.split(':'))
                 self.scheduler.add_job(
-                    self.send_daily_ranking,
+                    self._leader_only(self.send_daily_ranking),
                     CronTrigger(hour=hour, minute=minute),
                     id='daily_ranking'
                 )
@@ -99,74 +257,148 @@ class TaskScheduler:
             except Exception as e:
                 logger.error(f"[PKTracker] 设置每日排行榜定时任务失败: {str(e)}")
 
-        # 每周晚上23:00处理周奖励
+        # 周/月奖励在周期结束后的第一天 00:05 结算刚结束的完整周期(上周一至周日 / 上个月),
+        # 周期最后一天 23:59:59 之前的打卡都会计入; 结算积分的 create_time 和日汇总的日期取被结算周期的最后一天,
+        # 与打卡积分一样使用本地时间, 积分榜 w[上周]/w[上月] 包含该奖励, 与服务器时区无关
         self.scheduler.add_job(
-            self.process_weekly_rewards,
-            CronTrigger(day_of_week='sun', hour=23),
+            self._leader_only(self.process_weekly_rewards),
+            CronTrigger(day_of_week='mon', hour=0, minute=5),
             id='weekly_rewards'
         )
 
-        # 每月最后一天23:00处理月奖励
         self.scheduler.add_job(
-            self.process_monthly_rewards,
-            CronTrigger(day='last', hour=23),
+            self._leader_only(self.process_monthly_rewards),
+            CronTrigger(day=1, hour=0, minute=5),
             id='monthly_rewards'
         )
 
+        # 每分钟分批清理已删除任务的历史数据, 删除任务后会立即触发一次
+        self.scheduler.add_job(
+            self._leader_only(self.purge_deleted_tasks),
+            CronTrigger(minute='*'),
+            id='purge_deleted_tasks'
+        )
+
+        # 每天低峰期在后台做一次数据一致性检查
+        consistency_time = self.plugin.config.get("consistency_check_time", "04:30")
+        if consistency_time:
+            try:
+                hour, minute = map(int, consistency_time.split(':'))
+                self.scheduler.add_job(
+                    self._leader_only(self.check_consistency),
+                    CronTrigger(hour=hour, minute=minute),
+                    id='check_consistency'
+                )
+            except Exception as e:
+                logger.error(f"[PKTracker] 设置一致性检查定时任务失败: {str(e)}")
+
+        # 每天低峰期在后台做一次数据库在线备份
+        backup_time = self.plugin.config.get("backup", {}).get("time", "03:30")
+        if backup_time:
+            try:
+                hour, minute = map(int, backup_time.split(':'))
+                self.scheduler.add_job(
+                    self._leader_only(self.backup_database),
+                    CronTrigger(hour=hour, minute=minute),
+                    id='backup_database'
+                )
+            except Exception as e:
+                logger.error(f"[PKTracker] 设置数据库备份定时任务失败: {str(e)}")
+
+        # 定时把新的打卡和积分记录增量同步到分析库
+        if getattr(self.plugin, "analytics", None) is not None:
+            interval = self.plugin.config.get("analytics_mirror", {}).get("sync_minutes", 10)
+            self.scheduler.add_job(
+                self._leader_only(self.sync_analytics),
+                CronTrigger(minute=f'*/{interval}'),
+                id='sync_analytics'
+            )
+
+    def run_soon(self, job_id):
+        """让指定的定时任务尽快执行一次, 之后按原有周期继续"""
+        try:
+            self.scheduler.modify_job(job_id, next_run_time=datetime.now(self.scheduler.timezone))
+        except Exception as e:
+            logger.warning(f"[PKTracker] 触发定时任务 {job_id} 失败: {str(e)}")
+
+    @metrics.timed("job")
     def check_reminders(self):
         """检查并触发到期的提醒"""
-        conn = None
+        tasks = []
         try:
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
-
             now = datetime.now()
             current_time = now.strftime('%H:%M')
 
-            # 获取所有启用的任务
-            c.execute("""
-                SELECT t.task_id, t.group_id, t.task_name, t.reminder_time, t.remind_text,
-                       COUNT(DISTINCT cl.user_id) as checked_users
-                FROM t_task t
-                LEFT JOIN t_checkin_log cl ON t.task_id = cl.task_id 
-                    AND date(cl.checkin_time) = date('now')
-                WHERE t.enable = 1 
-                    AND t.reminder_time = ?
-                    AND t.reminder_time IS NOT NULL
-                GROUP BY t.task_id
-            """, (current_time,))
-
-            tasks = c.fetchall()
+            # 按群组分库时依次读取每个分库; task_id 只在所属的库内唯一, 今天的打卡用户集合也按库分别维护
+            for db_path in shards.paths(self.db_path):
+                conn = get_connection(db_path, readonly=True)
+                try:
+                    c = conn.cursor()
+                    # 获取所有到达提醒时间的启用任务
+                    c.execute("""SELECT task_id, group_id, task_name, remind_text FROM t_task
+                                 WHERE enable = 1 AND reminder_time = ?""", (current_time,))
+                    due = c.fetchall()
+                    if due:
+                        checked = self._today_checkins(db_path).checked_in(conn, [task[0] for task in due])
+                        tasks += [(checked[task[0]],) + task[1:] for task in due]
+                finally:
+                    conn.close()
+
             # 打印tasks的size
             logger.info(f"[PKTracker] 当前时间: {current_time}, 任务数量: {len(tasks)}")
-
-            for task in tasks:
-                task_id, group_id, task_name, reminder_time, remind_text, checked_users = task
-
-                # 构建提醒消息
-                message = f"⏰ 任务提醒 [{task_name}]\n"
-                message += "===================\n\n"
-
-                if remind_text:
-                    message += f"📝 {remind_text}\n\n"
-
-                message += f"🔸 今日已打卡: {checked_users}人\n"
-                message += "\n💡 快来打卡啦~记得使用以下格式:\n"
-                message += f"PKTracker [{task_name}] 打卡内容"
-
-                # 发送提醒消息
-                self._send_reminder(group_id, message)
-
-                logger.info(f"[PKTracker] 已发送任务 [{task_name}] 的提醒消息到群组 {group_id}")
-
         except Exception as e:
             logger.error(f"[PKTracker] 检查提醒异常: {str(e)}")
-        finally:
-            if conn:
-                conn.close()
+            return
 
-    def _send_reminder(self, group_id: str, message: str):
-        """发送提醒消息"""
+        mention_limit = self.plugin.config.get("reminder_mention_limit", REMINDER_MENTION_LIMIT)
+        reminders = defaultdict(list)
+        for checked_users, group_id, task_name, remind_text in tasks:
+            # 构建提醒消息
+            message = f"⏰ 任务提醒 [{task_name}]\n"
+            message += "===================\n\n"
+
+            if remind_text:
+                message += f"📝 {remind_text}\n\n"
+
+            message += f"🔸 今日已打卡: {len(checked_users)}人\n"
+            # 名单还没有获取到时只显示人数; 未打卡成员在内存中求差集, 不查询数据库也不调用接口
+            members = self.roster.members(group_id)
+            ats = None
+            if members and mention_limit:
+                pending = [wxid for wxid in members if wxid not in checked_users]
+                if pending:
+                    mentioned = pending[:mention_limit]
+                    message += f"🔸 还未打卡: {len(pending)}人\n"
+                    message += " ".join(f"@{members[wxid]}" for wxid in mentioned)
+                    if len(pending) > len(mentioned):
+                        message += f" 等{len(pending)}人"
+                    message += "\n"
+                    ats = ",".join(mentioned)
+            message += "\n💡 快来打卡啦~记得使用以下格式:\n"
+            message += f"PKTracker [{task_name}] 打卡内容"
+            reminders[group_id].append((group_id, task_name, message, ats))
+
+        # 各群组并行发送提醒消息
+        self._fan_out("check_reminders", reminders, self._send_task_reminder)
+
+    def _today_checkins(self, db_path):
+        """数据库对应的今天打卡用户集合, 按群组分库时每个分库一份"""
+        today_checkins = self._today_checkins_by_db.get(db_path)
+        if today_checkins is None:
+            today_checkins = self._today_checkins_by_db[db_path] = TodayCheckins()
+        return today_checkins
+
+    def _send_task_reminder(self, group_id: str, task_name: str, message: str, ats: str = None):
+        """发送单个任务的提醒消息"""
+        self._send_reminder(group_id, message, ats)
+        logger.info(f"[PKTracker] 已发送任务 [{task_name}] 的提醒消息到群组 {group_id}")
+
+    def _send_reminder(self, group_id: str, message: str, ats: str = None):
+        """发送提醒消息
+
+        Args:
+            ats: 需要 @ 的成员 wxid, 多个用逗号分隔; 群消息的 actual_user_id 会作为 @ 的对象发送
+        """
         try:
             # 构建消息上下文
             context = Context(ContextType.TEXT, message)
@@ -179,7 +411,7 @@ class TaskScheduler:
             msg.is_group = True
             msg.other_user_id = group_id
             msg.to_user_id = group_id
-            msg.actual_user_id = group_id
+            msg.actual_user_id = ats or group_id
             context["msg"] = msg
 
             # 构建回复消息
@@ -190,7 +422,8 @@ class TaskScheduler:
             channel = channel_factory.create_channel(channel_name)
 
             # 发送消息
-            channel.send(reply, context)
+            with metrics.timer("http", "channel.send"):
+                channel.send(reply, context)
 
             logger.info(f"[PKTracker] 成功发送消息到群组 {group_id}")
             return True
@@ -198,155 +431,294 @@ class TaskScheduler:
             logger.error(f"[PKTracker] 发送提醒消息失败: {str(e)}")
             return False
 
+    @metrics.timed("job")
     def process_weekly_rewards(self):
         """处理每周奖励"""
-        conn = None
-        try:
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
+        winners = defaultdict(list)
+        # 按群组分库时每个分库单独一个事务结算, 一个分库失败不影响其他分库
+        for db_path in shards.paths(self.db_path):
+            conn = None
+            settled = []
+            try:
+                conn = get_connection(db_path)
+                c = conn.cursor()
 
-            # 获取所有启用周奖励的任务
-            c.execute("""
-                SELECT t.task_id, t.group_id, t.task_name, t.week_checkin_reward
-                FROM t_task t
-                WHERE t.enable = 1 
-                    AND t.week_checkin_reward_enabled = 1
-                    AND t.week_checkin_reward IS NOT NULL
-            """)
-
-            tasks = c.fetchall()
-            for task_id, group_id, task_name, bonus in tasks:
-                # 获取本周打卡记录及次数最多的用户
+                # 获取所有启用周奖励的任务
                 c.execute("""
-                    WITH weekly_checkins AS (
-                        SELECT 
-                            cl.checkin_id,
-                            cl.user_id,
-                            COUNT(*) as checkin_count
-                        FROM t_checkin_log cl
-                        WHERE cl.task_id = ? 
-                            AND cl.checkin_time >= date('now', 'weekday 0', '-7 days')
-                            AND cl.checkin_time < date('now', 'weekday 0')
-                        GROUP BY cl.user_id
-                        ORDER BY checkin_count DESC
-                        LIMIT 1
-                    )
-                    SELECT checkin_id, user_id, checkin_count
-                    FROM weekly_checkins
-                """, (task_id,))
-
-                winner = c.fetchone()
-                if winner:
-                    checkin_id, user_id, checkin_count = winner
-                    # 获取用户昵称
-                    nicknames = self.user_manager._get_nickname_by_user_ids([user_id])
-                    user_name = nicknames.get(user_id, "未知用户")
-
-                    # 记录周奖励
-                    c.execute("""
-                        INSERT INTO t_bonus (
-                            task_id, user_id, checkin_id, bonus_type, 
-                            bonus_value, create_time
-                        ) VALUES (?, ?, ?, 'week', ?, CURRENT_TIMESTAMP)
-                    """, (task_id, user_id, checkin_id, bonus))
+                    SELECT t.task_id, t.group_id, t.task_name, t.week_checkin_reward
+                    FROM t_task t
+                    WHERE t.enable = 1 
+                        AND t.week_checkin_reward_enabled = 1
+                        AND t.week_checkin_reward IS NOT NULL
+                """)
+
+                tasks = c.fetchall()
+                start, end = previous_week(date.today())
+                # 奖励记在被结算周期最后一天的 23:59:59, 格式与打卡时间一致
+                settled_at = f"{end} 23:59:59"
+                for task_id, group_id, task_name, bonus in tasks:
+                    # 上周(周一至周日)打卡天数最多的用户
+                    winner = self._find_champion(c, task_id, start, end)
+                    if winner:
+                        checkin_id, user_id, checkin_days = winner
+
+                        # 记录周奖励
+                        c.execute("""
+                            INSERT INTO t_bonus (
+                                task_id, user_id, checkin_id, bonus_type, 
+                                bonus_value, create_time
+                            ) VALUES (?, ?, ?, 'week', ?, ?)
+                        """, (task_id, user_id, checkin_id, bonus, settled_at))
+                        record_settlement(c, task_id, user_id, 'week', bonus, end.isoformat())
+                        settled.append((group_id, task_name, user_id, checkin_days, bonus, "week"))
+
+                conn.commit()
+                # 提交成功后才发送获奖通知
+                for item in settled:
+                    winners[item[0]].append(item)
 
-                    # 发送获奖通知
-                    message = f"🎉 周冠军公告 [{task_name}]\n"
-                    message += "===================\n\n"
-                    message += f"👑 本周冠军: {user_name}\n"
-                    message += f"📊 打卡次数: {checkin_count}次\n"
-                    message += f"🎁 奖励积分: {bonus}分\n"
-                    message += "\n继续加油,下周等你来战！💪"
-
-                    self._send_reminder(group_id, message)
-
-            conn.commit()
+            except Exception as e:
+                logger.error(f"[PKTracker] 处理周奖励异常: {str(e)}")
+                if conn:
+                    conn.rollback()
+            finally:
+                if conn:
+                    conn.close()
 
-        except Exception as e:
-            logger.error(f"[PKTracker] 处理周奖励异常: {str(e)}")
-            if conn:
-                conn.rollback()
-        finally:
-            if conn:
-                conn.close()
+        # 结算在每个库的事务中串行完成, 获奖通知(查询昵称、发送消息)按群组并行
+        self._fan_out("process_weekly_rewards", winners, self._send_champion_notice)
 
+    @metrics.timed("job")
     def process_monthly_rewards(self):
         """处理每月奖励"""
-        conn = None
-        try:
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
+        winners = defaultdict(list)
+        # 按群组分库时每个分库单独一个事务结算, 一个分库失败不影响其他分库
+        for db_path in shards.paths(self.db_path):
+            conn = None
+            settled = []
+            try:
+                conn = get_connection(db_path)
+                c = conn.cursor()
 
-            # 获取所有启用月奖励的任务
-            c.execute("""
-                SELECT t.task_id, t.group_id, t.task_name, t.month_checkin_reward
-                FROM t_task t
-                WHERE t.enable = 1 
-                    AND t.month_checkin_reward_enabled = 1
-                    AND t.month_checkin_reward IS NOT NULL
-            """)
-
-            tasks = c.fetchall()
-            for task_id, group_id, task_name, bonus in tasks:
-                # 获取上月打卡记录及次数最多的用户
+                # 获取所有启用月奖励的任务
                 c.execute("""
-                    WITH monthly_checkins AS (
-                        SELECT 
-                            cl.checkin_id,
-                            cl.user_id,
-                            COUNT(*) as checkin_count
-                        FROM t_checkin_log cl
-                        WHERE cl.task_id = ? 
-                            AND cl.checkin_time >= date('now', 'start of month', '-1 month')
-                            AND cl.checkin_time < date('now', 'start of month')
-                        GROUP BY cl.user_id
-                        ORDER BY checkin_count DESC
-                        LIMIT 1
-                    )
-                    SELECT checkin_id, user_id, checkin_count
-                    FROM monthly_checkins
-                """, (task_id,))
-
-                winner = c.fetchone()
-                if winner:
-                    checkin_id, user_id, checkin_count = winner
-                    # 获取用户昵称
-                    nicknames = self.user_manager._get_nickname_by_user_ids([user_id])
-                    user_name = nicknames.get(user_id, "未知用户")
-
-                    # 记录月奖励
-                    c.execute("""
-                        INSERT INTO t_bonus (
-                            task_id, user_id, checkin_id, bonus_type, 
-                            bonus_value, create_time
-                        ) VALUES (?, ?, ?, 'month', ?, CURRENT_TIMESTAMP)
-                    """, (task_id, user_id, checkin_id, bonus))
-
-                    # 发送获奖通知
-                    message = f"🎉 月度冠军公告 [{task_name}]\n"
-                    message += "===================\n\n"
-                    message += f"👑 本月冠军: {user_name}\n"
-                    message += f"📊 打卡次数: {checkin_count}次\n"
-                    message += f"🎁 奖励积分: {bonus}分\n"
-                    message += "\n继续加油,下月等你来战！💪"
+                    SELECT t.task_id, t.group_id, t.task_name, t.month_checkin_reward
+                    FROM t_task t
+                    WHERE t.enable = 1 
+                        AND t.month_checkin_reward_enabled = 1
+                        AND t.month_checkin_reward IS NOT NULL
+                """)
+
+                tasks = c.fetchall()
+                start, end = previous_month(date.today())
+                # 奖励记在被结算周期最后一天的 23:59:59, 格式与打卡时间一致
+                settled_at = f"{end} 23:59:59"
+                for task_id, group_id, task_name, bonus in tasks:
+                    # 上个月打卡天数最多的用户
+                    winner = self._find_champion(c, task_id, start, end)
+                    if winner:
+                        checkin_id, user_id, checkin_days = winner
+
+                        # 记录月奖励
+                        c.execute("""
+                            INSERT INTO t_bonus (
+                                task_id, user_id, checkin_id, bonus_type, 
+                                bonus_value, create_time
+                            ) VALUES (?, ?, ?, 'month', ?, ?)
+                        """, (task_id, user_id, checkin_id, bonus, settled_at))
+                        record_settlement(c, task_id, user_id, 'month', bonus, end.isoformat())
+                        settled.append((group_id, task_name, user_id, checkin_days, bonus, "month"))
+
+                conn.commit()
+                # 提交成功后才发送获奖通知
+                for item in settled:
+                    winners[item[0]].append(item)
 
-                    self._send_reminder(group_id, message)
+            except Exception as e:
+                logger.error(f"[PKTracker] 处理月奖励异常: {str(e)}")
+                if conn:
+                    conn.rollback()
+            finally:
+                if conn:
+                    conn.close()
+
+        self._fan_out("process_monthly_rewards", winners, self._send_champion_notice)
+
+    @staticmethod
+    def _find_champion(cursor, task_id, start, end):
+        """按打卡日历统计 [start, end] 内打卡天数最多的用户, 天数相同时按用户ID排序
+
+        Returns:
+            tuple: (奖励关联的打卡ID, 用户ID, 打卡天数), 期间无人打卡时返回 None
+        """
+        counts = period_counts(cursor, task_id, start, end)
+        if not counts:
+            return None
+        user_id, days = min(counts.items(), key=lambda item: (-item[1], item[0]))
+        # 奖励关联到冠军在本期最后一次打卡
+        cursor.execute("""SELECT MAX(checkin_id) FROM t_checkin_log
+                          WHERE task_id = ? AND user_id = ? AND checkin_time >= ? AND checkin_time <= ?""",
+                       (task_id, user_id, f"{start.isoformat()} 00:00:00", f"{end.isoformat()} 23:59:59"))
+        return cursor.fetchone()[0], user_id, days
+
+    def _send_champion_notice(self, group_id, task_name, user_id, checkin_days, bonus, period):
+        """发送周/月冠军通知"""
+        # 获取用户昵称
+        nicknames = self.user_manager._get_nickname_by_user_ids([user_id])
+        user_name = nicknames.get(user_id, "未知用户")
+
+        title, champion, next_period = CHAMPION_TEXT[period]
+        message = f"🎉 {title} [{task_name}]\n"
+        message += "===================\n\n"
+        message += f"👑 {champion}: {user_name}\n"
+        message += f"📊 打卡天数: {checkin_days}天\n"
+        message += f"🎁 奖励积分: {bonus}分\n"
+        message += f"\n继续加油,{next_period}等你来战！💪"
+
+        self._send_reminder(group_id, message)
+
+    @metrics.timed("job")
+    def purge_deleted_tasks(self):
+        """分批清理已删除任务的打卡和积分记录, 清理完成后通知对应群组"""
+        config = self.plugin.config
+        try:
+            finished = self.task_manager.purge_deleted_tasks(
+                batch_size=config.get("task_purge_batch_size", 500),
+                pause=config.get("task_purge_pause_ms", 50) / 1000,
+                max_seconds=config.get("task_purge_max_seconds", 20)
+            )
+        except Exception as e:
+            logger.error(f"[PKTracker] 清理已删除任务异常: {str(e)}")
+            return
+
+        for group_id, task_name, deleted_rows in finished:
+            # 一致性检查登记的孤立数据没有所属群组
+            if not group_id:
+                continue
+            self._send_reminder(group_id, f"🧹 任务 [{task_name}] 的历史数据已清理完成, 共删除 {deleted_rows} 条记录")
+
+    def check_consistency(self, repair=None):
+        """把一致性检查交给工作线程池执行, 扫描全表耗时较长, 不能占用调度器唯一的工作线程或消息处理线程
+
+        Args:
+            repair: 是否修复, None 表示按配置 consistency_auto_repair
+
+        Returns:
+            bool: 已提交返回 True, 已有检查在进行中时返回 False
+        """
+        if self._consistency_lock.locked():
+            logger.info("[PKTracker] 一致性检查正在进行中, 跳过")
+            return False
+        if repair is None:
+            repair = self.plugin.config.get("consistency_auto_repair", False)
+        self._executor.submit(self.run_consistency_check, repair)
+        return True
+
+    @metrics.timed("job")
+    def run_consistency_check(self, repair=False):
+        """执行一次数据一致性检查并保存报告
+
+        Returns:
+            dict: 检查报告, 已有检查在进行中时返回 None
+        """
+        if not self._consistency_lock.acquire(blocking=False):
+            logger.info("[PKTracker] 一致性检查正在进行中, 跳过")
+            return None
+        try:
+            config = self.plugin.config
+            report = ConsistencyChecker(self.db_path).run(
+                repair=repair,
+                batch_size=config.get("consistency_batch_size", 1000),
+                pause=config.get("consistency_pause_ms", 10) / 1000
+            )
+            save_report(self.consistency_report_path, report)
+            problems = sum(report["findings"].values())
+            if problems:
+                logger.warning(f"[PKTracker] 一致性检查发现 {problems} 个问题: {report['findings']}")
+            else:
+                logger.info(f"[PKTracker] 一致性检查完成, 未发现问题, 耗时 {report['duration_s']}s")
+            return report
+        except Exception as e:
+            logger.error(f"[PKTracker] 一致性检查异常: {str(e)}")
+            return None
+        finally:
+            self._consistency_lock.release()
 
-            conn.commit()
+    def backup_database(self):
+        """把备份交给工作线程池执行, 分步复制期间会多次休眠, 不能占用调度器唯一的工作线程或消息处理线程
 
-        except Exception as e:
-            logger.error(f"[PKTracker] 处理月奖励异常: {str(e)}")
-            if conn:
-                conn.rollback()
+        Returns:
+            bool: 已提交返回 True, 已有备份在进行中时返回 False
+        """
+        if self._backup_lock.locked():
+            logger.info("[PKTracker] 数据库备份正在进行中, 跳过")
+            return False
+        self._executor.submit(self.run_backup)
+        return True
+
+    @metrics.timed("job")
+    def run_backup(self):
+        """执行一次在线备份
+
+        Returns:
+            dict: 备份报告, 已有备份在进行中时返回 None
+        """
+        if not self._backup_lock.acquire(blocking=False):
+            logger.info("[PKTracker] 数据库备份正在进行中, 跳过")
+            return None
+        try:
+            report = self.backup.run()
+            if report["ok"]:
+                logger.info(f"[PKTracker] 数据库备份完成: {report['snapshot']}, "
+                            f"{report['size']}字节, 耗时 {report['duration_s']}s")
+            return report
         finally:
-            if conn:
-                conn.close()
+            self._backup_lock.release()
 
-    def send_ranking_list(self, task_id):
-        """发送任务排行榜"""
+    @metrics.timed("job")
+    def refresh_rosters(self):
+        """刷新设置了提醒的群中已过期的成员名单, 各群并行调用接口"""
+        group_ids = []
+        try:
+            for db_path in shards.paths(self.db_path):
+                conn = get_connection(db_path, readonly=True)
+                try:
+                    c = conn.cursor()
+                    c.execute("""SELECT DISTINCT group_id FROM t_task
+                                 WHERE enable = 1 AND reminder_time IS NOT NULL""")
+                    group_ids += [row[0] for row in c.fetchall()]
+                finally:
+                    conn.close()
+        except Exception as e:
+            logger.error(f"[PKTracker] 读取提醒群组失败: {str(e)}")
+            return
+        self.roster.retain(group_ids)
+        stale = self.roster.stale(group_ids)
+        if stale:
+            self._fan_out("refresh_rosters", {group_id: [(group_id,)] for group_id in stale}, self.roster.refresh)
+
+    def sync_analytics(self):
+        """把分析库同步交给工作线程池执行, 首次同步需要复制全部历史记录"""
+        self._executor.submit(self.run_analytics_sync)
+
+    @metrics.timed("job")
+    def run_analytics_sync(self):
+        return self.plugin.analytics.sync()
+
+    @property
+    def consistency_report_path(self):
+        file_name = self.plugin.config.get("consistency_report_file", "consistency_report.json")
+        return os.path.join(os.path.dirname(__file__), file_name)
+
+    def send_ranking_list(self, task_id, group_id=None):
+        """发送任务排行榜
+
+        Args:
+            group_id: 任务所属的群组, 按群组分库时用于定位分库
+        """
         conn = None
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id) if group_id else self.db_path, readonly=True)
             c = conn.cursor()
 
             # 获取任务信息
@@ -363,62 +735,31 @@ class TaskScheduler:
 
             group_id, task_name = task
 
-            # 获取排行榜数据
-            c.execute("""
-                WITH checkin_stats AS (
-                    -- 计算基础打卡次数和对应的基础积分
-                    SELECT 
-                        cl.user_id,
-                        COUNT(*) as checkin_count,
-                        SUM(COALESCE(
-                            (SELECT b.bonus_value 
-                             FROM t_bonus b 
-                             WHERE b.checkin_id = cl.checkin_id 
-                             AND b.bonus_type = 'base'), 0)
-                        ) as base_points,
-                        SUM(COALESCE(
-                            (SELECT b.bonus_value 
-                             FROM t_bonus b 
-                             WHERE b.checkin_id = cl.checkin_id 
-                             AND b.bonus_type = 'first'), 0)
-                        ) as first_points,
-                        SUM(COALESCE(
-                            (SELECT b.bonus_value 
-                             FROM t_bonus b 
-                             WHERE b.checkin_id = cl.checkin_id 
-                             AND b.bonus_type = 'consecutive'), 0)
-                        ) as consecutive_points,
-                        SUM(COALESCE(
-                            (SELECT b.bonus_value 
-                             FROM t_bonus b 
-                             WHERE b.checkin_id = cl.checkin_id 
-                             AND b.bonus_type IN ('week', 'month')), 0)
-                        ) as special_points
-                    FROM t_checkin_log cl
-                    WHERE cl.task_id = ?
-                    GROUP BY cl.user_id
-                )
-                SELECT 
-                    user_id,
-                    checkin_count,
-                    base_points,
-                    first_points,
-                    consecutive_points,
-                    special_points,
-                    (base_points + first_points + consecutive_points + special_points) as total_points
-                FROM checkin_stats
-                ORDER BY total_points DESC, checkin_count DESC
-                LIMIT 10
-            """, (task_id,))
-
-            rankings = c.fetchall()
+            # 与积分榜使用同一个排名索引和排名顺序, 只取前 N 名, 各类积分按日汇总表只统计这 N 个用户;
+            # 排名和各类积分在同一个读事务中读取
+            c.execute("BEGIN")
+            try:
+                _, top = self.rank_index.page(c, group_id, (task_id,), 0, DAILY_RANKING_TOP_N)
+                user_ids = [row[0] for row in top]
+                placeholders = ",".join("?" * len(user_ids))
+                c.execute(f"""
+                    SELECT user_id, SUM(base_points), SUM(first_points), SUM(consecutive_points),
+                           SUM(week_points + month_points)
+                    FROM t_daily_stats
+                    WHERE task_id = ? AND user_id IN ({placeholders})
+                    GROUP BY user_id
+                """, (task_id, *user_ids))
+                breakdown = {row[0]: row[1:] for row in c.fetchall()}
+            finally:
+                conn.rollback()
+            rankings = [(user_id, checkins, *breakdown.get(user_id, (0, 0, 0, 0)), points)
+                        for user_id, checkins, points, _, _ in top]
 
             # 批量获取用户昵称
-            user_ids = [user_id for user_id, *_ in rankings]
             nicknames = self.user_manager._get_nickname_by_user_ids(user_ids)
 
             # 生成排行榜消息
-            message = f"📊 [{task_name}] 排行榜 TOP 10\n"
+            message = f"📊 [{task_name}] 排行榜 TOP {DAILY_RANKING_TOP_N}\n"
             message += "===================\n\n"
             for idx, (user_id, checkins, base, first, consec, special, total) in enumerate(rankings, 1):
                 name = nicknames.get(user_id, "未知用户")
@@ -438,28 +779,34 @@ class TaskScheduler:
             if conn:
                 conn.close()
 
+    @metrics.timed("job")
     def send_daily_ranking(self):
         """发送每日任务排行榜"""
-        conn = None
+        rankings = defaultdict(list)
         try:
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
-
-            # 获取所有启用的任务
-            c.execute("""
-                SELECT task_id, group_id, task_name
-                FROM t_task
-                WHERE enable = 1
-            """)
-
-            tasks = c.fetchall()
-            for task_id, group_id, task_name in tasks:
-                # 调用现有的排行榜发送方法
-                self.send_ranking_list(task_id)
-                logger.info(f"[PKTracker] 已发送任务 [{task_name}] 的每日排行榜")
+            for db_path in shards.paths(self.db_path):
+                conn = get_connection(db_path, readonly=True)
+                try:
+                    c = conn.cursor()
 
+                    # 获取所有启用的任务
+                    c.execute("""
+                        SELECT task_id, group_id, task_name
+                        FROM t_task
+                        WHERE enable = 1
+                    """)
+                    for task_id, group_id, task_name in c.fetchall():
+                        rankings[group_id].append((group_id, task_id, task_name))
+                finally:
+                    conn.close()
         except Exception as e:
             logger.error(f"[PKTracker] 发送每日排行榜异常: {str(e)}")
-        finally:
-            if conn:
-                conn.close()
+            return
+
+        # 各群组并行生成并发送排行榜, 每个群组内按任务顺序发送
+        self._fan_out("send_daily_ranking", rankings, self._send_daily_ranking_for_task)
+
+    def _send_daily_ranking_for_task(self, group_id, task_id, task_name):
+        # 调用现有的排行榜发送方法
+        self.send_ranking_list(task_id, group_id)
+        logger.info(f"[PKTracker] 已发送任务 [{task_name}] 的每日排行榜")
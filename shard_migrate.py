@@ -0,0 +1,170 @@
+"""把单个数据库按群组拆分为分库
+
+用法(在 dify-on-wechat 根目录下, 插件停止时执行):
+    python -m plugins.PKTracker.shard_migrate plugins/PKTracker/pkTracker.db
+
+每个群组的任务(包括正在后台清理的已删除任务)、打卡、打卡内容和全文索引、积分、管理员以及派生聚合表
+复制到分库目录下该群的文件中, 主键保持不变; 累计排名数据和群版本号由日汇总表上的触发器重新生成。
+每个分库在一个事务中写入并核对行数。原库只读不改, 确认无误后在 config.json 中开启 shards.enable。
+"""
+import argparse
+import os
+import sys
+import time
+
+from plugins.PKTracker.database import DatabaseManager, get_connection
+from plugins.PKTracker.shards import ShardRouter, shard_file
+from plugins.PKTracker.upgrade import upgrade_database
+
+# 按任务复制的表, 顺序即复制顺序: 日汇总放在最后, 插入时由触发器生成累计排名数据和群版本号
+TASK_TABLES = ["t_checkin_log", "t_bonus", "t_checkin_calendar", "t_task_stats", "t_daily_stats"]
+
+# 拆分后核对行数的表
+CHECKED_TABLES = ["t_task", "t_task_purge", "t_admin", "t_checkin_content"] + TASK_TABLES
+
+
+def group_ids(conn):
+    """库中有数据的群组: 有任务、有待清理的任务或有管理员"""
+    c = conn.cursor()
+    c.execute("""SELECT group_id FROM t_task
+                 UNION SELECT group_id FROM t_task_purge WHERE status = 'pending'
+                 UNION SELECT group_id FROM t_admin""")
+    return [row[0] for row in c.fetchall()]
+
+
+def count_groups(db_path):
+    """主库中仍有数据的群组数, 开启分库后用于提示尚未拆分的数据"""
+    conn = get_connection(db_path, readonly=True)
+    try:
+        return len(group_ids(conn))
+    finally:
+        conn.close()
+
+
+def _columns(conn, table):
+    return ", ".join(row[1] for row in conn.execute(f"PRAGMA main.table_info({table})"))
+
+
+def _copy_group(path, source, group_id, fts):
+    """把一个群组的数据复制到新建的分库, 返回 {表名: 行数}"""
+    conn = get_connection(path)
+    try:
+        conn.execute("ATTACH DATABASE ? AS src", (source,))
+        c = conn.cursor()
+        c.execute("BEGIN")
+        c.execute("CREATE TEMP TABLE shard_tasks (task_id INTEGER PRIMARY KEY)")
+        c.execute("""INSERT INTO shard_tasks
+                     SELECT task_id FROM src.t_task WHERE group_id = ?
+                     UNION SELECT task_id FROM src.t_task_purge WHERE group_id = ? AND status = 'pending'""",
+                  (group_id, group_id))
+        for table in ("t_task", "t_task_purge", "t_admin"):
+            columns = _columns(conn, table)
+            c.execute(f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM src.{table} WHERE group_id = ?",
+                      (group_id,))
+        for table in TASK_TABLES:
+            columns = _columns(conn, table)
+            c.execute(f"""INSERT INTO main.{table} ({columns}) SELECT {columns} FROM src.{table}
+                          WHERE task_id IN (SELECT task_id FROM shard_tasks)""")
+            if table == "t_checkin_log":
+                columns = _columns(conn, "t_checkin_content")
+                c.execute(f"""INSERT INTO main.t_checkin_content ({columns})
+                              SELECT {columns} FROM src.t_checkin_content
+                              WHERE checkin_id IN (SELECT checkin_id FROM main.t_checkin_log)""")
+                if fts:
+                    c.execute("""INSERT INTO main.t_checkin_fts (rowid, body)
+                                 SELECT rowid, body FROM src.t_checkin_fts
+                                 WHERE rowid IN (SELECT checkin_id FROM main.t_checkin_log)""")
+
+        counts = {}
+        for table in CHECKED_TABLES:
+            c.execute(f"SELECT COUNT(*) FROM main.{table}")
+            counts[table] = c.fetchone()[0]
+        conn.commit()
+        return counts
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _source_counts(source, group_id):
+    """原库中一个群组各表的行数, 与拆分后的分库核对"""
+    tasks = """SELECT task_id FROM t_task WHERE group_id = :group_id
+               UNION SELECT task_id FROM t_task_purge WHERE group_id = :group_id AND status = 'pending'"""
+    conn = get_connection(source, readonly=True)
+    try:
+        c = conn.cursor()
+        counts = {}
+        for table in ("t_task", "t_task_purge", "t_admin"):
+            c.execute(f"SELECT COUNT(*) FROM {table} WHERE group_id = :group_id", {"group_id": group_id})
+            counts[table] = c.fetchone()[0]
+        for table in TASK_TABLES:
+            c.execute(f"SELECT COUNT(*) FROM {table} WHERE task_id IN ({tasks})", {"group_id": group_id})
+            counts[table] = c.fetchone()[0]
+        c.execute(f"""SELECT COUNT(*) FROM t_checkin_content WHERE checkin_id IN
+                      (SELECT checkin_id FROM t_checkin_log WHERE task_id IN ({tasks}))""", {"group_id": group_id})
+        counts["t_checkin_content"] = c.fetchone()[0]
+        return counts
+    finally:
+        conn.close()
+
+
+def split_database(db_path, directory="shards", wal=True):
+    """把 db_path 按群组拆分到分库目录, 返回 [(group_id, 分库路径, {表名: 行数})]
+
+    Raises:
+        ValueError: 分库目录中已经有同名的分库文件
+    """
+    # 先按当前版本完成原库的表结构升级和回填, 分库的表结构与之一致
+    source_manager = DatabaseManager(db_path, wal=wal)
+    upgrade_database(source_manager)
+
+    router = ShardRouter()
+    router.configure(True, directory, wal)
+    shard_dir = router.shard_dir(db_path)
+    conn = get_connection(db_path, readonly=True)
+    try:
+        groups = group_ids(conn)
+    finally:
+        conn.close()
+    existing = [group_id for group_id in groups if os.path.exists(os.path.join(shard_dir, shard_file(group_id)))]
+    if existing:
+        raise ValueError(f"分库目录 {shard_dir} 中已有 {len(existing)} 个群组的分库, 例如 {existing[0]}")
+
+    os.makedirs(shard_dir, exist_ok=True)
+    results = []
+    for group_id in groups:
+        path = os.path.join(shard_dir, shard_file(group_id))
+        shard_manager = DatabaseManager(path, wal=wal)
+        counts = _copy_group(path, os.path.abspath(db_path), group_id,
+                             source_manager.fts_enabled and shard_manager.fts_enabled)
+        expected = _source_counts(os.path.abspath(db_path), group_id)
+        if counts != expected:
+            raise RuntimeError(f"群组 {group_id} 的分库行数与原库不一致: {counts} != {expected}")
+        results.append((group_id, path, counts))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把 PKTracker 的单个数据库按群组拆分为分库")
+    parser.add_argument("db_path", help="原数据库文件")
+    parser.add_argument("--directory", default="shards", help="分库目录, 相对路径相对于原数据库所在目录")
+    parser.add_argument("--no-wal", action="store_true", help="分库不使用 WAL 模式")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        results = split_database(args.db_path, args.directory, wal=not args.no_wal)
+    except (ValueError, RuntimeError) as e:
+        print(f"拆分失败: {e}", file=sys.stderr)
+        sys.exit(1)
+    for group_id, path, counts in results:
+        print(f"{group_id}: 任务 {counts['t_task']}个, 打卡 {counts['t_checkin_log']}条, "
+              f"积分 {counts['t_bonus']}条 -> {path}")
+    print(f"共拆分 {len(results)} 个群组, 耗时 {time.perf_counter() - start:.1f}s")
+    print("确认无误后在 config.json 中设置 \"shards\": {\"enable\": true}, 原库中的群组数据可以在之后删除")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import glob
+import hashlib
+import os
+import re
+import threading
+
+from common.log import logger
+from plugins.PKTracker.database import DatabaseManager
+
+# 分库文件名中保留的字符, 其他字符替换为 "_" 并追加群 ID 的哈希避免重名
+SAFE_NAME = re.compile(r"[^0-9A-Za-z@._-]")
+
+
+def shard_file(group_id):
+    """群组对应的分库文件名"""
+    name = SAFE_NAME.sub("_", group_id)
+    if name != group_id:
+        name += "_" + hashlib.sha1(group_id.encode("utf-8")).hexdigest()[:8]
+    return f"{name}.db"
+
+
+class ShardRouter:
+    """按群组把数据库访问路由到各自的 SQLite 文件
+
+    未开启分库时所有群组共用主库, path / paths 原样返回主库路径。开启后每个群组的任务、打卡、积分、管理员
+    和派生聚合表都存放在分库目录下的单独文件中(表结构与主库相同), 一个群的打卡只持有该群分库的写锁,
+    不会阻塞其他群; 主库只保留调度器租约等跨群的协调数据。
+
+    分库在第一次用到时创建表结构并执行升级回填(与启动时对主库的处理相同), 每个进程每个文件只做一次。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = "shards"
+        self.wal = True
+        self._upgrade = None
+        self._lock = threading.Lock()
+        self._ready = set()
+
+    def configure(self, enabled, directory="shards", wal=True, upgrade=None):
+        """
+        Args:
+            enabled: 是否按群组分库
+            directory: 分库目录, 相对路径相对于主库所在目录
+            wal: 分库是否使用 WAL 模式
+            upgrade: upgrade(db_manager), 分库初始化表结构后调用, 执行升级后的数据迁移和回填
+        """
+        self.enabled = enabled
+        self.directory = directory
+        self.wal = wal
+        self._upgrade = upgrade
+
+    def shard_dir(self, db_path):
+        return os.path.join(os.path.dirname(os.path.abspath(db_path)), self.directory)
+
+    def path(self, db_path, group_id):
+        """群组数据所在的数据库文件, 分库不存在时创建"""
+        if not self.enabled:
+            return db_path
+        path = os.path.join(self.shard_dir(db_path), shard_file(group_id))
+        self._ensure(path)
+        return path
+
+    def paths(self, db_path):
+        """所有存放群组数据的数据库文件, 定时任务和跨群的查询依次处理每个文件"""
+        if not self.enabled:
+            return [db_path]
+        paths = sorted(glob.glob(os.path.join(glob.escape(self.shard_dir(db_path)), "*.db")))
+        for path in paths:
+            self._ensure(path)
+        return paths
+
+    def _ensure(self, path):
+        if path in self._ready:
+            return
+        with self._lock:
+            if path in self._ready:
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            db_manager = DatabaseManager(path, wal=self.wal)
+            if self._upgrade:
+                self._upgrade(db_manager)
+            self._ready.add(path)
+            logger.debug(f"[PKTracker] 分库已就绪: {path}")
+
+
+shards = ShardRouter()
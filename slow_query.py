@@ -0,0 +1,166 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from plugins.PKTracker.metrics import normalize_sql
+
+_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\w+)(.*)$")
+_AUTO_INDEX_RE = re.compile(r"^SEARCH (?:TABLE )?(\w+) USING AUTOMATIC")
+_ALIAS_RE = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+_KEYWORDS = {"where", "join", "left", "inner", "cross", "on", "group", "order", "limit", "using", "natural"}
+
+# 每条慢查询记录中参数文本的最大长度
+MAX_PARAMS_LENGTH = 500
+
+
+def explain(conn, sql, params=()):
+    """对语句执行 EXPLAIN QUERY PLAN
+
+    Returns:
+        tuple: (计划行列表, 全表扫描(含自动索引)的表名列表, 是否使用了临时 B-TREE)
+    """
+    cursor = sqlite3.Cursor(conn)
+    try:
+        rows = cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        tables = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    finally:
+        cursor.close()
+
+    # 执行计划中使用的是别名, 先把别名映射回表名
+    names = {name: name for name in tables}
+    for table, alias in _ALIAS_RE.findall(sql):
+        if table in tables and alias and alias.lower() not in _KEYWORDS:
+            names[alias] = table
+
+    plan = [row[3] for row in rows]
+    full_scans = []
+    for detail in plan:
+        match = _SCAN_RE.match(detail)
+        if match and match.group(1) in names and "INDEX" not in match.group(2) \
+                and "PRIMARY KEY" not in match.group(2):
+            full_scans.append(names[match.group(1)])
+            continue
+        # 自动索引需要在每次查询时扫描整张表来构建
+        match = _AUTO_INDEX_RE.match(detail)
+        if match and match.group(1) in names:
+            full_scans.append(names[match.group(1)])
+    temp_btree = any("USE TEMP B-TREE" in detail for detail in plan)
+    return plan, full_scans, temp_btree
+
+
+class SlowQueryLog:
+    """慢查询记录
+
+    耗时超过阈值的语句会连同参数、耗时和 EXPLAIN QUERY PLAN 一起写入滚动日志文件(每行一条 JSON),
+    同时在内存中按归一化后的语句累计次数和总耗时, 用于生成排行摘要。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._summary = {}
+        self._logger = logging.getLogger("PKTracker.slow_query")
+        self._logger.propagate = False
+        self._handler = None
+        self.threshold = float("inf")
+        self.since = datetime.now()
+
+    @property
+    def enabled(self):
+        return self.threshold != float("inf")
+
+    def configure(self, threshold_ms, log_path=None, max_bytes=5 * 1024 * 1024, backup_count=3):
+        """设置阈值和日志文件, threshold_ms 小于等于 0 时关闭记录"""
+        self.threshold = threshold_ms / 1000 if threshold_ms and threshold_ms > 0 else float("inf")
+        if self._handler:
+            self._logger.removeHandler(self._handler)
+            self._handler.close()
+            self._handler = None
+        if log_path and self.enabled:
+            self._handler = RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count,
+                                                encoding="utf-8")
+            self._handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger.addHandler(self._handler)
+            self._logger.setLevel(logging.INFO)
+
+    def observe(self, conn, db_path, sql, params, seconds):
+        """记录一条慢查询, 由 InstrumentedCursor 在语句结束时调用"""
+        if seconds < self.threshold:
+            return
+        key = normalize_sql(sql)
+        try:
+            plan, full_scans, temp_btree = self._explain(conn, db_path, sql, params)
+        except Exception as e:
+            plan, full_scans, temp_btree = [f"EXPLAIN 失败: {e}"], [], False
+
+        with self._lock:
+            entry = self._summary.get(key)
+            if entry is None:
+                entry = self._summary[key] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0}
+            entry["count"] += 1
+            entry["total_ms"] += seconds * 1000
+            entry["max_ms"] = max(entry["max_ms"], seconds * 1000)
+            entry["plan"] = plan
+            entry["full_scans"] = full_scans
+            entry["temp_btree"] = temp_btree
+
+        if self._handler:
+            self._logger.info(json.dumps({
+                "time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                "duration_ms": round(seconds * 1000, 3),
+                "sql": key,
+                "params": repr(params)[:MAX_PARAMS_LENGTH],
+                "plan": plan,
+                "full_scan": bool(full_scans),
+                "full_scan_tables": full_scans,
+                "temp_btree": temp_btree,
+            }, ensure_ascii=False))
+
+    @staticmethod
+    def _explain(conn, db_path, sql, params):
+        try:
+            return explain(conn, sql, params)
+        except sqlite3.ProgrammingError:
+            # 连接已关闭(例如游标在连接关闭后才被回收), 另开一个连接
+            conn = sqlite3.connect(db_path)
+            try:
+                return explain(conn, sql, params)
+            finally:
+                conn.close()
+
+    def reset(self):
+        with self._lock:
+            self._summary = {}
+            self.since = datetime.now()
+
+    def summary(self):
+        """按总耗时降序返回 [(归一化语句, 统计)]"""
+        with self._lock:
+            items = [(key, dict(entry)) for key, entry in self._summary.items()]
+        return sorted(items, key=lambda kv: kv[1]["total_ms"], reverse=True)
+
+    def format_report(self, top: int = 10) -> str:
+        """生成适合在群里发送的慢查询排行"""
+        if not self.enabled:
+            return "慢查询记录未开启, 请在配置中设置 slow_query_threshold_ms"
+        message = f"🐢 慢查询排行 (阈值 {self.threshold * 1000:g}ms, 自 {self.since.strftime('%Y-%m-%d %H:%M:%S')} 起)\n"
+        message += "==================="
+        items = self.summary()
+        if not items:
+            return message + "\n\n暂无慢查询"
+        for idx, (sql, stats) in enumerate(items[:top], 1):
+            label = sql if len(sql) <= 80 else sql[:77] + "..."
+            message += f"\n\n{idx}. {label}"
+            message += (f"\n   {stats['count']}次 | 总 {stats['total_ms']:.0f}ms"
+                        f" | 平均 {stats['total_ms'] / stats['count']:.1f}ms | 最大 {stats['max_ms']:.1f}ms")
+            if stats["full_scans"]:
+                message += f"\n   ⚠️ 全表扫描: {', '.join(stats['full_scans'])}"
+            if stats["temp_btree"]:
+                message += "\n   ⚠️ 使用临时 B-TREE 排序/分组"
+        return message
+
+
+slow_queries = SlowQueryLog()
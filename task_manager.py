@@ -1,7 +1,26 @@
-import sqlite3
-from datetime import datetime
+import json
+import time
+from datetime import date, datetime
 
 from common.log import logger
+from plugins.PKTracker.database import get_connection
+from plugins.PKTracker.shards import shards
+from plugins.PKTracker.reward_rules import compile_rules
+from plugins.PKTracker.task_stats import active_streaks, roll
+
+# 删除任务后按顺序分批清理的语句, 参数为 (task_id, 每批行数)
+PURGE_STATEMENTS = [
+    "DELETE FROM t_bonus WHERE bonus_id IN (SELECT bonus_id FROM t_bonus WHERE task_id = ? LIMIT ?)",
+    "DELETE FROM t_checkin_log WHERE checkin_id IN "
+    "(SELECT checkin_id FROM t_checkin_log WHERE task_id = ? LIMIT ?)",
+    "DELETE FROM t_daily_stats WHERE (task_id, day, user_id) IN "
+    "(SELECT task_id, day, user_id FROM t_daily_stats WHERE task_id = ? LIMIT ?)",
+    "DELETE FROM t_checkin_calendar WHERE (task_id, user_id, year) IN "
+    "(SELECT task_id, user_id, year FROM t_checkin_calendar WHERE task_id = ? LIMIT ?)",
+    "DELETE FROM t_user_total WHERE (task_id, user_id) IN "
+    "(SELECT task_id, user_id FROM t_user_total WHERE task_id = ? LIMIT ?)",
+    "DELETE FROM t_task_stats WHERE task_id IN (SELECT task_id FROM t_task_stats WHERE task_id = ? LIMIT ?)",
+]
 
 
 class TaskManager:
@@ -16,7 +35,7 @@ class TaskManager:
             return "❌ 频率设置失败: 频率只能是 日/周/月"
 
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id))
             c = conn.cursor()
 
             # 检查任务是否存在
@@ -45,7 +64,7 @@ class TaskManager:
 
     def get_task_list(self, group_id: str) -> str:
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id), readonly=True)
             c = conn.cursor()
 
             c.execute("""
@@ -107,7 +126,7 @@ class TaskManager:
             return "❌ 打卡次数必须大于0"
 
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id))
             c = conn.cursor()
 
             # 检查任务是否存在
@@ -136,7 +155,7 @@ class TaskManager:
 
     def create_task(self, group_id: str, task_name: str) -> str:
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id))
             c = conn.cursor()
 
             # 检查任务名是否已存在
@@ -178,56 +197,38 @@ class TaskManager:
 
     def get_task_detail(self, group_id: str, task_name: str) -> str:
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id), readonly=True)
             c = conn.cursor()
 
-            # 获取任务基本信息
+            # 任务设置和统计都只读取一行, 统计在打卡时已经更新
             c.execute("""
                 SELECT t.task_id, t.frequency, t.max_checkins,
-                       COUNT(DISTINCT cl.user_id) as total_users,
-                       COUNT(cl.checkin_id) as total_checkins,
-                       MAX(cl.checkin_time) as last_checkin,
                        t.first_checkin_reward_enabled, t.first_checkin_reward,
                        t.consecutive_checkin_reward_enabled, t.consecutive_checkin_reward,
                        t.week_checkin_reward_enabled, t.week_checkin_reward,
                        t.month_checkin_reward_enabled, t.month_checkin_reward,
-                       t.enable, t.base_score, t.reminder_time,t.remind_text
+                       t.enable, t.base_score, t.reminder_time, t.remind_text,
+                       COALESCE(s.participants, 0), COALESCE(s.checkins, 0), s.last_checkin,
+                       s.day, s.today_users, s.today_checkins, s.streak_today, s.streak_prev, s.streak_carried
                 FROM t_task t
-                LEFT JOIN t_checkin_log cl ON t.task_id = cl.task_id
+                LEFT JOIN t_task_stats s ON s.task_id = t.task_id
                 WHERE t.group_id=? AND t.task_name=?
-                GROUP BY t.task_id
             """, (group_id, task_name))
 
             task = c.fetchone()
             if not task:
                 return f"❌ 任务 [{task_name}] 不存在"
 
-            (task_id, frequency, max_checkins, total_users, total_checkins, last_checkin,
+            (task_id, frequency, max_checkins,
              first_enable, first_bonus, continuous_enable, continuous_bonus,
              weekly_enable, weekly_bonus, monthly_enable, monthly_bonus,
-             task_enable, base_score, reminder_time, remind_text) = task
+             task_enable, base_score, reminder_time, remind_text,
+             total_users, total_checkins, last_checkin) = task[:18]
 
-            # 获取今日打卡人数
-            today = datetime.now().strftime('%Y-%m-%d')
-            c.execute("""
-                SELECT COUNT(DISTINCT user_id)
-                FROM t_checkin_log
-                WHERE task_id=? AND date(checkin_time)=?
-            """, (task_id, today))
-            today_users = c.fetchone()[0]
-
-            # 获取连续打卡人数
-            c.execute("""
-                SELECT COUNT(DISTINCT user_id)
-                FROM (
-                    SELECT user_id, COUNT(*) as consecutive_days
-                    FROM t_checkin_log
-                    WHERE task_id=? AND checkin_time >= date('now', '-3 days')
-                    GROUP BY user_id
-                    HAVING consecutive_days >= 3
-                )
-            """, (task_id,))
-            consecutive_users = c.fetchone()[0]
+            # 当日计数按记录的日期换算到今天
+            today_users, _, streak_today, streak_prev, streak_carried = (
+                roll(*task[18:], today=date.today()) if task[18] else (0, 0, 0, 0, 0))
+            consecutive_users = active_streaks(streak_today, streak_prev, streak_carried)
 
             freq_map = {"day": "每日", "week": "每周", "month": "每月"}
             freq_text = freq_map.get(frequency, frequency)
@@ -276,7 +277,7 @@ class TaskManager:
             str: 设置结果信息
         """
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id))
             c = conn.cursor()
 
             # 检查任务是否存在
@@ -324,7 +325,7 @@ class TaskManager:
             str: 设置结果信息
         """
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id))
             c = conn.cursor()
 
             # 检查任务是否存在
@@ -362,7 +363,7 @@ class TaskManager:
     def set_week_checkin(self, group_id: str, task_name: str, enable: int, bonus: int = None) -> str:
         """设置任务周冠军奖励"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id))
             c = conn.cursor()
 
             # 检查任务是否存在
@@ -400,7 +401,7 @@ class TaskManager:
     def set_month_checkin(self, group_id: str, task_name: str, enable: int, bonus: int = None) -> str:
         """设置任务月冠军奖励"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id))
             c = conn.cursor()
 
             # 检查任务是否存在
@@ -448,7 +449,7 @@ class TaskManager:
             str: 设置结果信息
         """
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id))
             c = conn.cursor()
 
             # 检查任务是否存在
@@ -483,9 +484,68 @@ class TaskManager:
         finally:
             conn.close()
 
+    def set_reward_rules(self, group_id: str, task_name: str, extra: dict = None) -> str:
+        """设置任务的附加奖励规则
+
+        Args:
+            group_id: 群组ID
+            task_name: 任务名称
+            extra: reward_rules.parse_rule_args 解析出的附加规则, 为空时清除
+
+        Returns:
+            str: 设置结果信息
+        """
+        try:
+            conn = get_connection(shards.path(self.db_path, group_id))
+            c = conn.cursor()
+
+            c.execute("""UPDATE t_task SET reward_rules=?
+                        WHERE group_id=? AND task_name=?""",
+                      (json.dumps(extra, ensure_ascii=False) if extra else None, group_id, task_name))
+            if c.rowcount == 0:
+                return f"❌ 任务 [{task_name}] 不存在"
+
+            conn.commit()
+            result = f"✅ 成功{'设置' if extra else '清除'}任务 [{task_name}] 的附加奖励规则\n\n"
+            result += self.get_reward_rules(group_id, task_name)
+            return result
+
+        except Exception as e:
+            logger.exception(f"[PKTracker] 设置奖励规则异常: {str(e)}")
+            return "❌ 设置失败,请稍后重试"
+        finally:
+            conn.close()
+
+    def get_reward_rules(self, group_id: str, task_name: str) -> str:
+        """查看任务编译后的奖励规则, 按计算顺序列出"""
+        try:
+            conn = get_connection(shards.path(self.db_path, group_id), readonly=True)
+            c = conn.cursor()
+            c.execute("""SELECT base_score, first_checkin_reward_enabled, first_checkin_reward,
+                                consecutive_checkin_reward_enabled, consecutive_checkin_reward, reward_rules
+                         FROM t_task WHERE group_id=? AND task_name=?""", (group_id, task_name))
+            task = c.fetchone()
+            if not task:
+                return f"❌ 任务 [{task_name}] 不存在"
+
+            message = f"🎯 任务 [{task_name}] 的奖励规则(按顺序计算):\n"
+            for i, line in enumerate(compile_rules(*task).describe(), 1):
+                message += f"{i}. {line}\n"
+            return message
+
+        except Exception as e:
+            logger.exception(f"[PKTracker] 获取奖励规则异常: {str(e)}")
+            return "❌ 获取奖励规则失败"
+        finally:
+            conn.close()
+
     def delete_task(self, group_id: str, task_name: str) -> str:
         """删除任务
-        
+
+        任务记录在一个短事务中立即删除并登记到 t_task_purge, 之后所有命令都看不到该任务,
+        同名任务也可以马上重新创建(task_id 自增不会复用)。任务的打卡和积分记录由
+        purge_deleted_tasks 在后台分批清理, 避免长时间持有写锁阻塞打卡。
+
         Args:
             group_id: 群组ID
             task_name: 任务名称
@@ -494,30 +554,43 @@ class TaskManager:
             str: 删除结果信息
         """
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id))
             c = conn.cursor()
 
             # 检查任务是否存在
             c.execute("""SELECT task_id FROM t_task 
                         WHERE group_id=? AND task_name=?""",
                       (group_id, task_name))
-            if not c.fetchone():
+            task = c.fetchone()
+            if not task:
                 return f"❌ 任务 [{task_name}] 不存在"
-
-            # 删除任务相关的所有数据
-            c.execute("""DELETE FROM t_checkin_log 
-                        WHERE task_id IN (
-                            SELECT task_id FROM t_task 
-                            WHERE group_id=? AND task_name=?
-                        )""", (group_id, task_name))
-
-            c.execute("""DELETE FROM t_task 
-                        WHERE group_id=? AND task_name=?""",
-                      (group_id, task_name))
+            task_id = task[0]
+
+            # 统计待清理的记录数, 用于展示清理进度
+            c.execute("SELECT COUNT(*) FROM t_checkin_log WHERE task_id=?", (task_id,))
+            checkin_count = c.fetchone()[0]
+            c.execute("SELECT COUNT(*) FROM t_bonus WHERE task_id=?", (task_id,))
+            bonus_count = c.fetchone()[0]
+            c.execute("SELECT COUNT(*) FROM t_daily_stats WHERE task_id=?", (task_id,))
+            stats_count = c.fetchone()[0]
+            c.execute("SELECT COUNT(*) FROM t_checkin_calendar WHERE task_id=?", (task_id,))
+            calendar_count = c.fetchone()[0]
+            c.execute("SELECT COUNT(*) FROM t_user_total WHERE task_id=?", (task_id,))
+            total_count = c.fetchone()[0]
+
+            # 任务统计只有一行
+            total_rows = checkin_count + bonus_count + stats_count + calendar_count + total_count + 1
+
+            c.execute("""INSERT INTO t_task_purge (task_id, group_id, task_name, total_rows)
+                        VALUES (?, ?, ?, ?)""",
+                      (task_id, group_id, task_name, total_rows))
+            c.execute("DELETE FROM t_task WHERE task_id=?", (task_id,))
 
             conn.commit()
-            result = f"✅ 成功删除任务 [{task_name}]\n\n"
-            result += self.get_task_list(group_id)
+            result = f"✅ 成功删除任务 [{task_name}]\n"
+            if checkin_count or bonus_count:
+                result += f"🧹 {checkin_count}条打卡记录和{bonus_count}条积分记录将在后台分批清理, 完成后会在群里通知\n"
+            result += "\n" + self.get_task_list(group_id)
             return result
 
         except Exception as e:
@@ -526,6 +599,84 @@ class TaskManager:
         finally:
             conn.close()
 
+    def purge_deleted_tasks(self, batch_size: int = 500, pause: float = 0.05, max_seconds: float = 20) -> list:
+        """分批清理已删除任务的积分和打卡记录
+
+        每批最多删除 batch_size 行并单独提交, 批次之间休眠 pause 秒让出写锁;
+        总耗时超过 max_seconds 后停止, 剩余部分在下次调用时继续。
+
+        Returns:
+            list: 本次清理完成的任务 [(group_id, task_name, 删除的记录数)]
+        """
+        deadline = time.monotonic() + max_seconds
+        finished = []
+        # 按群组分库时依次清理每个分库, 共用同一个截止时间
+        for db_path in shards.paths(self.db_path):
+            if not self._purge_database(db_path, batch_size, pause, deadline, finished):
+                break
+        return finished
+
+    @staticmethod
+    def _purge_database(db_path, batch_size, pause, deadline, finished):
+        """清理一个数据库中已删除的任务, 超过截止时间时返回 False"""
+        conn = get_connection(db_path)
+        try:
+            c = conn.cursor()
+            c.execute("""SELECT task_id, group_id, task_name FROM t_task_purge
+                        WHERE status='pending' ORDER BY task_id""")
+            for task_id, group_id, task_name in c.fetchall():
+                # 先删积分再删打卡, 中途中断也不会留下指向已删除打卡的积分
+                for statement in PURGE_STATEMENTS:
+                    while True:
+                        if time.monotonic() > deadline:
+                            return False
+                        c.execute(statement, (task_id, batch_size))
+                        deleted = c.rowcount
+                        c.execute("""UPDATE t_task_purge SET deleted_rows = deleted_rows + ?
+                                    WHERE task_id=?""", (deleted, task_id))
+                        conn.commit()
+                        if deleted < batch_size:
+                            break
+                        time.sleep(pause)
+
+                c.execute("""UPDATE t_task_purge SET status='done', finish_time=CURRENT_TIMESTAMP
+                            WHERE task_id=?""", (task_id,))
+                c.execute("SELECT deleted_rows FROM t_task_purge WHERE task_id=?", (task_id,))
+                deleted_rows = c.fetchone()[0]
+                conn.commit()
+                finished.append((group_id, task_name, deleted_rows))
+                logger.info(f"[PKTracker] 任务 [{task_name}] 的历史数据已清理完成, 共 {deleted_rows} 条")
+            return True
+        finally:
+            conn.close()
+
+    def get_purge_progress(self, group_id: str) -> str:
+        """查看本群已删除任务的后台清理进度"""
+        try:
+            conn = get_connection(shards.path(self.db_path, group_id), readonly=True)
+            c = conn.cursor()
+            c.execute("""SELECT task_name, total_rows, deleted_rows, create_time
+                        FROM t_task_purge
+                        WHERE group_id=? AND status='pending'
+                        ORDER BY task_id""", (group_id,))
+            rows = c.fetchall()
+            if not rows:
+                return "✅ 没有正在清理的任务"
+
+            message = "🧹 任务清理进度\n"
+            message += "==================="
+            for task_name, total_rows, deleted_rows, create_time in rows:
+                percent = deleted_rows * 100 // total_rows if total_rows else 100
+                message += f"\n\n🔸 [{task_name}] (删除于 {create_time})"
+                message += f"\n   已清理 {deleted_rows}/{total_rows} 条 ({percent}%)"
+            return message
+
+        except Exception as e:
+            logger.exception(f"[PKTracker] 查询清理进度异常: {str(e)}")
+            return "❌ 查询失败,请稍后重试"
+        finally:
+            conn.close()
+
     def set_reminder(self, group_id: str, task_name: str, reminder_time: str, remind_text: str = None) -> str:
         """设置任务提醒时间和内容
         
@@ -545,7 +696,7 @@ class TaskManager:
             except ValueError:
                 return "❌ 时间格式错误，请使用 HH:MM 格式，例如：08:00"
 
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection(shards.path(self.db_path, group_id))
             c = conn.cursor()
 
             # 检查任务是否存在
@@ -0,0 +1,150 @@
+from collections import namedtuple
+from datetime import date, timedelta
+
+from plugins.PKTracker.checkin_calendar import current_streak, to_int
+from plugins.PKTracker.consistency import register_aggregate
+from plugins.PKTracker.reward_rules import STREAK_DAYS
+
+UPSERT_STATS = """
+    INSERT INTO t_task_stats (task_id, participants, checkins, last_checkin,
+                              day, today_users, today_checkins, streak_today, streak_prev, streak_carried)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(task_id) DO UPDATE SET
+        participants = excluded.participants, checkins = excluded.checkins, last_checkin = excluded.last_checkin,
+        day = excluded.day, today_users = excluded.today_users, today_checkins = excluded.today_checkins,
+        streak_today = excluded.streak_today, streak_prev = excluded.streak_prev,
+        streak_carried = excluded.streak_carried
+"""
+
+# 打卡时读取的任务统计, 当日计数已换算到打卡当天
+Snapshot = namedtuple("Snapshot", ["participants", "checkins", "last_checkin", "today_users", "today_checkins",
+                                   "streak_today", "streak_prev", "streak_carried"])
+
+
+def roll(day, today_users, today_checkins, streak_today, streak_prev, streak_carried, today):
+    """把按 day 记录的当日计数换算到 today
+
+    过了一天时, 前一天连续达标的人数成为"昨天达标"的人数, 当日计数清零; 超过一天则全部清零。
+
+    Returns:
+        tuple: (today_users, today_checkins, streak_today, streak_prev, streak_carried)
+    """
+    if day == today.isoformat():
+        return today_users, today_checkins, streak_today, streak_prev, streak_carried
+    if day == (today - timedelta(days=1)).isoformat():
+        return 0, 0, 0, streak_today, 0
+    return 0, 0, 0, 0, 0
+
+
+def active_streaks(streak_today, streak_prev, streak_carried):
+    """连续打卡达标人数: 今天达标的, 加上昨天达标且今天还没打卡(连续天数仍然有效)的"""
+    return streak_today + streak_prev - streak_carried
+
+
+def load(cursor, task_id, day):
+    """在打卡的事务中读取任务统计, 当日计数换算到 day(打卡当天)
+
+    须在写入打卡记录之后调用, 此时已经处于写事务中, 读到的计数不会被并发的打卡改变。
+
+    Returns:
+        Snapshot: 不含本次打卡的统计
+    """
+    cursor.execute("""SELECT participants, checkins, last_checkin,
+                             day, today_users, today_checkins, streak_today, streak_prev, streak_carried
+                      FROM t_task_stats WHERE task_id = ?""", (task_id,))
+    row = cursor.fetchone() or (0, 0, "", day.isoformat(), 0, 0, 0, 0, 0)
+    return Snapshot(*row[:3], *roll(*row[3:], today=day))
+
+
+def record_checkin(cursor, task_id, user_id, checkin_time, seen, streak, snapshot):
+    """在打卡的事务中更新任务统计, 须在写入打卡记录之后调用
+
+    Args:
+        checkin_time: 打卡时间, '%Y-%m-%d %H:%M:%S' 格式
+        seen: 用户当天此前是否已经打过卡
+        streak: 截至当天的连续打卡天数
+        snapshot: 同一事务中由 load 读取的统计
+    """
+    # 用户在该任务下只有刚写入的这一条打卡时是新的参与者, 最多读两行
+    cursor.execute("""SELECT COUNT(*) FROM (SELECT 1 FROM t_checkin_log
+                      WHERE task_id = ? AND user_id = ? LIMIT 2)""", (task_id, user_id))
+    new_user = cursor.fetchone()[0] == 1
+
+    today_users, streak_today, streak_carried = snapshot.today_users, snapshot.streak_today, snapshot.streak_carried
+    if not seen:
+        today_users += 1
+        if streak >= STREAK_DAYS:
+            streak_today += 1
+        # 截至昨天已经达标的用户今天继续打卡, 不再计入"昨天达标且今天未打卡"
+        if streak - 1 >= STREAK_DAYS:
+            streak_carried += 1
+    cursor.execute(UPSERT_STATS, (task_id, snapshot.participants + new_user, snapshot.checkins + 1,
+                                  max(snapshot.last_checkin, checkin_time), checkin_time[:10], today_users,
+                                  snapshot.today_checkins + 1, streak_today, snapshot.streak_prev, streak_carried))
+
+
+def _expected_row(cursor, task_id, today):
+    cursor.execute("""SELECT COUNT(DISTINCT user_id), COUNT(*), COALESCE(MAX(checkin_time), '')
+                      FROM t_checkin_log WHERE task_id = ?""", (task_id,))
+    participants, checkins, last_checkin = cursor.fetchone()
+    cursor.execute("""SELECT COUNT(*) FROM t_checkin_log
+                      WHERE task_id = ? AND checkin_time >= ? AND checkin_time <= ?""",
+                   (task_id, f"{today.isoformat()} 00:00:00", f"{today.isoformat()} 23:59:59"))
+    today_checkins = cursor.fetchone()[0]
+
+    yesterday = today - timedelta(days=1)
+    cursor.execute("""SELECT user_id, year, bits FROM t_checkin_calendar
+                      WHERE task_id = ? AND year BETWEEN ? AND ?""", (task_id, yesterday.year - 1, today.year))
+    bitmaps = {}
+    for user_id, year, bits in cursor.fetchall():
+        bitmaps.setdefault(user_id, {})[year] = to_int(bits)
+    today_users = streak_today = streak_prev = streak_carried = 0
+    for user_bitmaps in bitmaps.values():
+        today_streak = current_streak(user_bitmaps, today)
+        prev_streak = current_streak(user_bitmaps, yesterday)
+        today_users += today_streak > 0
+        streak_today += today_streak >= STREAK_DAYS
+        streak_prev += prev_streak >= STREAK_DAYS
+        streak_carried += today_streak > 0 and prev_streak >= STREAK_DAYS
+    return (task_id, participants, checkins, last_checkin,
+            today.isoformat(), today_users, today_checkins, streak_today, streak_prev, streak_carried)
+
+
+def rebuild_task(cursor, task_id):
+    """按打卡记录和打卡日历重新计算一个任务的统计, 返回写入的行数; 调用方负责提交"""
+    # 先执行 DELETE 开启写事务, 计算期间不会有新的打卡提交
+    cursor.execute("DELETE FROM t_task_stats WHERE task_id = ?", (task_id,))
+    cursor.execute(UPSERT_STATS, _expected_row(cursor, task_id, date.today()))
+    return 1
+
+
+def _expected_rows(cursor, task_id):
+    return [_expected_row(cursor, task_id, date.today())]
+
+
+def _actual_rows(cursor, task_id):
+    today = date.today()
+    cursor.execute("""SELECT participants, checkins, last_checkin,
+                             day, today_users, today_checkins, streak_today, streak_prev, streak_carried
+                      FROM t_task_stats WHERE task_id = ?""", (task_id,))
+    row = cursor.fetchone()
+    if row is None:
+        # 还没有统计的任务与没有打卡的任务相同
+        return [(task_id, 0, 0, "", today.isoformat(), 0, 0, 0, 0, 0)]
+    return [(task_id,) + tuple(row[:3]) + (today.isoformat(),) + roll(*row[3:], today=today)]
+
+
+aggregate = register_aggregate("t_task_stats", _expected_rows, _actual_rows, rebuild_task, "任务统计")
+
+
+class TaskStats:
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def backfill(self, pause=0.01):
+        """按打卡记录和打卡日历回填所有任务的统计
+
+        Returns:
+            int: 写入的行数
+        """
+        return aggregate.backfill(self.db_path, pause)
@@ -0,0 +1,139 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+
+class TokenBucket:
+    """令牌桶: 以 rate 个/秒的速度补充令牌, 最多积攒 burst 个"""
+    __slots__ = ("tokens", "updated", "warned")
+
+    def __init__(self, burst, now):
+        self.tokens = float(burst)
+        self.updated = now
+        # 本轮限流是否已经回复过提示, 避免对刷屏的每条消息都回复
+        self.warned = False
+
+    def refill(self, rate, burst, now):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+class Throttle:
+    """打卡限流
+
+    按 (群, 用户) 和群两级令牌桶在访问数据库之前拒绝刷屏消息。两级都有令牌时才放行并同时扣减。
+    桶保存在按最近使用排序的字典中: 空闲时间足够让桶重新装满的桶与新建的桶等价, 会被直接清理;
+    桶的总数超过 max_buckets 时淘汰最久未使用的桶, 因此内存占用有上限。
+    """
+
+    # 每次放行/拒绝时顺带清理的空闲桶数量上限, 把清理开销分摊到各次调用
+    EVICT_PER_CALL = 8
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        self.configure()
+
+    def configure(self, user_per_minute=6, user_burst=3, group_per_minute=120, group_burst=30,
+                  max_buckets=10000):
+        """设置限流参数, 速率为 0 表示不限制该级别"""
+        with self._lock:
+            self.user_rate = user_per_minute / 60
+            self.user_burst = user_burst
+            self.group_rate = group_per_minute / 60
+            self.group_burst = group_burst
+            self.max_buckets = max_buckets
+            self._buckets.clear()
+            self._reset_stats()
+
+    @property
+    def enabled(self):
+        return self.user_rate > 0 or self.group_rate > 0
+
+    def reset(self):
+        """清空统计(不影响桶的状态)"""
+        with self._lock:
+            self._reset_stats()
+
+    def _reset_stats(self):
+        self.since = datetime.now()
+        self.stats = {"allowed": 0, "throttled_user": 0, "throttled_group": 0, "evicted": 0}
+
+    def _bucket(self, key, rate, burst, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(burst, now)
+        else:
+            bucket.refill(rate, burst, now)
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _evict(self, now):
+        # 最久未使用的桶在最前面, 遇到第一个仍未装满的桶即可停止
+        for _ in range(self.EVICT_PER_CALL):
+            if not self._buckets:
+                return
+            key, bucket = next(iter(self._buckets.items()))
+            rate, burst = (self.group_rate, self.group_burst) if len(key) == 1 else (self.user_rate, self.user_burst)
+            if bucket.tokens + (now - bucket.updated) * rate < burst:
+                break
+            del self._buckets[key]
+            self.stats["evicted"] += 1
+
+    def _trim(self):
+        # 刚取到的桶已移到末尾, 至少保留两个桶即可保证不会淘汰本次使用的桶
+        while len(self._buckets) > max(self.max_buckets, 2):
+            self._buckets.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def check(self, group_id, user_id):
+        """判断一次打卡是否放行
+
+        Returns:
+            tuple: (是否放行, 被拒绝时是否需要回复提示, 拒绝的级别 "user"/"group")
+        """
+        if not self.enabled:
+            return True, False, None
+        now = time.monotonic()
+        with self._lock:
+            # 先清理空闲桶再取桶, 避免刚取到的桶被清理掉
+            self._evict(now)
+            user = self._bucket((group_id, user_id), self.user_rate, self.user_burst, now) \
+                if self.user_rate > 0 else None
+            group = self._bucket((group_id,), self.group_rate, self.group_burst, now) \
+                if self.group_rate > 0 else None
+            self._trim()
+
+            if user is not None and user.tokens < 1:
+                level, bucket = "user", user
+            elif group is not None and group.tokens < 1:
+                level, bucket = "group", group
+            else:
+                for b in (user, group):
+                    if b is not None:
+                        b.tokens -= 1
+                        b.warned = False
+                self.stats["allowed"] += 1
+                return True, False, None
+
+            self.stats[f"throttled_{level}"] += 1
+            notify = not bucket.warned
+            bucket.warned = True
+            return False, notify, level
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, buckets=len(self._buckets), since=self.since.strftime('%Y-%m-%d %H:%M:%S'))
+
+    def format_report(self):
+        if not self.enabled:
+            return "🚦 打卡限流: 未开启"
+        stats = self.snapshot()
+        return (f"🚦 打卡限流 (自 {stats['since']} 起):\n"
+                f"   - 放行: {stats['allowed']}次\n"
+                f"   - 用户限流: {stats['throttled_user']}次 | 群限流: {stats['throttled_group']}次\n"
+                f"   - 活跃桶: {stats['buckets']}个 | 已清理: {stats['evicted']}个")
+
+
+checkin_throttle = Throttle()
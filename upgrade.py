@@ -0,0 +1,35 @@
+from plugins.PKTracker.checkin_calendar import CheckinCalendar
+from plugins.PKTracker.checkin_search import CheckinSearch
+from plugins.PKTracker.content_store import checkin_content
+from plugins.PKTracker.daily_stats import DailyStats
+from plugins.PKTracker.rank_index import UserTotals
+from plugins.PKTracker.task_stats import TaskStats
+
+
+def upgrade_database(db_manager):
+    """表结构初始化后, 按需迁移打卡内容并回填派生聚合表
+
+    主库在插件启动时执行, 各分库在第一次用到时执行, 拆分数据库前也会对原库执行一次。
+
+    Args:
+        db_manager: 刚完成初始化的 DatabaseManager, 根据其中的标记判断需要执行的步骤
+    """
+    db_path = db_manager.db_path
+    if db_manager.inline_content:
+        # 升级后第一次启动时把打卡记录表中的内容迁移到打卡内容表
+        checkin_content.migrate(db_path)
+    if db_manager.daily_stats_created:
+        # 升级后第一次启动时按历史记录回填日汇总
+        DailyStats(db_path).backfill()
+    if db_manager.user_total_created:
+        # 累计排名数据由日汇总表计算, 需要在日汇总回填之后执行
+        UserTotals(db_path).backfill()
+    if db_manager.checkin_calendar_created:
+        # 升级后第一次启动时按历史记录回填打卡日历
+        CheckinCalendar(db_path, None).backfill()
+    if db_manager.task_stats_created:
+        # 任务统计中的当日和连续打卡人数由打卡日历计算, 需要在打卡日历回填之后执行
+        TaskStats(db_path).backfill()
+    if db_manager.checkin_fts_created:
+        # 升级后第一次启动时为已有的打卡内容建立全文索引, 需要在打卡内容迁移之后执行
+        CheckinSearch(db_path, None).backfill()
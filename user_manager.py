@@ -2,18 +2,22 @@ import requests
 
 from common.log import logger
 from config import conf
+from plugins.PKTracker.metrics import metrics
 
 
 class UserManager:
     def __init__(self, client, app_id):
         self.client = client
         self.app_id = app_id
+        # 登录账号(机器人)自己的 wxid, 第一次获取群成员时查询
+        self._self_wxid = None
 
     def _get_user_id_by_nickname(self, nickname):
         """根据昵称或备注名获取用户 ID"""
         try:
             # 获取所有联系人列表
-            contacts_response = self.client.fetch_contacts_list(self.app_id)
+            with metrics.timer("http", "contacts/fetchContactsList"):
+                contacts_response = self.client.fetch_contacts_list(self.app_id)
             print(f"[PKTracker] fetch_contacts_list 返回数据: {contacts_response}")  # 打印返回数据
             if contacts_response.get('ret') == 200:
                 # 提取好友的 wxid 列表
@@ -29,7 +33,8 @@ class UserManager:
                 for i in range(0, len(wxids), 20):
                     batch_wxids = wxids[i:i + 20]  # 每次最多 20 个 wxid
                     # 获取当前批次的详细信息
-                    detail_response = self.client.get_detail_info(self.app_id, batch_wxids)
+                    with metrics.timer("http", "contacts/getDetailInfo"):
+                        detail_response = self.client.get_detail_info(self.app_id, batch_wxids)
                     print(f"[PKTracker] get_detail_info 返回数据: {detail_response}")  # 打印详细信息
                     if detail_response.get('ret') == 200:
                         details = detail_response.get('data', [])
@@ -42,19 +47,50 @@ class UserManager:
             logger.error(f"[PKTracker] 获取用户信息失败: {e}")
             return None
 
+    def get_self_wxid(self):
+        """登录账号(机器人)的 wxid, 获取失败时返回 None, 下次调用时再试"""
+        if self._self_wxid is None:
+            try:
+                with metrics.timer("http", "personal/getProfile"):
+                    response = self.client.get_profile(self.app_id)
+                if response.get('ret') == 200:
+                    self._self_wxid = response.get('data', {}).get('wxid')
+                else:
+                    logger.warning(f"[PKTracker] 获取登录账号信息失败: {response.get('msg')}")
+            except Exception as e:
+                logger.error(f"[PKTracker] 获取登录账号信息失败: {e}")
+        return self._self_wxid
+
+    def get_group_members(self, group_id):
+        """一次获取群的全部成员, 返回 {wxid: 群昵称或昵称}(按群成员列表的顺序, 不含机器人自己), 失败时返回 None"""
+        try:
+            with metrics.timer("http", "group/getChatroomMemberList"):
+                response = self.client.get_chatroom_member_list(self.app_id, group_id)
+            if response.get('ret') == 200:
+                members = response.get('data', {}).get('memberList') or []
+                # 群成员列表包含机器人自己, 打卡提醒不应 @ 机器人或把它算作未打卡
+                self_wxid = self.get_self_wxid()
+                return {member['wxid']: member.get('displayName') or member.get('nickName') or member['wxid']
+                        for member in members if member.get('wxid') and member['wxid'] != self_wxid}
+            logger.warning(f"[PKTracker] 获取群 {group_id} 成员列表失败: {response.get('msg')}")
+        except Exception as e:
+            logger.error(f"[PKTracker] 获取群成员列表失败: {e}")
+        return None
+
     def _get_user_nickname(self, user_id):
         """获取用户昵称"""
         try:
-            response = requests.post(
-                f"{conf().get('gewechat_base_url')}/contacts/getBriefInfo",
-                json={
-                    "appId": conf().get('gewechat_app_id'),
-                    "wxids": [user_id]
-                },
-                headers={
-                    "X-GEWE-TOKEN": conf().get('gewechat_token')
-                }
-            )
+            with metrics.timer("http", "contacts/getBriefInfo"):
+                response = requests.post(
+                    f"{conf().get('gewechat_base_url')}/contacts/getBriefInfo",
+                    json={
+                        "appId": conf().get('gewechat_app_id'),
+                        "wxids": [user_id]
+                    },
+                    headers={
+                        "X-GEWE-TOKEN": conf().get('gewechat_token')
+                    }
+                )
             if response.status_code == 200:
                 data = response.json()
                 if data.get('ret') == 200 and data.get('data'):
@@ -70,16 +106,17 @@ class UserManager:
             return {}
 
         try:
-            response = requests.post(
-                f"{conf().get('gewechat_base_url')}/contacts/getBriefInfo",
-                json={
-                    "appId": conf().get('gewechat_app_id'),
-                    "wxids": user_ids
-                },
-                headers={
-                    "X-GEWE-TOKEN": conf().get('gewechat_token')
-                }
-            )
+            with metrics.timer("http", "contacts/getBriefInfo"):
+                response = requests.post(
+                    f"{conf().get('gewechat_base_url')}/contacts/getBriefInfo",
+                    json={
+                        "appId": conf().get('gewechat_app_id'),
+                        "wxids": user_ids
+                    },
+                    headers={
+                        "X-GEWE-TOKEN": conf().get('gewechat_token')
+                    }
+                )
 
             if response.status_code == 200:
                 data = response.json()